@@ -0,0 +1,6 @@
+"""Benchmarks for the toolkit (not run as part of the test suite).
+
+Run a benchmark as a module from the top level of the repository, e.g.::
+
+    $ python -m benchmarks.extraction --observables 100000
+"""
@@ -0,0 +1,72 @@
+"""Benchmark collecting the observables of very large STIX packages.
+
+Times StixTransform._observables_for_package for packages of increasing
+size, so that any super-linear growth shows up as a rising time per
+observable. A deeply nested observable composition is also collected to
+check that nesting depth is not limited by the recursion limit.
+
+Usage::
+
+    $ python -m benchmarks.collection [--sizes 10000 100000 1000000]
+"""
+
+import sys
+import argparse
+
+from cybox.core import Observable, ObservableComposition
+from cybox.objects.address_object import Address
+from stix.core import STIXPackage
+
+from certau.transform import StixStatsTransform, StixCsvTransform
+
+from .common import make_package, timed
+
+
+def make_nested_package(depth):
+    """Build a package with an Address observable nested depth
+    compositions deep.
+    """
+    package = STIXPackage()
+    observable = Observable(Address('10.0.0.1', Address.CAT_IPV4))
+    observable.id_ = 'example:Observable-nested'
+    for _ in range(depth):
+        composition = ObservableComposition(operator='AND')
+        composition.add(observable)
+        observable = Observable()
+        observable.observable_composition = composition
+    package.add_observable(observable)
+    return package
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--depth', type=int,
+                        default=sys.getrecursionlimit() * 2,
+                        help='nesting depth of the composition check')
+    options = parser.parse_args()
+
+    for size in options.sizes:
+        build_time, package = timed(make_package, size)
+        print('Built package with {} observables in {:.2f}s'.format(
+            size, build_time))
+        for transform_class in (StixStatsTransform, StixCsvTransform):
+            elapsed, observables = timed(
+                transform_class._observables_for_package, package,
+            )
+            count = sum(len(o) for o in observables.values())
+            print('{:<24} collect {:7.2f}s  {:6.2f}us/observable'
+                  '  ({} observables)'.format(
+                      transform_class.__name__, elapsed,
+                      elapsed * 1e6 / size, count))
+
+    package = make_nested_package(options.depth)
+    elapsed, observables = timed(StixCsvTransform._observables_for_package,
+                                 package)
+    print('Collected from a composition nested {} deep in {:.2f}s'.format(
+        options.depth, elapsed))
+
+
+if __name__ == '__main__':
+    main()
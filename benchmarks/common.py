@@ -0,0 +1,28 @@
+"""Helpers for the benchmarks."""
+
+import time
+
+# The package generator is shared with the tests
+from conftest import make_package
+
+
+def all_observables(package):
+    """Returns a list of the observables with objects in a package."""
+    result = []
+    stack = list(package.observables or [])
+    for indicator in package.indicators or []:
+        stack.extend(indicator.observables or [])
+    while stack:
+        observable = stack.pop()
+        if observable.observable_composition is not None:
+            stack.extend(observable.observable_composition.observables)
+        elif observable.object_ is not None:
+            result.append(observable)
+    return result
+
+
+def timed(func, *args, **kwargs):
+    """Returns (seconds, result) for a function call."""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
@@ -0,0 +1,65 @@
+"""Benchmark observable extraction from large STIX packages.
+
+Two timings are reported for each transform class: extracting field values
+from every observable of a supported type
+(StixTransform._field_values_for_observable), and collecting the
+observables of the whole package (StixTransform._observables_for_package).
+
+Usage::
+
+    $ python -m benchmarks.extraction [--observables 100000] [--repeat 3]
+"""
+
+import argparse
+
+from certau.transform import StixCsvTransform, StixBroIntelTransform
+from certau.transform import StixMispTransform
+
+from .common import make_package, all_observables, timed
+
+
+def _extract_fields(transform_class, observables):
+    rows = 0
+    for observable in observables:
+        object_type = transform_class._observable_object_type(observable)
+        if object_type in transform_class.OBJECT_FIELDS:
+            rows += len(transform_class._field_values_for_observable(
+                observable,
+            ))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--observables', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-collect', action='store_true',
+                        help='only time field extraction')
+    options = parser.parse_args()
+
+    build_time, package = timed(make_package, options.observables)
+    observables = all_observables(package)
+    print('Built package with {} observables in {:.2f}s'.format(
+        options.observables, build_time))
+
+    for transform_class in (StixCsvTransform, StixBroIntelTransform,
+                            StixMispTransform):
+        fields_times = []
+        collect_times = []
+        for _ in range(options.repeat):
+            elapsed, rows = timed(_extract_fields, transform_class,
+                                  observables)
+            fields_times.append(elapsed)
+            if not options.skip_collect:
+                elapsed, _ = timed(transform_class._observables_for_package,
+                                   package)
+                collect_times.append(elapsed)
+        line = '{:<24} fields {:7.2f}s'.format(
+            transform_class.__name__, min(fields_times))
+        if collect_times:
+            line += '  collect {:7.2f}s'.format(min(collect_times))
+        print(line + '  ({} rows)'.format(rows))
+
+
+if __name__ == '__main__':
+    main()
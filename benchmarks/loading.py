@@ -0,0 +1,89 @@
+"""Benchmark loading STIX files and extracting their observables.
+
+A large package is written to a file, which is then loaded and its
+observables extracted for several transforms: once with python-stix
+(StixSource.load_stix_package and StixTransformGroup._observables_for_package)
+and once reading the fields from the XML using XPath
+(StixSource.load_extracted_package with XPath extraction enabled).
+
+Usage::
+
+    $ python -m benchmarks.loading [--observables 20000] [--repeat 3]
+"""
+
+import os
+import argparse
+import tempfile
+
+from certau.source import StixSource
+from certau.transform import StixCsvTransform, StixBroIntelTransform
+from certau.transform import StixTransformGroup
+
+from .common import make_package, timed
+
+
+def _normalised(observables):
+    return dict(
+        (transform_class.__name__, dict(
+            (object_type, [
+                (o.id, [dict(fields.items()) for fields in o.fields or []])
+                for o in object_observables
+            ])
+            for object_type, object_observables in class_observables.items()
+        ))
+        for transform_class, class_observables in observables.items()
+    )
+
+
+def _load_package(source, file_name, group):
+    package = source.load_stix_package(file_name)
+    return group._detached_observables(
+        group._observables_for_package(package),
+    )
+
+
+def _load_extracted(source, file_name, group):
+    _, observables = source.load_extracted_package(file_name, group)
+    return observables
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--observables', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    options = parser.parse_args()
+
+    package = make_package(options.observables)
+    handle, file_name = tempfile.mkstemp(suffix='.xml')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(package.to_xml())
+        del package
+        print('Wrote package with {} observables ({} bytes)'.format(
+            options.observables, os.path.getsize(file_name)))
+
+        group = StixTransformGroup([StixCsvTransform, StixBroIntelTransform])
+        source = StixSource()
+        xpath_source = StixSource()
+        xpath_source._xpath_extract = True
+        results = []
+        for name, func, source_ in (('python-stix', _load_package, source),
+                                    ('xpath', _load_extracted, xpath_source)):
+            times = []
+            for _ in range(options.repeat):
+                elapsed, observables = timed(func, source_, file_name, group)
+                times.append(elapsed)
+            results.append(_normalised(observables))
+            count = sum(len(o) for transform_observables
+                        in observables.values()
+                        for o in transform_observables.values())
+            print('{:<12} load {:7.2f}s  ({} observables)'.format(
+                name, min(times), count))
+        if results[0] != results[1]:
+            print('WARNING: the extracted observables differ')
+    finally:
+        os.remove(file_name)
+
+
+if __name__ == '__main__':
+    main()
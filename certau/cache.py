@@ -0,0 +1,265 @@
+"""Persistent caches used to avoid repeating expensive work between runs."""
+
+import os
+import time
+import hashlib
+import sqlite3
+import cPickle as pickle
+
+import stix
+from stix.core import STIXPackage
+
+
+def file_digest(file_, block_size=1 << 20):
+    """Returns the SHA-256 digest (hex string) of a file's content."""
+    digest = hashlib.sha256()
+    with open(file_, 'rb') as file_obj:
+        for block in iter(lambda: file_obj.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_digest(content):
+    """Returns the SHA-256 digest (hex string) of a string."""
+    return hashlib.sha256(content).hexdigest()
+
+
+def package_stub(package):
+    """Returns a package containing only the id, timestamp, header and
+    version of a package.
+    """
+    stub = STIXPackage(
+        id_=package.id_,
+        timestamp=package.timestamp,
+        stix_header=package.stix_header,
+    )
+    stub.version = package.version
+    return stub
+
+
+class DiskCache(object):
+    """A persistent key/value store with a size limit.
+
+    Values are pickled and stored in an SQLite database. When the total
+    size of the stored values exceeds the limit, the least recently used
+    entries are evicted.
+
+    Args:
+        path: the name of the database file (created if required)
+        max_size: the maximum total size (in bytes) of the stored values
+        reader: if True, the database (which must already exist) is only
+            read using :py:func:`peek`, so it isn't set up or sized (e.g.
+            for worker processes, where another process does the writing)
+
+    Attributes:
+        path: the name of the database file
+    """
+
+    EVICT_BATCH = 100
+
+    def __init__(self, path, max_size=512 * 1024 * 1024, reader=False):
+        self.path = path
+        self._max_size = max_size
+        # Sources may be created in one thread and read in another
+        self._db = sqlite3.connect(os.path.expanduser(path),
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        self._db.text_factory = str
+        if reader:
+            self._size = None
+            return
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)'
+        )
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)'
+        )
+        self._size = self._total_size()
+
+    def _total_size(self):
+        row = self._db.execute('SELECT SUM(size) FROM cache').fetchone()
+        return row[0] or 0
+
+    def _evict(self):
+        """Remove least recently used entries until under the size limit."""
+        self._size = self._total_size()
+        while self._size > self._max_size:
+            rows = self._db.execute(
+                'SELECT key, size FROM cache ORDER BY accessed LIMIT ?',
+                (self.EVICT_BATCH,),
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+                self._size -= size
+                if self._size <= self._max_size:
+                    break
+
+    def get(self, key, default=None):
+        """Returns the value stored for key (or default)."""
+        row = self._db.execute(
+            'SELECT value FROM cache WHERE key = ?', (key,),
+        ).fetchone()
+        if row is None:
+            return default
+        self._db.execute(
+            'UPDATE cache SET accessed = ? WHERE key = ?', (time.time(), key),
+        )
+        return pickle.loads(str(row[0]))
+
+    def peek(self, key, default=None):
+        """Returns the value stored for key (or default), without updating
+        the entry's access time (so nothing is written to the database).
+        """
+        row = self._db.execute(
+            'SELECT value FROM cache WHERE key = ?', (key,),
+        ).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(str(row[0]))
+
+    def touch(self, keys):
+        """Updates the access time of the entries for several keys (e.g.
+        those read by another process using :py:func:`peek`).
+        """
+        accessed = time.time()
+        self._db.execute('BEGIN')
+        try:
+            self._db.executemany(
+                'UPDATE cache SET accessed = ? WHERE key = ?',
+                ((accessed, key) for key in keys),
+            )
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _store(self, key, value, accessed):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        row = self._db.execute(
+            'SELECT size FROM cache WHERE key = ?', (key,),
+        ).fetchone()
+        if row is not None:
+            self._size -= row[0]
+        self._db.execute(
+            'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+            (key, sqlite3.Binary(data), len(data), accessed),
+        )
+        self._size += len(data)
+
+    def set(self, key, value):
+        """Stores a value for key, evicting old entries if required."""
+        self._store(key, value, time.time())
+        if self._size > self._max_size:
+            self._evict()
+
+    def set_many(self, items):
+        """Stores several (key, value) pairs in a single transaction,
+        evicting old entries if required.
+        """
+        accessed = time.time()
+        self._db.execute('BEGIN')
+        try:
+            for key, value in items:
+                self._store(key, value, accessed)
+        except Exception:
+            self._db.execute('ROLLBACK')
+            self._size = self._total_size()
+            raise
+        self._db.execute('COMMIT')
+        if self._size > self._max_size:
+            self._evict()
+
+    def __contains__(self, key):
+        row = self._db.execute(
+            'SELECT 1 FROM cache WHERE key = ?', (key,),
+        ).fetchone()
+        return row is not None
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+class ObservableCache(DiskCache):
+    """A persistent cache of observables extracted from STIX files.
+
+    Entries are keyed by the digest of the file content and a fingerprint
+    of the transform class (see
+    :py:func:`StixTransform._extraction_fingerprint`), so entries are
+    no longer used once the transform's fields or constraints change.
+
+    Each entry contains the package id, timestamp and header along with
+    the extracted observables (without the
+    :py:class:`Observable<cybox.core.observable.Observable>` objects).
+    Transforms that need the full package content (see
+    REQUIRES_FULL_PACKAGE) are not cached.
+    """
+
+    @staticmethod
+    def _key(digest, transform_class):
+        return '{}:{}'.format(
+            digest,
+            transform_class._extraction_fingerprint(),
+        )
+
+    @staticmethod
+    def is_cacheable(transform_class):
+        return (transform_class is not None and
+                not transform_class.REQUIRES_FULL_PACKAGE)
+
+    def get_extracted(self, digest, transform_class):
+        """Returns a cached (package, observables) tuple (or None).
+
+        The returned package contains only the id, timestamp and header
+        of the original package.
+        """
+        entry = self.get(self._key(digest, transform_class))
+        if entry is None:
+            return None
+        package_dict, observables = entry
+        return STIXPackage.from_dict(package_dict), observables
+
+    def set_extracted(self, digest, transform_class, package, observables):
+        """Stores the observables extracted from a package."""
+        stub = package_stub(package)
+        stored = transform_class._detached_observables(observables)
+        self.set(self._key(digest, transform_class),
+                 (stub.to_dict(), stored))
+
+
+class UpgradeCache(DiskCache):
+    """A persistent cache of STIX documents updated using ramrod.
+
+    Entries are keyed by the digest of the original document and the
+    STIX version supported by python-stix, so each legacy document is
+    only updated once. Values are the updated documents (UTF-8 strings).
+    """
+
+    @staticmethod
+    def _key(digest):
+        return '{}:{}'.format(digest, stix.supported_stix_version())
+
+    def get_upgraded(self, digest):
+        """Returns the updated version of a document (or None)."""
+        return self.get(self._key(digest))
+
+    def peek_upgraded(self, digest):
+        """Returns the updated version of a document (or None), without
+        updating the entry's access time.
+        """
+        return self.peek(self._key(digest))
+
+    def touch_upgraded(self, digests):
+        """Updates the access time of the entries for several documents."""
+        self.touch(self._key(digest) for digest in digests)
+
+    def set_upgraded(self, digest, document):
+        """Stores the updated version of a document."""
+        self.set(self._key(digest), document)
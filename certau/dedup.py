@@ -0,0 +1,203 @@
+"""Detection of STIX packages that have already been processed."""
+
+import os
+import math
+import logging
+import hashlib
+import collections
+import cPickle as pickle
+
+import dateutil.parser
+
+
+class RotatingBloomFilter(object):
+    """A memory-bounded set of strings with a small false positive rate.
+
+    Items are added to the newest of a number of Bloom filters
+    ('generations'). Once the newest filter holds capacity items a new
+    filter is started and the oldest filter is dropped, so the memory used
+    is fixed and items are eventually forgotten. At least
+    ``capacity * (generations - 1)`` of the most recently added items are
+    always remembered.
+
+    Args:
+        capacity: the number of items added to each generation
+        error_rate: the false positive rate of each generation
+        generations: the number of generations kept
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001, generations=2):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Optimal number of bits and hash functions for a Bloom filter
+        self._bits = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        ))
+        self._hashes = max(1, int(round(
+            self._bits * math.log(2) / capacity
+        )))
+        self._filters = collections.deque(maxlen=generations)
+        self._count = 0
+        self._rotate()
+
+    def _rotate(self):
+        self._filters.append(bytearray((self._bits + 7) // 8))
+        self._count = 0
+
+    def _positions(self, item):
+        """Returns the bit positions for an item (using double hashing)."""
+        digest = hashlib.sha256(item).digest()
+        h1 = int(digest[:8].encode('hex'), 16)
+        h2 = int(digest[8:16].encode('hex'), 16) | 1
+        return [(h1 + i * h2) % self._bits for i in range(self._hashes)]
+
+    def __contains__(self, item):
+        positions = self._positions(item)
+        for bloom in self._filters:
+            if all(bloom[p >> 3] & (1 << (p & 7)) for p in positions):
+                return True
+        return False
+
+    def add(self, item):
+        """Adds an item to the newest generation."""
+        if self._count >= self.capacity:
+            self._rotate()
+        bloom = self._filters[-1]
+        for p in self._positions(item):
+            bloom[p >> 3] |= 1 << (p & 7)
+        self._count += 1
+
+
+class PackageDeduplicator(object):
+    """Remembers the STIX packages that have been processed.
+
+    Packages are identified by their id and timestamp, so an updated
+    version of a package (with a new timestamp) is not a duplicate.
+    Recently seen packages are found in an exact set (the recent window),
+    while older packages are remembered by a
+    :py:class:`RotatingBloomFilter`. Memory use (and the size of the state
+    file) is therefore bounded, at the cost of a small chance (the Bloom
+    filter's false positive rate) of a new package being mistaken for one
+    seen before.
+
+    Args:
+        state_file: an optional file used to save the state between runs
+            (loaded if it exists, written by :py:func:`save`)
+        capacity: the number of packages in each Bloom filter generation
+        error_rate: the false positive rate of each Bloom filter generation
+        window: the number of recently seen packages held exactly
+
+    Attributes:
+        duplicates: the number of duplicate packages found
+    """
+
+    STATE_VERSION = 1
+
+    def __init__(self, state_file=None, capacity=1000000, error_rate=0.001,
+                 window=10000):
+        self._logger = logging.getLogger()
+        self._state_file = state_file
+        self._bloom = RotatingBloomFilter(capacity, error_rate)
+        self._recent = collections.OrderedDict()
+        self._window = window
+        self.duplicates = 0
+        if state_file:
+            self._load_state()
+
+    @staticmethod
+    def _key(id_, timestamp):
+        """Returns the key identifying a package (or None)."""
+        if not id_:
+            return None
+        if isinstance(timestamp, basestring):
+            # As parsed by python-stix, so both forms give the same key
+            try:
+                timestamp = dateutil.parser.parse(timestamp)
+            except (ValueError, OverflowError):
+                pass
+        if hasattr(timestamp, 'isoformat'):
+            timestamp = timestamp.isoformat()
+        return u'{}|{}'.format(id_, timestamp or '').encode('utf-8')
+
+    def _load_state(self):
+        try:
+            with open(self._state_file, 'rb') as state_f:
+                state = pickle.load(state_f)
+        except IOError:
+            return
+        except Exception:
+            self._logger.warning(
+                "ignoring invalid state file '{}'".format(self._state_file)
+            )
+            return
+        bloom = state['bloom']
+        if (state.get('version') != self.STATE_VERSION or
+                bloom.capacity != self._bloom.capacity or
+                bloom.error_rate != self._bloom.error_rate):
+            self._logger.warning(
+                "ignoring state file '{}' - settings have changed".format(
+                    self._state_file)
+            )
+            return
+        self._bloom = bloom
+        for key in state['recent'][-self._window:]:
+            self._recent[key] = None
+
+    def save(self):
+        """Save the state (if using a state file)."""
+        if not self._state_file:
+            return
+        state = dict(
+            version=self.STATE_VERSION,
+            bloom=self._bloom,
+            recent=list(self._recent),
+        )
+        temp_file = self._state_file + '.tmp'
+        with open(temp_file, 'wb') as state_f:
+            pickle.dump(state, state_f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_file, self._state_file)
+
+    def _add(self, key):
+        self._bloom.add(key)
+        self._recent[key] = None
+        if len(self._recent) > self._window:
+            self._recent.popitem(last=False)
+
+    def seen(self, key, record=True):
+        """Returns True if key has been seen before, then records it
+        (unless record is False).
+        """
+        if key in self._recent:
+            return True
+        elif key in self._bloom:
+            return True
+        if record:
+            self._add(key)
+        return False
+
+    def is_duplicate_id(self, id_, timestamp, record=True):
+        """Returns True if the package with the given id and timestamp
+        has already been processed.
+
+        Packages without an id are never treated as duplicates. Unless
+        record is False, the package is then recorded as processed (see
+        :py:func:`record_id`).
+        """
+        key = self._key(id_, timestamp)
+        if key is not None and self.seen(key, record):
+            self.duplicates += 1
+            self._logger.debug("skipping duplicate package %s", key)
+            return True
+        return False
+
+    def record_id(self, id_, timestamp):
+        """Records the package with the given id and timestamp as
+        processed.
+        """
+        key = self._key(id_, timestamp)
+        if key is not None:
+            self.seen(key)
+
+    def is_duplicate(self, package):
+        """Returns True if the package has already been processed."""
+        return self.is_duplicate_id(package.id_, package.timestamp)
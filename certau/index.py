@@ -0,0 +1,158 @@
+"""Resolution of observables referenced (using idref) across packages."""
+
+import logging
+
+from certau.cache import DiskCache
+from certau.transform.base import ExtractedObservable
+
+
+class ObservableIndex(object):
+    """An index of the observables extracted from STIX packages, keyed by ID.
+
+    Indicators often refer to observables defined elsewhere (at the root of
+    the package or in a separate package) using an idref. The observables
+    extracted from a package (see
+    :py:func:`StixTransform._observables_for_package
+    <certau.transform.StixTransform._observables_for_package>`) record
+    these references, and the index holds the observables extracted from
+    the packages processed so far, so each reference can be resolved with
+    a single lookup.
+
+    Entries are keyed by the observable ID and a fingerprint of the
+    transform class (see :py:func:`StixTransform._extraction_fingerprint
+    <certau.transform.StixTransform._extraction_fingerprint>`), and hold
+    the observable's object type and extracted fields. By default the
+    index is held in memory for the current run. If a file is given the
+    entries are stored in an SQLite database instead (see
+    :py:class:`certau.cache.DiskCache`), so observables extracted in
+    previous runs can also be resolved.
+
+    The in-memory index has no size limit: it holds an entry for every
+    observable processed, so use a file for very large inputs. In a file,
+    lookups don't update the entries' access times, so when the index is
+    full the entries evicted are those least recently added (observables
+    are added again each time they are processed).
+
+    Args:
+        path: the name of the database file (optional - created if
+            required)
+        max_size: the maximum total size (in bytes) of the database entries
+
+    Attributes:
+        resolved: the number of references resolved
+    """
+
+    def __init__(self, path=None, max_size=512 * 1024 * 1024):
+        self._logger = logging.getLogger()
+        self._memory = dict()
+        self._disk = DiskCache(path, max_size) if path else None
+        self._fingerprints = dict()
+        self.resolved = 0
+
+    def _fingerprint(self, transform_class):
+        fingerprint = self._fingerprints.get(transform_class)
+        if fingerprint is None:
+            fingerprint = transform_class._extraction_fingerprint()
+            self._fingerprints[transform_class] = fingerprint
+        return fingerprint
+
+    def add_observables(self, transform_class, observables):
+        """Adds the observables extracted from a package to the index.
+
+        Args:
+            transform_class: the :py:class:`StixTransform` subclass used
+                to extract the observables
+            observables: the extracted observables, keyed by object type
+        """
+        fingerprint = self._fingerprint(transform_class)
+        entries = [
+            (observable.id, (object_type, observable.fields))
+            for object_type, object_observables in observables.items()
+            for observable in object_observables
+        ]
+        if self._disk is not None:
+            self._disk.set_many(
+                (u'{}:{}'.format(fingerprint, id_), entry)
+                for id_, entry in entries
+            )
+        else:
+            self._memory.update(
+                ((fingerprint, id_), entry) for id_, entry in entries
+            )
+
+    def get(self, transform_class, id_):
+        """Returns the (object type, fields) of an indexed observable.
+
+        Returns None if the observable isn't in the index.
+        """
+        fingerprint = self._fingerprint(transform_class)
+        if self._disk is not None:
+            return self._disk.peek(u'{}:{}'.format(fingerprint, id_))
+        return self._memory.get((fingerprint, id_))
+
+    def resolve_references(self, transform_class, observables,
+                           object_types=None):
+        """Adds the observables referenced by a package from the index.
+
+        References to observables found in the package itself (or not
+        found in the index) are skipped. Resolved observables are appended
+        to the lists in observables, in the order they were referenced, as
+        :py:class:`ExtractedObservable
+        <certau.transform.base.ExtractedObservable>` objects without the
+        :py:class:`Observable<cybox.core.observable.Observable>` object.
+
+        Args:
+            transform_class: the :py:class:`StixTransform` subclass used
+                to extract the observables
+            observables: the observables extracted from the package (a
+                :py:class:`PackageObservables
+                <certau.transform.base.PackageObservables>` object)
+            object_types: a list of the object types to be resolved
+                (optional)
+
+        Returns:
+            int: the number of references resolved
+        """
+        references = getattr(observables, 'references', None)
+        if not references:
+            return 0
+        found = set(observable.id
+                    for object_observables in observables.values()
+                    for observable in object_observables)
+        resolved = 0
+        for idref in references:
+            if idref in found:
+                continue
+            entry = self.get(transform_class, idref)
+            if entry is None:
+                continue
+            object_type, fields = entry
+            if object_types and object_type not in object_types:
+                continue
+            if object_type not in observables:
+                observables[object_type] = []
+            observables[object_type].append(
+                ExtractedObservable(idref, None, fields),
+            )
+            found.add(idref)
+            resolved += 1
+        if resolved:
+            self._logger.debug("resolved %d referenced observables",
+                               resolved)
+        self.resolved += resolved
+        return resolved
+
+    def update(self, transform_class, observables, object_types=None):
+        """Indexes the observables extracted from a package, then resolves
+        the package's references (see :py:func:`resolve_references`).
+
+        Returns:
+            int: the number of references resolved
+        """
+        self.add_observables(transform_class, observables)
+        return self.resolve_references(transform_class, observables,
+                                       object_types)
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
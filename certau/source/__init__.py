@@ -6,3 +6,6 @@ These classes should implement the ``next_stix_package()`` method.
 from .base import StixSource
 from .taxii import SimpleTaxiiClient
 from .files import StixFileSource
+from .stream import StixStreamSource
+from .multi import StixMultiSource
+from .writer import ContentBlockWriter
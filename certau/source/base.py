@@ -1,27 +1,258 @@
+import io
+import logging
+
 import ramrod
-from stix.core import STIXPackage
-from stix.utils.parser import UnsupportedVersionError
+import stix
+from lxml import etree
+from ramrod.stix import STIX_UPDATERS, STIX_VERSIONS
+from stix.bindings import stix_core as stix_core_binding
+from stix.core import STIXPackage, STIXHeader
+from stix.utils.parser import UnsupportedVersionError, get_etree_root
+
+from certau.cache import content_digest
+from certau.transform.xpath import UnsupportedDocumentError
+
+
+_STIX_HEADER = etree.XPath('*[local-name()="STIX_Header"]')
+
+
+def read_stix_document(stix_file):
+    """Returns the content of a STIX document as a string.
+
+    Elements are serialized as libtaxii serializes XML content blocks, so
+    a document polled with or without streaming has the same content.
+
+    Args:
+        stix_file: a file name, file object or lxml element
+    """
+    if isinstance(stix_file, basestring):
+        with open(stix_file, 'rb') as file_:
+            return file_.read()
+    elif hasattr(stix_file, 'read'):
+        if hasattr(stix_file, 'seek'):
+            stix_file.seek(0)
+        return stix_file.read()
+    else:
+        return etree.tostring(stix_file, encoding='utf-8')
+
+
+def upgrade_stix_tree(root):
+    """Update a parsed STIX document to the version supported by python-stix.
+
+    The document is updated in place, rather than being copied at each
+    step as it is by :py:func:`ramrod.update`.
+
+    Args:
+        root: the root (STIX_Package) element of the document
+
+    Returns:
+        the root element of the updated document
+    """
+    from_ = root.get('version')
+    to_ = stix.supported_stix_version()
+    if (from_ not in STIX_VERSIONS or
+            STIX_VERSIONS.index(from_) > STIX_VERSIONS.index(to_)):
+        raise UnsupportedVersionError(
+            'unable to update STIX version {}'.format(from_),
+            expected=to_,
+            found=from_,
+        )
+    options = ramrod.DEFAULT_UPDATE_OPTIONS
+    for version in STIX_VERSIONS[STIX_VERSIONS.index(from_):
+                                 STIX_VERSIONS.index(to_)]:
+        updater = STIX_UPDATERS[version]()
+        updater.check_update(root, options)
+        # _update() updates in place, unlike update() (which copies the
+        # document first) - stix-ramrod is pinned in setup.py for this
+        root = updater._update(root, options)
+    return root
+
+
+def upgrade_stix_document(content):
+    """Update a STIX document to the version supported by python-stix.
+
+    Returns:
+        the updated document (a UTF-8 string), or None if the document is
+        already the supported version
+    """
+    root = get_etree_root(io.BytesIO(content))
+    if root.get('version') == stix.supported_stix_version():
+        return None
+    return etree.tostring(upgrade_stix_tree(root),
+                          encoding='UTF-8', xml_declaration=True)
 
 
 class StixSource(object):
     """A base class for sources of STIX packages."""
 
+    #: An optional :py:class:`certau.cache.UpgradeCache` used when loading
+    #: packages with an older STIX version
+    _upgrade_cache = None
+
+    #: Whether observables are read directly from the XML where possible
+    #: (see :py:func:`load_extracted_package`)
+    _xpath_extract = False
+
+    def _upgraded_root(self, root, content=None):
+        """Returns the root element of an updated STIX document.
+
+        The upgrade cache (if any) is checked using the digest of content
+        (the original document, as read by :py:func:`read_stix_document`)
+        before the document is updated.
+        """
+        if self._upgrade_cache is None:
+            return upgrade_stix_tree(root)
+
+        if content is None:
+            content = read_stix_document(root)
+        digest = content_digest(content)
+        document = self._upgrade_cache.get_upgraded(digest)
+        if document is not None:
+            return get_etree_root(io.BytesIO(document))
+        root = upgrade_stix_tree(root)
+        self._upgrade_cache.set_upgraded(
+            digest,
+            etree.tostring(root, encoding='UTF-8', xml_declaration=True),
+        )
+        return root
+
+    def _load_stix_root(self, stix_file):
+        """Parse a STIX document, updating it if required.
+
+        The document is parsed once. If the version attribute of the root
+        element shows that the document needs updating, the parsed tree is
+        updated in place (or replaced by a cached copy of the updated
+        document).
+
+        Returns:
+            the root (STIX_Package) element of the document
+        """
+        content = None
+        if self._upgrade_cache is not None and \
+                not etree.iselement(stix_file):
+            # Keep the content for calculating the digest
+            content = read_stix_document(stix_file)
+            stix_file = io.BytesIO(content)
+        root = get_etree_root(stix_file)
+        if root.get('version') != stix.supported_stix_version():
+            root = self._upgraded_root(root, content)
+        return root
+
+    @staticmethod
+    def _header_for_element(element):
+        obj = stix_core_binding.STIXHeaderType.factory()
+        obj.build(element)
+        return STIXHeader.from_obj(obj)
+
+    @staticmethod
+    def _log_load_error(e):
+        logging.getLogger().warning(
+            "unable to load STIX package - {}: {}".format(
+                e.__class__.__name__, e)
+        )
+
     def load_stix_package(self, stix_file):
-        """Helper for loading and updating (if required) a STIX package."""
+        """Helper for loading and updating (if required) a STIX package.
+
+        The document is parsed once. If the version attribute of the root
+        element shows that the document needs updating, the parsed tree is
+        updated in place (or replaced by a cached copy of the updated
+        document) before being passed to python-stix.
+
+        Args:
+            stix_file: a file name, file object or lxml element
+
+        Returns:
+            the :py:class:`STIXPackage`, or None (with the reason logged)
+            if the package could not be loaded
+        """
         try:
-            package = STIXPackage.from_xml(stix_file)
-        except UnsupportedVersionError:
-            updated = ramrod.update(stix_file, to_='1.1.1')
-            document = updated.document.as_stringio()
-            try:
-                package = STIXPackage.from_xml(document)
-            except Exception:
-                package = None
-        except Exception:
-            package = None
+            return STIXPackage.from_xml(self._load_stix_root(stix_file))
+        except Exception as e:
+            self._log_load_error(e)
+            return None
+
+    def load_extracted_package(self, stix_file, transform_class):
+        """Helper for loading a STIX package and extracting its observables.
+
+        When the source reads observables directly from the XML and the
+        transform class (or :py:class:`StixTransformGroup
+        <certau.transform.StixTransformGroup>`) doesn't require the full
+        package, the observables are extracted from the parsed document
+        (see :py:func:`StixTransform._observables_for_tree
+        <certau.transform.StixTransform._observables_for_tree>`) and the
+        package returned contains only the id, timestamp and header of the
+        original package. Documents that can't be read this way are loaded
+        with python-stix.
 
-        return package
+        Args:
+            stix_file: a file name, file object or lxml element
+            transform_class: the :py:class:`StixTransform` subclass whose
+                fields should be extracted (or None to skip extraction)
+
+        Returns:
+            tuple: a (package, observables) tuple (see
+                :py:func:`next_extracted_package`). The package is None
+                (with the reason logged) if it could not be loaded.
+        """
+        if (not self._xpath_extract or transform_class is None or
+                transform_class.REQUIRES_FULL_PACKAGE):
+            package = self.load_stix_package(stix_file)
+            if package is None or transform_class is None:
+                return package, None
+            return package, transform_class._observables_for_package(package)
+
+        try:
+            root = self._load_stix_root(stix_file)
+            try:
+                observables = transform_class._observables_for_tree(root)
+            except UnsupportedDocumentError:
+                package = STIXPackage.from_xml(root)
+                return (package,
+                        transform_class._observables_for_package(package))
+            headers = _STIX_HEADER(root)
+            package = STIXPackage(
+                id_=root.get('id'),
+                timestamp=root.get('timestamp'),
+                stix_header=(self._header_for_element(headers[-1])
+                             if headers else None),
+            )
+            return package, observables
+        except Exception as e:
+            self._log_load_error(e)
+            return None, None
 
     def next_stix_package(self):
         """Return the next STIX package available from the source (or None)."""
         raise NotImplementedError
+
+    def open(self):
+        """Prepare the source before packages are requested."""
+        pass
+
+    def close(self):
+        """Release resources (processes, connections) held by the source."""
+        pass
+
+    def next_extracted_package(self, transform_class):
+        """Return the next STIX package along with its extracted observables.
+
+        Sources that can extract observables more efficiently (for example
+        in parallel) may override this method.
+
+        Args:
+            transform_class: the :py:class:`StixTransform` subclass whose
+                fields should be extracted (or None to skip extraction)
+
+        Returns:
+            tuple: a (package, observables) tuple, where observables is the
+                result of ``transform_class._observables_for_package()``.
+                Returns (None, None) when the source is exhausted.
+        """
+        package = self.next_stix_package()
+        if package is None:
+            return None, None
+        elif transform_class is None:
+            return package, None
+        else:
+            return package, transform_class._observables_for_package(package)
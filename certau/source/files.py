@@ -1,7 +1,125 @@
+import io
 import os
+import bz2
+import gzip
+import zlib
+import json
 import logging
+import tarfile
+import zipfile
+import collections
+import multiprocessing
 
-from .base import StixSource
+from certau.cache import (file_digest, content_digest, package_stub,
+                          UpgradeCache)
+
+from .base import StixSource, read_stix_document, upgrade_stix_document
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tbz')
+
+# Errors raised when reading damaged files, compressed files or archives
+READ_ERRORS = (IOError, EOFError, zlib.error, tarfile.TarError,
+               zipfile.BadZipfile)
+
+
+# The source used to load packages in a worker process
+_worker_source = None
+
+
+class _WorkerUpgradeCache(object):
+    """The upgrade cache, as used by a worker process.
+
+    Documents are read from the cache file (without updating their access
+    times). The digests of the documents found, and the documents updated
+    by the worker, are kept in pending as (digest, document) tuples, with
+    a document of None for those found. They are returned to the parent
+    process, which updates the access times and stores the documents.
+    Only the parent writes to the cache, so the cache's size limit is
+    enforced using the total size of the entries.
+    """
+
+    def __init__(self, path):
+        self._cache = UpgradeCache(path, reader=True)
+        self.pending = []
+
+    def get_upgraded(self, digest):
+        document = self._cache.peek_upgraded(digest)
+        if document is not None:
+            self.pending.append((digest, None))
+        return document
+
+    def set_upgraded(self, digest, document):
+        self.pending.append((digest, document))
+
+
+def _init_worker(upgrade_cache_path, xpath_extract=False):
+    """Worker process initialiser (opens the upgrade cache, if any)."""
+    global _worker_source
+    _worker_source = StixSource()
+    _worker_source._xpath_extract = xpath_extract
+    if upgrade_cache_path is not None:
+        _worker_source._upgrade_cache = _WorkerUpgradeCache(
+            upgrade_cache_path,
+        )
+
+
+def _load_and_extract(file_, transform_class, content=None, source=None):
+    """Loads a package and extracts its observables (in this process or
+    a worker process).
+
+    The package is loaded from content (if given) rather than from file_.
+    """
+    if content is not None:
+        file_ = io.BytesIO(content)
+    source = source or _worker_source or StixSource()
+    return source.load_extracted_package(file_, transform_class)
+
+
+def _load_and_extract_worker(file_, transform_class, content=None):
+    """Worker function for loading (and extracting) packages in parallel.
+
+    Unless the transform requires the full package, only the package's id,
+    timestamp and header are returned along with the observables (as for
+    cached packages), to save pickling the whole package.
+
+    Returns:
+        tuple: the (package, observables) tuple and a list of the (digest,
+            updated document) tuples for the upgrade cache (see
+            :py:class:`_WorkerUpgradeCache`)
+    """
+    loaded = _load_and_extract(file_, transform_class, content)
+    package, observables = loaded
+    if (package and transform_class is not None and
+            not transform_class.REQUIRES_FULL_PACKAGE):
+        loaded = package_stub(package), observables
+    upgrade_cache = _worker_source._upgrade_cache
+    if upgrade_cache is None:
+        return loaded, []
+    upgraded = upgrade_cache.pending
+    upgrade_cache.pending = []
+    return loaded, upgraded
+
+
+def _upgrade(content):
+    """Worker function for updating documents in parallel.
+
+    Returns:
+        tuple: the updated document (None if no update is required) and
+            the reason the update failed (None if successful)
+    """
+    try:
+        return upgrade_stix_document(content), None
+    except Exception as e:
+        return None, str(e) or e.__class__.__name__
 
 
 class StixFileSource(StixSource):
@@ -12,37 +130,412 @@ class StixFileSource(StixSource):
             directories
         recurse: an optional boolean value (default False), which when set
             to True, will cause subdirectories to be searched recursively
+        workers: an optional number of worker processes used to load
+            packages (and extract observables) in parallel. Packages are
+            still returned in file order. Set to None (default) or 1 to
+            load packages in the current process.
+        max_pending: the maximum number of files being loaded by the
+            workers at any one time (default is twice the number of
+            workers)
+        cache: an optional :py:class:`certau.cache.ObservableCache` used
+            to store extracted observables by file content, so unchanged
+            files are not parsed again
+        state_file: an optional file used to record the files that have
+            been processed. When given, files whose inode, size and
+            modification time are unchanged since they were recorded are
+            skipped. A file is only recorded once all its packages have
+            been loaded and returned. The state is saved once all files
+            have been returned (or when :py:func:`save_state` is called),
+            without the files that no longer exist.
+        upgrade_cache: an optional :py:class:`certau.cache.UpgradeCache`
+            used to store documents updated from an older STIX version,
+            so each document is only updated once (see
+            :py:func:`pre_upgrade`)
+        xpath_extract: an optional boolean value (default False), which
+            when set to True, causes observables to be read directly from
+            the XML of each file where possible rather than loading the
+            whole package with python-stix (see
+            :py:func:`StixSource.load_extracted_package`)
+
+    Files compressed with gzip (.gz) or bzip2 (.bz2) are decompressed as
+    they are read, and each file contained in a zip (.zip) or tar (.tar,
+    .tar.gz, .tgz, .tar.bz2, .tbz2) archive is read as a separate package,
+    without being written to disk. Archives are treated as a single file
+    when using a state file.
     """
 
-    def __init__(self, files, recurse=False):
+    def __init__(self, files, recurse=False, workers=None, max_pending=None,
+                 cache=None, state_file=None, upgrade_cache=None,
+                 xpath_extract=False):
         self._logger = logging.getLogger()
-        self._files = []
+        self._files = self._walk_files(files, recurse)
+        self._items = self._walk_items()
+        self._workers = workers if workers and workers > 1 else None
+        self._max_pending = max_pending or 2 * (self._workers or 1)
+        self._pool = None
+        self._pending = collections.deque()
+        self._transform_class = None
+        self._cache = cache
+        self._state_file = state_file
+        self._state = self._load_state() if state_file else None
+        self._signatures = dict()
+        self._last_file = None
+        self._upgrade_cache = upgrade_cache
+        self._xpath_extract = xpath_extract
+
+    @staticmethod
+    def _dir_entries(directory):
+        """Return (path, is_dir, is_file) for a directory, sorted by name."""
+        if scandir is not None:
+            entries = sorted(scandir(directory), key=lambda e: e.name)
+            return [(e.path, e.is_dir(), e.is_file()) for e in entries]
+        else:
+            paths = [os.path.join(directory, name)
+                     for name in sorted(os.listdir(directory))]
+            return [(p, os.path.isdir(p), os.path.isfile(p)) for p in paths]
+
+    def _walk_dir(self, directory, recurse):
+        for path, is_dir, is_file in self._dir_entries(directory):
+            if is_dir and recurse:
+                for file_ in self._walk_dir(path, recurse):
+                    yield file_
+            elif is_file:
+                yield path
+
+    def _walk_files(self, files, recurse):
+        """Generate file names lazily, in sorted order within directories."""
         for file_ in files:
-            self._add_file(file_, recurse)
-        self._index = 0
-
-    def _add_file(self, file_, recurse):
-        if os.path.isdir(file_):
-            for dir_file in sorted(os.listdir(file_)):
-                path = os.path.join(file_, dir_file)
-                if os.path.isdir(path) and recurse:
-                    self._add_file(path, recurse)
-                elif os.path.isfile(path):
-                    self._files.append(path)
-        elif os.path.isfile(file_):
-            self._files.append(file_)
+            if os.path.isdir(file_):
+                for path in self._walk_dir(file_, recurse):
+                    yield path
+            elif os.path.isfile(file_):
+                yield file_
 
-    def next_stix_package(self):
-        package = None
-        while self._index < len(self._files):
-            file_ = self._files[self._index]
-            self._index += 1
-            package = self.load_stix_package(file_)
-            if package:
+    @staticmethod
+    def _open_packages(file_):
+        """Generate (name, file object) for each package in a file.
+
+        The file object is None for plain files, which should be read
+        using the file name. Each file object must be read before moving
+        on to the next package.
+        """
+        lower = file_.lower()
+        if lower.endswith(TAR_EXTENSIONS):
+            # Read the archive as a stream (members in archive order)
+            with tarfile.open(file_, 'r|*') as tar_file:
+                for member in tar_file:
+                    if member.isfile():
+                        yield (os.path.join(file_, member.name),
+                               tar_file.extractfile(member))
+        elif lower.endswith('.zip'):
+            with zipfile.ZipFile(file_) as zip_file:
+                for info in zip_file.infolist():
+                    if not info.filename.endswith('/'):
+                        yield (os.path.join(file_, info.filename),
+                               zip_file.open(info))
+        elif lower.endswith('.gz'):
+            with gzip.open(file_, 'rb') as gz_file:
+                yield file_, gz_file
+        elif lower.endswith('.bz2'):
+            with bz2.BZ2File(file_) as bz2_file:
+                yield file_, bz2_file
+        else:
+            yield file_, None
+
+    def _walk_items(self):
+        """Generate (file, name, content) for each package to be processed.
+
+        File is the file (or archive) the package is read from. Content is
+        None for plain files (see :py:func:`_open_packages`).
+        Each member of an archive (or compressed file) is read into memory
+        in full, so it can be hashed for the cache and passed to a worker
+        process.
+        """
+        while True:
+            file_ = self._next_file()
+            if file_ is None:
+                return
+            try:
+                for name, file_obj in self._open_packages(file_):
+                    if file_obj is None:
+                        yield file_, name, None
+                    else:
+                        yield file_, name, file_obj.read()
+            except READ_ERRORS:
+                self._signatures.pop(file_, None)
+                self._logger.info(
+                    "skipping file '{}' - unable to read".format(file_)
+                )
+
+    def _load_state(self):
+        """Load the (inode, size, mtime) of previously processed files."""
+        try:
+            with open(self._state_file, 'rb') as state_f:
+                return json.load(state_f)
+        except IOError:
+            return dict()
+        except ValueError:
+            self._logger.warning(
+                "ignoring invalid state file '{}'".format(self._state_file)
+            )
+            return dict()
+
+    def save_state(self):
+        """Save the state of the processed files (if using a state file)."""
+        if self._state is None:
+            return
+        for file_ in [f for f in self._state if not os.path.exists(f)]:
+            del self._state[file_]
+        temp_file = self._state_file + '.tmp'
+        with open(temp_file, 'wb') as state_f:
+            json.dump(self._state, state_f)
+        os.rename(temp_file, self._state_file)
+
+    @staticmethod
+    def _file_signature(file_):
+        stat = os.stat(file_)
+        return [stat.st_ino, stat.st_size, stat.st_mtime]
+
+    def _next_file(self):
+        """Return the next file to be processed (or None).
+
+        When using a state file, unchanged files are skipped. The file's
+        signature is kept until the file is recorded (see
+        :py:func:`_record_file`).
+        """
+        for file_ in self._files:
+            if self._state is not None:
+                try:
+                    signature = self._file_signature(file_)
+                except OSError:
+                    continue
+                if self._state.get(file_) == signature:
+                    self._logger.debug(
+                        "skipping file '{}' - unchanged".format(file_)
+                    )
+                    continue
+                self._signatures[file_] = signature
+            return file_
+        return None
+
+    def _record_file(self, file_):
+        """Record a file as processed (if using a state file).
+
+        Files whose signature has been discarded, because one of their
+        packages failed to load, are not recorded.
+        """
+        signature = self._signatures.pop(file_, None)
+        if signature is not None:
+            self._state[file_] = signature
+
+    def _returned_from(self, file_):
+        """Note the file the package being returned was read from.
+
+        Packages are returned in file order, so the previous file is
+        recorded once a package from another file (or None, at the end)
+        is returned.
+        """
+        if file_ != self._last_file:
+            self._record_file(self._last_file)
+            self._last_file = file_
+
+    def _cached(self, file_, content, transform_class):
+        """Look up the cache for a file (or the content read from it).
+
+        Returns:
+            tuple: the file's digest (None if the file can't be cached) and
+                the cached (package, observables) tuple (None if not found)
+        """
+        if (self._cache is None or
+                not self._cache.is_cacheable(transform_class)):
+            return None, None
+        if content is not None:
+            digest = content_digest(content)
+        else:
+            try:
+                digest = file_digest(file_)
+            except (IOError, OSError):
+                return None, None
+        return digest, self._cache.get_extracted(digest, transform_class)
+
+    def _store(self, digest, transform_class, loaded):
+        """Add a loaded (package, observables) tuple to the cache."""
+        package, observables = loaded
+        if digest is not None and package:
+            self._cache.set_extracted(digest, transform_class,
+                                      package, observables)
+
+    def _create_pool(self):
+        upgrade_cache_path = None
+        if self._upgrade_cache is not None:
+            upgrade_cache_path = self._upgrade_cache.path
+        return multiprocessing.Pool(
+            self._workers,
+            initializer=_init_worker,
+            initargs=(upgrade_cache_path, self._xpath_extract),
+        )
+
+    def _next_pending(self, transform_class):
+        """Return the next (file, name, result) from the worker pool (or
+        None).
+
+        Keeps up to max_pending files queued with the workers. Results are
+        returned in the order the files were submitted.
+        """
+        if self._transform_class is None:
+            self._transform_class = transform_class
+        elif transform_class is not self._transform_class:
+            raise ValueError('transform class cannot change between calls')
+
+        while len(self._pending) < self._max_pending:
+            file_, name, content = next(self._items, (None, None, None))
+            if file_ is None:
                 break
+            digest, cached = self._cached(name, content, transform_class)
+            if cached is not None:
+                self._pending.append((file_, name, digest, cached, None))
+                continue
+            if self._pool is None:
+                self._pool = self._create_pool()
+            result = self._pool.apply_async(
+                _load_and_extract_worker,
+                (name, transform_class, content),
+            )
+            self._pending.append((file_, name, digest, None, result))
+
+        if not self._pending:
+            self.close()
+            return None
+
+        file_, name, digest, loaded, result = self._pending.popleft()
+        if loaded is None:
+            loaded, upgraded = result.get()
+            if upgraded:
+                self._upgrade_cache.touch_upgraded(
+                    upgraded_digest for upgraded_digest, document in upgraded
+                    if document is None
+                )
+            for upgraded_digest, document in upgraded:
+                if document is not None:
+                    self._upgrade_cache.set_upgraded(upgraded_digest,
+                                                     document)
+            self._store(digest, transform_class, loaded)
+        return file_, name, loaded
+
+    def close(self):
+        """Shut down any worker processes."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._pending.clear()
+
+    def next_extracted_package(self, transform_class):
+        """Return the next STIX package along with its extracted observables.
+
+        When a cache is in use and the file's content has been seen before
+        with the same transform class, the cached observables are returned
+        along with a package containing only the id, timestamp and header
+        of the original package. Packages loaded by worker processes are
+        returned the same way, unless the transform class requires the
+        full package.
+        """
+        while True:
+            if self._workers:
+                pending = self._next_pending(transform_class)
+                if pending is None:
+                    self._returned_from(None)
+                    self.save_state()
+                    return None, None
+                file_, name, (package, observables) = pending
+            else:
+                file_, name, content = next(self._items, (None, None, None))
+                if file_ is None:
+                    self._returned_from(None)
+                    self.save_state()
+                    return None, None
+                digest, loaded = self._cached(name, content,
+                                              transform_class)
+                if loaded is None:
+                    loaded = _load_and_extract(name, transform_class,
+                                               content, self)
+                    self._store(digest, transform_class, loaded)
+                package, observables = loaded
+
+            self._returned_from(file_)
+            if package:
+                return package, observables
             else:
+                # Don't record a file that failed to load
+                self._signatures.pop(file_, None)
                 self._logger.info(
-                    "skipping file '{}' - invalid XML/STIX".format(file_)
+                    "skipping file '{}' - invalid XML/STIX".format(name)
                 )
 
+    def next_stix_package(self):
+        package, _ = self.next_extracted_package(None)
         return package
+
+    def pre_upgrade(self):
+        """Update documents with an older STIX version ahead of time.
+
+        Each document that requires an update (and is not already in the
+        upgrade cache) is updated using ramrod and added to the cache.
+        Documents are updated in parallel when using worker processes.
+
+        Returns:
+            dict: the number of documents that were 'current' (didn't
+                need updating), already 'cached', 'upgraded' or 'failed'
+        """
+        if self._upgrade_cache is None:
+            raise ValueError('an upgrade cache is required')
+        counts = dict(current=0, cached=0, upgraded=0, failed=0)
+        pool = self._create_pool() if self._workers else None
+        pending = collections.deque()
+
+        def _finish(file_, name, digest, result):
+            document, reason = result
+            if reason is not None:
+                self._signatures.pop(file_, None)
+                self._logger.warning(
+                    "unable to update '{}' - {}".format(name, reason)
+                )
+                counts['failed'] += 1
+            elif document is None:
+                counts['current'] += 1
+            else:
+                self._upgrade_cache.set_upgraded(digest, document)
+                counts['upgraded'] += 1
+
+        try:
+            for file_, name, content in self._items:
+                if content is None:
+                    try:
+                        content = read_stix_document(name)
+                    except (IOError, OSError):
+                        self._signatures.pop(file_, None)
+                        counts['failed'] += 1
+                        continue
+                digest = content_digest(content)
+                if self._upgrade_cache.get_upgraded(digest) is not None:
+                    counts['cached'] += 1
+                elif pool is None:
+                    _finish(file_, name, digest, _upgrade(content))
+                else:
+                    result = pool.apply_async(_upgrade, (content,))
+                    pending.append((file_, name, digest, result))
+                    while len(pending) > self._max_pending:
+                        file_, name, digest, result = pending.popleft()
+                        _finish(file_, name, digest, result.get())
+            while pending:
+                file_, name, digest, result = pending.popleft()
+                _finish(file_, name, digest, result.get())
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        # Record the files whose documents were all updated (or current)
+        for file_ in list(self._signatures):
+            self._record_file(file_)
+        self.save_state()
+        return counts
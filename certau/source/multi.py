@@ -0,0 +1,71 @@
+import logging
+import threading
+import Queue
+
+from .base import StixSource
+
+
+class StixMultiSource(StixSource):
+    """Return STIX packages from several sources at the same time.
+
+    Each source is read by one of a pool of worker threads, so a slow
+    source (e.g. a slow TAXII server) does not hold up the others.
+    Packages are returned in the order they become available. An error
+    reading from one source is logged and the remaining sources carry on.
+
+    Args:
+        sources: a list of :py:class:`StixSource` objects
+        threads: the maximum number of sources read at the same time
+        max_pending: the maximum number of packages read from the sources
+            but not yet returned by :py:func:`next_stix_package`
+    """
+
+    def __init__(self, sources, threads=4, max_pending=100):
+        self._logger = logging.getLogger()
+        self._sources = list(sources)
+        self._source_queue = Queue.Queue()
+        for source in self._sources:
+            self._source_queue.put(source)
+        self._packages = Queue.Queue(max_pending)
+        self._threads = []
+        for _ in range(min(threads, len(self._sources))):
+            thread = threading.Thread(target=self._read_sources)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._running = len(self._threads)
+
+    def _read_sources(self):
+        """Worker thread: read packages from sources until none are left."""
+        while True:
+            try:
+                source = self._source_queue.get_nowait()
+            except Queue.Empty:
+                break
+            try:
+                source.open()
+                while True:
+                    package = source.next_stix_package()
+                    if package is None:
+                        break
+                    self._packages.put(package)
+            except Exception:
+                self._logger.exception("error reading from source %r", source)
+        self._packages.put(None)
+
+    def next_stix_package(self):
+        while self._running:
+            try:
+                # A timeout allows the main thread to be interrupted
+                package = self._packages.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if package is None:
+                self._running -= 1
+            else:
+                return package
+        return None
+
+    def close(self):
+        for source in self._sources:
+            source.close()
@@ -0,0 +1,255 @@
+import io
+
+import stix
+from lxml import etree
+from cybox.bindings import GDSParseError as CyboxParseError
+from cybox.bindings import cybox_core as cybox_core_binding
+from cybox.core import Observable
+from cybox.utils.nsparser import UnknownObjectType
+from stix.bindings import GDSParseError as StixParseError
+from stix.bindings import stix_core as stix_core_binding
+from stix.core import STIXPackage
+from stix.core.stix_package import Indicators
+
+from .base import StixSource
+from .files import StixFileSource, READ_ERRORS
+
+
+STIX_NS = 'http://stix.mitre.org/stix-1'
+CYBOX_NS = 'http://cybox.mitre.org/cybox-2'
+
+TAG_STIX_PACKAGE = '{%s}STIX_Package' % STIX_NS
+TAG_STIX_HEADER = '{%s}STIX_Header' % STIX_NS
+TAG_OBSERVABLES = '{%s}Observables' % STIX_NS
+TAG_OBSERVABLE = '{%s}Observable' % CYBOX_NS
+TAG_INDICATORS = '{%s}Indicators' % STIX_NS
+TAG_INDICATOR = '{%s}Indicator' % STIX_NS
+
+# Errors raised when a file isn't valid XML or STIX
+PARSE_ERRORS = (etree.LxmlError, ValueError, CyboxParseError, StixParseError,
+                UnknownObjectType)
+
+
+class _ReplayableFile(object):
+    """Wraps a file object, keeping the data read until it is released.
+
+    Archive members are read as a stream and can't be rewound, so the
+    data read is kept until it is known whether the document needs to be
+    loaded in full.
+    """
+
+    def __init__(self, file_obj):
+        self._file_obj = file_obj
+        self._chunks = []
+
+    def read(self, size=-1):
+        data = self._file_obj.read(size)
+        if self._chunks is not None:
+            self._chunks.append(data)
+        return data
+
+    def release(self):
+        """Stop keeping the data read."""
+        self._chunks = None
+
+    def content(self):
+        """Returns the entire content of the file (including the data
+        already read).
+        """
+        return b''.join(self._chunks) + self._file_obj.read()
+
+
+class StixStreamSource(StixFileSource):
+    """Return STIX packages from large files without loading them in full.
+
+    Each file is read incrementally with :py:func:`lxml.etree.iterparse`.
+    Observables and indicators found in the root of the STIX package are
+    converted to python-stix objects one at a time and returned in batches,
+    with each batch wrapped in a STIX package that shares the id, timestamp
+    and header of the original package. The XML for each element is
+    discarded once it has been converted, so memory use is bounded by the
+    batch size rather than by the size of the file.
+
+    Compressed files and archives are read as described for
+    :py:class:`StixFileSource`, with each archive member streamed in turn.
+    Other top-level package elements (TTPs, campaigns, etc.) are skipped.
+    Note that transforms only remove duplicate observables within a batch.
+    Files containing a STIX version other than the one supported by
+    python-stix are loaded in full using
+    :py:func:`StixSource.load_stix_package` so they can be updated.
+
+    Args:
+        files: an array containing the names of one or more files or
+            directories
+        recurse: an optional boolean value (default False), which when set
+            to True, will cause subdirectories to be searched recursively
+        batch_size: the maximum number of observables and indicators
+            included in each returned package
+        upgrade_cache: an optional :py:class:`certau.cache.UpgradeCache`
+            used when loading files with an older STIX version
+        state_file: an optional file used to record the files that have
+            been processed, so unchanged files are skipped (see
+            :py:class:`StixFileSource`)
+        dedup: an optional :py:class:`certau.dedup.PackageDeduplicator`.
+            Files containing a package that has already been processed
+            are skipped as soon as the package id and timestamp are read.
+            (As each batch shares the package id and timestamp, batches
+            can't be checked after they have been returned.) A package is
+            only recorded as processed once its last batch has been
+            returned, so a file that can't be read in full isn't skipped
+            next time.
+    """
+
+    def __init__(self, files, recurse=False, batch_size=1000,
+                 upgrade_cache=None, dedup=None, state_file=None):
+        super(StixStreamSource, self).__init__(
+            files, recurse, state_file=state_file,
+            upgrade_cache=upgrade_cache,
+        )
+        self._batch_size = batch_size
+        self._dedup = dedup
+        self._packages = self._stream_files()
+
+    @staticmethod
+    def _observable_for_element(element):
+        obj = cybox_core_binding.ObservableType.factory()
+        obj.build(element)
+        return Observable.from_obj(obj)
+
+    @staticmethod
+    def _indicator_for_element(element):
+        # Let the Indicators binding resolve the indicator's xsi:type
+        obj = stix_core_binding.IndicatorsType.factory()
+        obj.buildChildren(element, None, 'Indicator')
+        return Indicators.from_obj(obj)[0]
+
+    def _stream_file(self, file_, file_obj=None):
+        """Generate packages containing batches of elements from a file.
+
+        The file is read from file_obj (if given) rather than file_.
+        """
+        root = None
+        header = None
+        observables = []
+        indicators = []
+        depth = 0
+        yielded = False
+
+        def _package():
+            package = STIXPackage(
+                id_=root.get('id'),
+                timestamp=root.get('timestamp'),
+                stix_header=header,
+            )
+            if observables:
+                package.observables = observables
+            for indicator in indicators:
+                package.add_indicator(indicator)
+            del observables[:]
+            del indicators[:]
+            return package
+
+        if file_obj is not None:
+            file_obj = _ReplayableFile(file_obj)
+        context = etree.iterparse(file_obj or file_, events=('start', 'end'),
+                                  huge_tree=True, remove_comments=True)
+        for event, element in context:
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    if element.tag != TAG_STIX_PACKAGE:
+                        raise ValueError('root element is not a STIX package')
+                    root = element
+                    if (self._dedup is not None and
+                            self._dedup.is_duplicate_id(
+                                root.get('id'), root.get('timestamp'),
+                                record=False)):
+                        return
+                    if root.get('version') != stix.supported_stix_version():
+                        # Needs updating, so fall back to a full load
+                        if file_obj is not None:
+                            file_ = io.BytesIO(file_obj.content())
+                        package = self.load_stix_package(file_)
+                        if package:
+                            yield package
+                            self._record_package(root)
+                        return
+                    if file_obj is not None:
+                        file_obj.release()
+                continue
+
+            depth -= 1
+            if depth == 1 and element.tag == TAG_STIX_HEADER:
+                header = self._header_for_element(element)
+            elif depth == 2:
+                parent_tag = element.getparent().tag
+                if parent_tag == TAG_STIX_HEADER:
+                    # Wait until the whole header has been read
+                    continue
+                elif (parent_tag == TAG_OBSERVABLES and
+                        element.tag == TAG_OBSERVABLE):
+                    observables.append(self._observable_for_element(element))
+                elif (parent_tag == TAG_INDICATORS and
+                        element.tag == TAG_INDICATOR):
+                    indicators.append(self._indicator_for_element(element))
+
+                if len(observables) + len(indicators) >= self._batch_size:
+                    yield _package()
+                    yielded = True
+
+            if 1 <= depth <= 2:
+                # Discard the processed subtree and any earlier siblings
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+        if root is not None and (observables or indicators or not yielded):
+            yield _package()
+        if root is not None:
+            self._record_package(root)
+
+    def _record_package(self, root):
+        """Records a package as processed (once its last batch has been
+        returned).
+        """
+        if self._dedup is not None:
+            self._dedup.record_id(root.get('id'), root.get('timestamp'))
+
+    def _stream_files(self):
+        while True:
+            file_ = self._next_file()
+            if file_ is None:
+                return
+            try:
+                for name, file_obj in self._open_packages(file_):
+                    try:
+                        for package in self._stream_file(name, file_obj):
+                            yield package
+                    except PARSE_ERRORS:
+                        self._signatures.pop(file_, None)
+                        self._logger.info(
+                            "skipping file '{}' - invalid XML/STIX".format(
+                                name)
+                        )
+                    except READ_ERRORS:
+                        self._signatures.pop(file_, None)
+                        self._logger.info(
+                            "skipping file '{}' - unable to read".format(name)
+                        )
+            except READ_ERRORS:
+                self._signatures.pop(file_, None)
+                self._logger.info(
+                    "skipping file '{}' - unable to read".format(file_)
+                )
+            # Its last package has been returned
+            self._record_file(file_)
+
+    def next_stix_package(self):
+        package = next(self._packages, None)
+        if package is None:
+            self.save_state()
+        return package
+
+    def next_extracted_package(self, transform_class):
+        # Packages are already small, so extract in this process
+        return StixSource.next_extracted_package(self, transform_class)
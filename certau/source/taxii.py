@@ -1,16 +1,30 @@
 import os
 import sys
+import json
 import logging
 from StringIO import StringIO
 
 import dateutil.parser
+import requests
+from lxml import etree
 from libtaxii import get_message_from_http_response, VID_TAXII_XML_11
-from libtaxii.messages_11 import PollRequest, MSG_POLL_RESPONSE
-from libtaxii.messages_11 import generate_message_id
+from libtaxii.constants import VID_TAXII_SERVICES_11
+from libtaxii.constants import VID_TAXII_HTTP_10, VID_TAXII_HTTPS_10
+from libtaxii.messages_11 import PollRequest, PollFulfillmentRequest
+from libtaxii.messages_11 import PollResponse, MSG_POLL_RESPONSE
+from libtaxii.messages_11 import generate_message_id, get_message_from_xml
 from libtaxii.clients import HttpClient
-from libtaxii.scripts import TaxiiScript
 
 from .base import StixSource
+from .writer import ContentBlockWriter
+
+
+TAXII_11_NS = 'http://taxii.mitre.org/messages/taxii_xml_binding-1.1'
+
+TAG_POLL_RESPONSE = '{%s}Poll_Response' % TAXII_11_NS
+TAG_INCLUSIVE_END_TIMESTAMP = '{%s}Inclusive_End_Timestamp' % TAXII_11_NS
+TAG_CONTENT_BLOCK = '{%s}Content_Block' % TAXII_11_NS
+TAG_CONTENT = '{%s}Content' % TAXII_11_NS
 
 
 class SimpleTaxiiClient(HttpClient, StixSource):
@@ -21,6 +35,11 @@ class SimpleTaxiiClient(HttpClient, StixSource):
     returning the response. It supports SSL (certificate-based)
     authentication in addition to a username and password.
 
+    Where the server splits a poll response into multiple parts, the
+    following parts are requested (using poll fulfillment requests) as
+    the content blocks of the previous part are consumed. Only one part
+    is held in memory at a time.
+
     Args:
         hostname: the name of the TAXII server
         path: the URL path for the collection
@@ -36,12 +55,29 @@ class SimpleTaxiiClient(HttpClient, StixSource):
         end_ts: a timestamp to describe the most recent content to be returned
                 by the TAXII server
         subscription_id: a subscription ID to include with the poll request
+        keep_alive: send requests using a persistent HTTP session, so
+                    connections (and their TLS handshakes) are reused
+                    across requests - see :py:func:`connection_stats`
+        state_file: a file used to record the inclusive end timestamp label
+                    of the last complete poll. If begin_ts is not given,
+                    the recorded timestamp is used as the begin timestamp,
+                    so each poll continues from where the last one ended.
+                    The file is only updated by :py:func:`commit_state`.
+        stream: parse poll responses as they are received, converting
+                each content block to a STIX package straight from the
+                parsed XML instead of holding the whole response (and a
+                copy of each content block) in memory. Not supported by
+                :py:func:`save_content_blocks`.
+        upgrade_cache: an optional :py:class:`certau.cache.UpgradeCache`
+                       used when loading content with an older STIX
+                       version
     """
 
     def __init__(self, hostname, path, collection,
                  use_ssl=False, username=None, password=None, port=None, 
                  key_file=None, cert_file=None, ca_file=None, begin_ts=None,
-                 end_ts=None, subscription_id=None):
+                 end_ts=None, subscription_id=None, keep_alive=False,
+                 state_file=None, stream=False, upgrade_cache=None):
         super(SimpleTaxiiClient, self).__init__()
 
         self._logger = logging.getLogger()
@@ -52,6 +88,15 @@ class SimpleTaxiiClient(HttpClient, StixSource):
         self._begin_ts = begin_ts
         self._end_ts = end_ts
         self._subscription_id = subscription_id
+        self._state_file = state_file
+        self._end_label = None
+        self._complete = False
+
+        if state_file and not begin_ts:
+            self._begin_ts = self._load_state()
+            if self._begin_ts:
+                self._logger.info("Polling %r from %s", self,
+                                  self._begin_ts)
 
         self.set_use_https(use_ssl)
         if ca_file:
@@ -94,6 +139,110 @@ class SimpleTaxiiClient(HttpClient, StixSource):
         # Set the index and the content blocks
         self._cb_index = 0
         self._poll_response = None
+        # The result id and part number of the next fulfillment request
+        self._result_id = None
+        self._next_part_number = None
+
+        self._session = self._create_session() if keep_alive else None
+        self._session_requests = 0
+
+        self._stream = stream
+        self._streamed_packages = None
+        self._upgrade_cache = upgrade_cache
+
+    def __repr__(self):
+        return '{}({}:{}{}, {})'.format(
+            self.__class__.__name__,
+            self._hostname,
+            self._port or '',
+            self._path,
+            self._collection,
+        )
+
+    def _load_state(self):
+        """Returns the end timestamp label recorded in the state file."""
+        try:
+            with open(self._state_file, 'rb') as state_f:
+                return json.load(state_f).get('inclusive_end_timestamp_label')
+        except IOError:
+            return None
+        except ValueError:
+            self._logger.warning(
+                "ignoring invalid state file '{}'".format(self._state_file)
+            )
+            return None
+
+    def commit_state(self):
+        """Record the end timestamp label of the poll in the state file.
+
+        Call this once the poll's content has been successfully processed.
+        Nothing is recorded unless all of the poll's content blocks have
+        been consumed (or saved).
+        """
+        if not (self._state_file and self._complete and self._end_label):
+            return
+        state = {
+            'collection': self._collection,
+            'inclusive_end_timestamp_label': self._end_label.isoformat(),
+        }
+        temp_file = self._state_file + '.tmp'
+        with open(temp_file, 'wb') as state_f:
+            json.dump(state, state_f)
+        os.rename(temp_file, self._state_file)
+
+    def _create_session(self):
+        """Create a requests session using the client's credentials."""
+        session = requests.Session()
+        credentials = self.auth_credentials
+        if self.auth_type in (HttpClient.AUTH_CERT,
+                              HttpClient.AUTH_CERT_BASIC):
+            session.cert = (credentials['cert_file'], credentials['key_file'])
+        if (self.auth_type in (HttpClient.AUTH_BASIC,
+                               HttpClient.AUTH_CERT_BASIC) and
+                credentials.get('username')):
+            session.auth = (credentials['username'], credentials['password'])
+        session.verify = self.ca_file if self.verify_server else False
+        session.headers.update({
+            'User-Agent': 'libtaxii.httpclient',
+            'Content-Type': 'application/xml',
+            'Accept': 'application/xml',
+            'X-TAXII-Content-Type': VID_TAXII_XML_11,
+            'X-TAXII-Accept': VID_TAXII_XML_11,
+            'X-TAXII-Services': VID_TAXII_SERVICES_11,
+            'X-TAXII-Protocol': (VID_TAXII_HTTPS_10 if self.use_https
+                                 else VID_TAXII_HTTP_10),
+        })
+        return session
+
+    def _url(self):
+        scheme = 'https' if self.use_https else 'http'
+        port = self._port or (443 if self.use_https else 80)
+        return '{}://{}:{}{}'.format(scheme, self._hostname, port, self._path)
+
+    def connection_stats(self):
+        """Returns connection usage statistics for a keep-alive session.
+
+        Returns:
+            dict: the number of requests sent, the number of connections
+                opened, and the number of requests that reused an existing
+                connection (or None if keep_alive is not in use).
+        """
+        if self._session is None:
+            return None
+        connections = 0
+        for adapter in self._session.adapters.values():
+            for key in adapter.poolmanager.pools.keys():
+                connections += adapter.poolmanager.pools[key].num_connections
+        return {
+            'requests': self._session_requests,
+            'connections': connections,
+            'reused': self._session_requests - connections,
+        }
+
+    def close(self):
+        """Close any persistent connections."""
+        if self._session is not None:
+            self._session.close()
 
     def create_poll_request(self):
         """Create a poll request message using supplied parameters."""
@@ -135,49 +284,248 @@ class SimpleTaxiiClient(HttpClient, StixSource):
 
         return PollRequest(**request_kwargs)
 
-    def send_poll_request(self):
-        """Send the poll request to the TAXII server."""
-        poll_request1 = self.create_poll_request()
-        self._logger.debug(
-            "Request generated: using collection name - %s",
-            self._collection)
+    def create_fulfillment_request(self, result_id, result_part_number):
+        """Create a poll fulfillment request for part of a poll result."""
+        return PollFulfillmentRequest(
+            message_id=generate_message_id(),
+            collection_name=self._collection,
+            result_id=result_id,
+            result_part_number=result_part_number,
+        )
+
+    @staticmethod
+    def _check_in_response_to(request, in_response_to):
+        """Check that a response is for the request that was sent."""
+        if in_response_to != request.message_id:
+            raise Exception('TAXII response is not in response to the '
+                            'request sent (in_response_to: {})'.format(
+                                in_response_to))
+
+    def send_message(self, request):
+        """Send a TAXII 1.1 message to the server, returning the response."""
+        if self._session is not None:
+            http_response = self._session.post(
+                self._url(),
+                data=request.to_xml(),
+            )
+            self._session_requests += 1
+            self._logger.debug("TAXII response received (keep-alive)")
+            http_response.raise_for_status()
+            taxii_content_type = http_response.headers.get(
+                'X-TAXII-Content-Type')
+            if taxii_content_type != VID_TAXII_XML_11:
+                raise Exception('TAXII response has unsupported content '
+                                'type: {}'.format(taxii_content_type))
+            response = get_message_from_xml(http_response.content)
+            self._check_in_response_to(request, response.in_response_to)
+            return response
 
         http_response = self.call_taxii_service2(
             self._hostname,
             self._path,
             VID_TAXII_XML_11,
-            poll_request1.to_xml(),
+            request.to_xml(),
             self._port,
         )
         self._logger.debug("TAXII response received")
         self._logger.debug("HTTP response %s",
                            http_response.__class__.__name__)
 
-        self._poll_response = get_message_from_http_response(
+        return get_message_from_http_response(
             http_response,
-            poll_request1.message_id,
+            request.message_id,
         )
 
-        if self._poll_response.message_type != MSG_POLL_RESPONSE:
+    def _stream_request(self, request):
+        """Send a request and parse the poll response as it is received.
+
+        Generates a :py:class:`PollResponse` (without any content blocks)
+        followed by a STIX package for each content block.
+        """
+        if self._session is not None:
+            http_response = self._session.post(
+                self._url(),
+                data=request.to_xml(),
+                stream=True,
+            )
+            self._session_requests += 1
+            http_response.raise_for_status()
+            taxii_content_type = http_response.headers.get(
+                'X-TAXII-Content-Type')
+            http_response.raw.decode_content = True
+            body = http_response.raw
+        else:
+            http_response = self.call_taxii_service2(
+                self._hostname,
+                self._path,
+                VID_TAXII_XML_11,
+                request.to_xml(),
+                self._port,
+            )
+            taxii_content_type = http_response.info().get(
+                'X-TAXII-Content-Type')
+            body = http_response
+        self._logger.debug("TAXII response received (streaming)")
+
+        if taxii_content_type != VID_TAXII_XML_11:
             raise Exception('TAXII response not a poll response as expected.')
 
-    def save_content_blocks(self, directory):
-        """Save poll response content blocks to given directory."""
-        if os.path.exists(directory) and self._poll_response:
-            taxii_script = TaxiiScript()
-            taxii_script.write_cbs_from_poll_response_11(
-                self._poll_response,
-                directory,
+        depth = 0
+        poll_response = None
+        for event, element in etree.iterparse(body, events=('start', 'end'),
+                                              huge_tree=True):
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    if element.tag != TAG_POLL_RESPONSE:
+                        raise Exception('TAXII response not a poll response '
+                                        'as expected.')
+                    self._check_in_response_to(
+                        request, element.get('in_response_to'),
+                    )
+                    poll_response = PollResponse(
+                        message_id=element.get('message_id'),
+                        in_response_to=element.get('in_response_to'),
+                        collection_name=element.get('collection_name'),
+                        more=element.get('more') in ('true', '1'),
+                        result_id=element.get('result_id'),
+                        result_part_number=int(
+                            element.get('result_part_number', 1)),
+                    )
+                    yield poll_response
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+            if element.tag == TAG_INCLUSIVE_END_TIMESTAMP:
+                label = dateutil.parser.parse(element.text)
+                poll_response.inclusive_end_timestamp_label = label
+                self._end_label = label
+            elif element.tag == TAG_CONTENT_BLOCK:
+                content = element.find(TAG_CONTENT)
+                if content is not None and len(content):
+                    # XML content - use the parsed element as is
+                    package = self.load_stix_package(content[0])
+                elif content is not None and content.text:
+                    package = self.load_stix_package(
+                        StringIO(content.text.encode('utf-8')))
+                else:
+                    package = None
+                if package:
+                    yield package
+                else:
+                    self._logger.info("skipping invalid content block")
+            # Discard the processed element and any earlier siblings
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    def _poll(self, request):
+        """Send a poll or poll fulfillment request."""
+        if self._stream:
+            self._streamed_packages = self._stream_request(request)
+            self._poll_response = next(self._streamed_packages)
+        else:
+            self._poll_response = self._send_request(request)
+        self._cb_index = 0
+
+    def _send_request(self, request):
+        """Send a request to the TAXII server, returning the poll response."""
+        response = self.send_message(request)
+        if response.message_type != MSG_POLL_RESPONSE:
+            raise Exception('TAXII response not a poll response as expected.')
+        if response.inclusive_end_timestamp_label:
+            self._end_label = response.inclusive_end_timestamp_label
+        return response
+
+    def send_poll_request(self):
+        """Send the poll request to the TAXII server."""
+        poll_request1 = self.create_poll_request()
+        self._logger.debug(
+            "Request generated: using collection name - %s",
+            self._collection)
+
+        self._complete = False
+        self._end_label = None
+        self._result_id = None
+        self._next_part_number = None
+        self._poll(poll_request1)
+
+    def open(self):
+        """Send the poll request (if it hasn't already been sent)."""
+        if not self._poll_response:
+            self.send_poll_request()
+
+    def send_fulfillment_request(self):
+        """Request the next part of a multi-part poll response.
+
+        The current part is released before the next part is requested.
+        If the request fails, calling this method again retries it.
+        """
+        if self._poll_response:
+            self._result_id = self._poll_response.result_id
+            self._next_part_number = (
+                self._poll_response.result_part_number + 1
             )
-        elif not self._poll_response:
+            self._poll_response = None
+        elif self._next_part_number is None:
             raise Exception('no poll response, call send_poll_request() first')
-        else:
-            raise Exception('output directory for TAXII content blocks ({}) '
-                            'does not exist'.format(directory))
+        self._logger.debug("Requesting part %d of result %s",
+                           self._next_part_number, self._result_id)
+
+        self._poll(self.create_fulfillment_request(self._result_id,
+                                                   self._next_part_number))
+
+    def save_content_blocks(self, directory, compression=None, dedup=False,
+                            threads=1):
+        """Save poll response content blocks to given directory.
+
+        See :py:class:`ContentBlockWriter` for a description of the
+        compression, dedup and threads arguments. Later parts of a
+        multi-part response are fetched while earlier blocks are written.
+
+        Returns:
+            the :py:class:`ContentBlockWriter` used to write the blocks
+        """
+        if self._stream:
+            raise Exception('content blocks cannot be saved when streaming '
+                            'poll responses')
+        if not self._poll_response:
+            raise Exception('no poll response, call send_poll_request() first')
+        writer = ContentBlockWriter(
+            directory,
+            compression=compression,
+            dedup=dedup,
+            threads=threads,
+        )
+        try:
+            while True:
+                writer.write_poll_response(self._poll_response)
+                if not self._poll_response.more:
+                    break
+                self.send_fulfillment_request()
+        finally:
+            writer.close()
+        self._complete = True
+        self._logger.info(
+            "%d content blocks written, %d duplicates skipped",
+            writer.written,
+            writer.duplicates,
+        )
+        return writer
 
     def next_stix_package(self):
+        if not self._poll_response and self._next_part_number is not None:
+            # Retry a failed fulfillment request
+            self.send_fulfillment_request()
         if not self._poll_response:
             raise Exception('no poll response, call send_poll_request() first')
+        if self._stream:
+            return self._next_streamed_package()
+        while (self._cb_index >= len(self._poll_response.content_blocks) and
+                self._poll_response.more):
+            self.send_fulfillment_request()
         if self._cb_index < len(self._poll_response.content_blocks):
             content_block = self._poll_response.content_blocks[self._cb_index]
             package_io = StringIO(content_block.content)
@@ -185,4 +533,15 @@ class SimpleTaxiiClient(HttpClient, StixSource):
             self._cb_index += 1
         else:
             package = None
+            self._complete = True
         return package
+
+    def _next_streamed_package(self):
+        while True:
+            package = next(self._streamed_packages, None)
+            if package is not None:
+                return package
+            elif not self._poll_response.more:
+                self._complete = True
+                return None
+            self.send_fulfillment_request()
@@ -0,0 +1,171 @@
+import os
+import io
+import gzip
+import hashlib
+import logging
+import datetime
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+
+from libtaxii.common import gen_filename
+from libtaxii.constants import CB_STIX_XML_10, CB_STIX_XML_101
+from libtaxii.constants import CB_STIX_XML_11, CB_STIX_XML_111
+from libtaxii.constants import CB_STIX_XML_12
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# File name parts for known content bindings (as used by libtaxii)
+BINDING_FORMATS = {
+    CB_STIX_XML_10: '_STIX10_',
+    CB_STIX_XML_101: '_STIX101_',
+    CB_STIX_XML_11: '_STIX11_',
+    CB_STIX_XML_111: '_STIX111_',
+    CB_STIX_XML_12: '_STIX12_',
+}
+
+COMPRESSION_EXTENSIONS = {
+    None: '',
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+class ContentBlockWriter(object):
+    """Write TAXII content blocks to files in a directory.
+
+    Files are named in the same way as libtaxii's poll client (using the
+    collection name, content binding and timestamp label of each block).
+    Content may be compressed with gzip or zstd (which requires the
+    zstandard package). Files are written by a pool of threads, so the
+    next part of a poll response can be fetched while earlier blocks are
+    being written, and each file is written under a temporary name and
+    then renamed so partially written files are never left behind.
+
+    When deduplication is enabled, files are named using the SHA-256
+    digest of the block's content instead of its timestamp label. Blocks
+    whose content has already been written (in this run or an earlier one)
+    are skipped.
+
+    Args:
+        directory: the directory the files are written to (must exist)
+        compression: None, 'gzip' or 'zstd'
+        dedup: skip blocks whose content has already been written
+        threads: the number of threads used to write files
+        max_pending: the maximum number of blocks waiting to be written
+
+    Attributes:
+        written: the number of files written
+        duplicates: the number of blocks skipped as duplicates
+    """
+
+    def __init__(self, directory, compression=None, dedup=False, threads=1,
+                 max_pending=100):
+        if not os.path.isdir(directory):
+            raise Exception('output directory for TAXII content blocks ({}) '
+                            'does not exist'.format(directory))
+        if compression not in COMPRESSION_EXTENSIONS:
+            raise ValueError(
+                'unknown compression type ({})'.format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise Exception('the zstandard package is required for zstd '
+                            'compression')
+        self._logger = logging.getLogger()
+        self._directory = directory
+        self._compression = compression
+        self._dedup = dedup
+        self._max_pending = max_pending
+        self._pool = ThreadPool(threads) if threads > 1 else None
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        self._digests = set()
+        self.written = 0
+        self.duplicates = 0
+
+    def _filename(self, collection_name, content_block, digest):
+        format_ = BINDING_FORMATS.get(
+            content_block.content_binding.binding_id, '')
+        ext = '.xml' if format_ else ''
+        if digest:
+            name_string = 'h' + digest
+        elif content_block.timestamp_label:
+            name_string = 't' + content_block.timestamp_label.isoformat()
+        else:
+            name_string = 's' + datetime.datetime.now().isoformat()
+        filename = gen_filename(collection_name, format_, name_string, ext)
+        filename += COMPRESSION_EXTENSIONS[self._compression]
+        return os.path.join(self._directory, filename)
+
+    def _compress(self, content):
+        if self._compression == 'gzip':
+            buf = io.BytesIO()
+            # A fixed mtime means identical content gives identical files
+            with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz_file:
+                gz_file.write(content)
+            return buf.getvalue()
+        elif self._compression == 'zstd':
+            return zstandard.ZstdCompressor().compress(content)
+        return content
+
+    def _write_file(self, filename, content):
+        """Compress and write content to a file (called by a pool thread)."""
+        data = self._compress(content)
+        tmp_filename = '{}.{}.tmp'.format(
+            filename, threading.current_thread().ident)
+        with open(tmp_filename, 'wb') as file_:
+            file_.write(data)
+        os.rename(tmp_filename, filename)
+        self._logger.debug("content block written to %s", filename)
+        with self._lock:
+            self.written += 1
+
+    def _wait(self, max_pending):
+        """Wait until no more than max_pending writes are outstanding."""
+        while len(self._pending) > max_pending:
+            # get() re-raises any exception raised while writing
+            self._pending.popleft().get()
+
+    def write(self, collection_name, content_block):
+        """Write (or queue the writing of) a single content block."""
+        content = content_block.content
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+
+        digest = None
+        if self._dedup:
+            digest = hashlib.sha256(content).hexdigest()
+        filename = self._filename(collection_name, content_block, digest)
+        if digest:
+            if digest in self._digests or os.path.exists(filename):
+                self._logger.debug("skipping duplicate content block %s",
+                                   digest)
+                self.duplicates += 1
+                return
+            self._digests.add(digest)
+
+        if self._pool is None:
+            self._write_file(filename, content)
+        else:
+            self._pending.append(self._pool.apply_async(
+                self._write_file, (filename, content),
+            ))
+            self._wait(self._max_pending)
+
+    def write_poll_response(self, poll_response):
+        """Write the content blocks contained in a TAXII poll response."""
+        for content_block in poll_response.content_blocks:
+            self.write(poll_response.collection_name, content_block)
+
+    def close(self):
+        """Wait for outstanding writes to finish."""
+        try:
+            self._wait(0)
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
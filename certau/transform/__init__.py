@@ -16,9 +16,14 @@ There are two broad types of transform currently supported:
 
 #. Transforms that interact with a service:
      * :py:class:`StixMispTransform` - publish indicators to a MISP instance
+
+:py:class:`StixTransformGroup` extracts the observables for several
+transforms from a package at once. The :py:mod:`certau.transform.xpath`
+module reads observables directly from the XML of a package.
 """
 
-__all__ = ['base', 'text', 'stats', 'csv', 'brointel', 'misp']
+__all__ = ['base', 'text', 'stats', 'csv', 'brointel', 'misp', 'group',
+           'xpath']
 
 from .base import StixTransform
 from .text import StixTextTransform
@@ -26,3 +31,4 @@ from .stats import StixStatsTransform
 from .csv import StixCsvTransform
 from .brointel import StixBroIntelTransform
 from .misp import StixMispTransform
+from .group import StixTransformGroup
@@ -1,6 +1,6 @@
 import logging
 import pprint
-import copy
+import hashlib
 
 from cybox import EntityList
 from cybox.core import Object
@@ -8,6 +8,21 @@ from cybox.common import ObjectProperties
 from stix.extensions.marking.tlp import TLPMarkingStructure
 
 
+# Whether values of each type are lists (EntityList is an abstract base
+# class, so isinstance checks against it are relatively slow)
+_LIST_TYPES = dict()
+
+
+def _is_list_value(value):
+    """Returns True if value is a list (including a cybox EntityList)."""
+    try:
+        return _LIST_TYPES[value.__class__]
+    except KeyError:
+        is_list = isinstance(value, (list, EntityList))
+        _LIST_TYPES[value.__class__] = is_list
+        return is_list
+
+
 class StixTransform(object):
     """Base class for transforming a STIX package to an alternate format.
 
@@ -17,14 +32,27 @@ class StixTransform(object):
     transform STIX packages into alternate formats.
 
     The default constructor processes a STIX package to initialise
-    self._observables, a :py:class:`dict` keyed by object type.
-    Each entry contains a list :py:class:`list` of :py:class:`dict` objects
-    with three keys: 'id', 'observable', and 'fields', containing the
-    observable ID, the :py:class:`Observable<cybox.core.observable.Observable>`
-    object itself, and extracted fields, respectively.
+    self._observables, a mapping (:py:class:`dict` or
+    :py:class:`LazyObservables`) keyed by object type.
+    Each entry contains a list :py:class:`list` of
+    :py:class:`ExtractedObservable` objects with three keys: 'id',
+    'observable', and 'fields', containing the observable ID, the
+    :py:class:`Observable<cybox.core.observable.Observable>` object itself,
+    and extracted fields, respectively. The extracted fields are a list of
+    read-only :py:class:`FieldValues` mappings (one for each row).
+
+    Observables are extracted on demand, the first time observables of
+    each object type are used, so object types that aren't output cost
+    little.
 
     Args:
         package: the STIX package to transform
+        observables: observables previously extracted from the package
+            using :py:func:`_observables_for_package` (optional)
+        object_types: a list of the object types to be transformed (all
+            supported object types if None)
+        max_observable_rows: the maximum number of rows extracted from a
+            single observable (optional - overrides MAX_OBSERVABLE_ROWS)
 
     Attributes:
         OBJECT_FIELDS: a :py:class:`dict` of supported Cybox object types
@@ -58,16 +86,42 @@ class StixTransform(object):
             may not support 'FitsPattern' or 'StartsWith' string condition
             values. Use this to list the supported values. Note the values
             are strings, even 'None'.
+
+        REQUIRES_FULL_PACKAGE: a boolean indicating whether the transform
+            uses package content other than the package id, timestamp,
+            header and the extracted observables. Extracted observables
+            are not cached for these transforms.
+
+        MAX_OBSERVABLE_ROWS: the default maximum number of rows (sets of
+            field values) extracted from a single observable, or None for
+            no limit. Fields containing lists produce a row for each
+            combination of list items, so a single observable could
+            otherwise produce a very large number of rows.
     """
 
     # Class constants - see descriptions above
     OBJECT_FIELDS = dict()
     OBJECT_CONSTRAINTS = dict()
     STRING_CONDITION_CONSTRAINT = list()
+    REQUIRES_FULL_PACKAGE = False
+    MAX_OBSERVABLE_ROWS = None
+
+    # Changed whenever the representation of extracted observables changes
+    _EXTRACTION_FORMAT = 3
 
-    def __init__(self, package):
+    def __init__(self, package, observables=None, object_types=None,
+                 max_observable_rows=None):
         self._package = package
-        self._observables = self._observables_for_package(package)
+        if observables is None:
+            observables = LazyObservables(self.__class__, package,
+                                          object_types, max_observable_rows)
+        elif object_types:
+            observables = dict(
+                (object_type, object_observables)
+                for object_type, object_observables in observables.items()
+                if object_type in object_types
+            )
+        self._observables = observables
 
         # Initialise the logger
         self._logger = logging.getLogger()
@@ -137,13 +191,35 @@ class StixTransform(object):
         properties = StixTransform._observable_properties(observable)
         return properties.__class__.__name__ if properties else None
 
+    @classmethod
+    def _extraction_fingerprint(cls):
+        """Returns a string identifying what this class extracts.
+
+        The fingerprint changes whenever the class's OBJECT_FIELDS,
+        OBJECT_CONSTRAINTS, STRING_CONDITION_CONSTRAINT or
+        MAX_OBSERVABLE_ROWS change.
+        """
+        state = (
+            cls._EXTRACTION_FORMAT,
+            cls.__module__,
+            cls.__name__,
+            sorted(cls.OBJECT_FIELDS.items()),
+            sorted((object_type, sorted(constraints.items()))
+                   for object_type, constraints
+                   in cls.OBJECT_CONSTRAINTS.items()),
+            cls.STRING_CONDITION_CONSTRAINT,
+            cls.MAX_OBSERVABLE_ROWS,
+        )
+        return hashlib.sha1(repr(state)).hexdigest()
+
     @staticmethod
     def _condition_key_for_field(field):
         """Dictionary key used for storing the string condition of a field."""
         return field + '_condition'
 
     @classmethod
-    def _observables_for_package(cls, package):
+    def _observables_for_package(cls, package, object_types=None,
+                                 max_rows=None):
         """Extract observables from a STIX package.
 
         Collects observables from a STIX package and groups them by object
@@ -159,6 +235,9 @@ class StixTransform(object):
         If no OBJECT_FIELDS are specified no constraints are applied and all
         identified observables are returned.
 
+        If object_types is given, only observables of those object types
+        are returned.
+
         Observables are sought from the following locations:
 
             - the root of the STIX package
@@ -167,170 +246,669 @@ class StixTransform(object):
             - within ObservableComposition objects found in either of the two
               previous locations
 
+        The IDs referenced by observables without an ID of their own (using
+        idref) are recorded in the result's references, so they can be
+        resolved using an :py:class:`ObservableIndex
+        <certau.index.ObservableIndex>`.
+
         Args:
             package: a :py:class:`stix:STIXPackage` object
+            object_types: a list of the object types to be returned
+                (optional)
+            max_rows: the maximum number of rows extracted from a single
+                observable (optional - defaults to MAX_OBSERVABLE_ROWS)
 
         Returns:
-            dict: a dictionary of valid observables, keyed by object type
-                (See description above). May be empty.
+            PackageObservables: a dictionary of valid observables, keyed by
+                object type (See description above). May be empty.
         """
 
-        def _add_observables(new_observables):
-            for observable in new_observables:
-                if observable.observable_composition is not None:
-                    _add_observables(
-                        observable.observable_composition.observables
-                    )
-                else:
-                    object_type = cls._observable_object_type(observable)
-                    if (observable.id_ is not None and
-                            observable.id_ not in observable_ids and
-                            object_type is not None):
-                        object_type = cls._observable_object_type(observable)
-                        if object_type in cls.OBJECT_FIELDS.keys():
-                            fields = cls._field_values_for_observable(
-                                observable
-                            )
-                            if not fields:
-                                continue
-                        elif not cls.OBJECT_FIELDS:
-                            fields = None
-                        else:
-                            continue
-                        if object_type not in observables:
-                            observables[object_type] = []
-                        new_observable = dict(
-                            id=observable.id_,
-                            observable=observable,
-                            fields=fields,
-                        )
-                        observables[object_type].append(new_observable)
-                        observable_ids.append(observable.id_)
-
-        # Look for observables in the package root and in indicators
-        observable_ids = []
-        observables = dict()
+        observable_ids = set()
+        observables = PackageObservables()
+        for observable in cls._package_observables(package):
+            if observable.id_ is None:
+                if observable.idref is not None:
+                    observables.add_reference(observable.idref)
+                continue
+            elif observable.id_ in observable_ids:
+                continue
+            object_type = cls._observable_object_type(observable)
+            if object_type is None:
+                continue
+            if object_types and object_type not in object_types:
+                continue
+            extracted = cls._extract_observable(observable, object_type,
+                                                max_rows=max_rows)
+            if extracted is None:
+                continue
+            if object_type not in observables:
+                observables[object_type] = []
+            observables[object_type].append(extracted)
+            observable_ids.add(observable.id_)
+        return observables
+
+    @classmethod
+    def _observables_for_tree(cls, root, object_types=None, max_rows=None):
+        """Extract observables from a parsed STIX document.
+
+        Fields are read directly from the XML where possible (see
+        :py:class:`XPathExtractor <certau.transform.xpath.XPathExtractor>`).
+        The results are the same as those of
+        :py:func:`_observables_for_package` for the loaded package, except
+        that the observables don't reference python-stix objects. The
+        :py:class:`StixTransformGroup
+        <certau.transform.StixTransformGroup>` used is stored on the class
+        and reused.
+
+        Args:
+            root: the root (STIX_Package) element of the document
+            object_types: a list of the object types to be returned
+                (optional)
+            max_rows: the maximum number of rows extracted from a single
+                observable (optional - defaults to MAX_OBSERVABLE_ROWS)
+
+        Raises:
+            UnsupportedDocumentError: if the document can't be read using
+                XPath, in which case it should be loaded with python-stix
+        """
+        key = (tuple(sorted(object_types or [])), max_rows)
+        groups = cls.__dict__.get('_tree_groups')
+        if groups is None:
+            groups = dict()
+            setattr(cls, '_tree_groups', groups)
+        group = groups.get(key)
+        if group is None:
+            from .group import StixTransformGroup
+            group = StixTransformGroup([cls], object_types, max_rows)
+            groups[key] = group
+        return group._observables_for_tree(root)[cls]
+
+    @staticmethod
+    def _package_observables(package):
+        """Yields the observables (other than compositions) in a package.
+
+        Observables are yielded in order from the package root, then from
+        the indicators, including those found within (nested)
+        ObservableComposition objects. Compositions are walked using an
+        explicit stack of iterators (rather than recursion) so deeply
+        nested compositions are handled.
+        """
+        sources = []
         if package.observables:
-            _add_observables(package.observables)
+            sources.append(package.observables)
         if package.indicators:
             for i in package.indicators:
                 if i.observables:
-                    _add_observables(i.observables)
-        return observables
+                    sources.append(i.observables)
+
+        stack = [iter(source) for source in reversed(sources)]
+        while stack:
+            observable = next(stack[-1], None)
+            if observable is None:
+                stack.pop()
+            elif observable.observable_composition is not None:
+                stack.append(
+                    iter(observable.observable_composition.observables)
+                )
+            else:
+                yield observable
+
+    @classmethod
+    def _extract_observable(cls, observable, object_type, properties=None,
+                            max_rows=None):
+        """Returns an :py:class:`ExtractedObservable` for an observable.
+
+        Returns None if the observable's object type isn't supported, or
+        if no field values are found (see
+        :py:func:`_observables_for_package`).
+
+        Args:
+            observable: a :py:class:`cybox.Observable` object
+            object_type: the observable's object type
+            properties: the observable's properties, if already known
+            max_rows: the maximum number of rows to extract (optional -
+                defaults to MAX_OBSERVABLE_ROWS)
+        """
+        if object_type in cls.OBJECT_FIELDS:
+            fields = cls._field_values_for_observable(observable, object_type,
+                                                      properties, max_rows)
+            if not fields:
+                return None
+        elif not cls.OBJECT_FIELDS:
+            fields = None
+        else:
+            return None
+        return ExtractedObservable(observable.id_, observable, fields)
+
+    @staticmethod
+    def _detached_observables(observables):
+        """Returns a copy of extracted observables suitable for caching.
+
+        The copy doesn't reference the
+        :py:class:`Observable<cybox.core.observable.Observable>` objects
+        (or the rest of the package).
+        """
+        detached = PackageObservables()
+        for object_type, object_observables in observables.items():
+            detached[object_type] = [
+                ExtractedObservable(observable.id, None, observable.fields)
+                for observable in object_observables
+            ]
+        for idref in getattr(observables, 'references', ()):
+            detached.add_reference(idref)
+        return detached
 
     @classmethod
-    def _field_values_for_observable(cls, observable):
-        """Collects property field values for an observable."""
-        object_type = cls._observable_object_type(observable)
-        fields = list(cls.OBJECT_FIELDS[object_type])
-
-        # Add any fields required for constraint checking
-        if object_type in cls.OBJECT_CONSTRAINTS.keys():
-            for field in cls.OBJECT_CONSTRAINTS[object_type]:
+    def _field_accessor(cls, object_type):
+        """Returns the compiled :py:class:`FieldAccessor` for an object type.
+
+        Accessors are compiled from OBJECT_FIELDS and OBJECT_CONSTRAINTS
+        the first time each object type is seen, and stored on the class.
+        """
+        accessors = cls.__dict__.get('_field_accessors')
+        if accessors is None:
+            accessors = dict()
+            setattr(cls, '_field_accessors', accessors)
+        accessor = accessors.get(object_type)
+        if accessor is None:
+            fields = list(cls.OBJECT_FIELDS[object_type])
+            constraints = []
+            # Add any fields required for constraint checking
+            for field, allowed in cls.OBJECT_CONSTRAINTS.get(
+                    object_type, dict()).items():
                 if field not in fields:
                     fields.append(field)
+                constraints.append((
+                    field,
+                    allowed,
+                    field not in cls.OBJECT_FIELDS[object_type],
+                ))
+            accessor = FieldAccessor(fields)
+            accessor.constraints = constraints
+            keys = []
+            for field in fields:
+                keys.append(field)
+                keys.append(cls._condition_key_for_field(field))
+            accessor.layout = FieldLayout(keys)
+            accessors[object_type] = accessor
+        return accessor
+
+    @classmethod
+    def _field_values_for_observable(cls, observable, object_type=None,
+                                     properties=None, max_rows=None):
+        """Collects property field values for an observable.
+
+        Returns a list of :py:class:`FieldValues` objects sharing the
+        object type's :py:class:`FieldLayout`.
+
+        Args:
+            observable: a :py:class:`cybox.Observable` object
+            object_type: the observable's object type, if already known
+                (see :py:func:`_observable_object_type`)
+            properties: the observable's properties, if already known
+            max_rows: the maximum number of rows to extract (optional -
+                defaults to MAX_OBSERVABLE_ROWS)
+        """
+        if object_type is None:
+            object_type = cls._observable_object_type(observable)
+        accessor = cls._field_accessor(object_type)
 
         # Get field values
+        if properties is None:
+            properties = cls._observable_properties(observable)
+        rows = cls._rows_for_entity([], properties, accessor,
+                                    max_rows or cls.MAX_OBSERVABLE_ROWS)
+
+        layout = accessor.layout
+        index = layout.index
         values = []
-        properties = cls._observable_properties(observable)
-        cls._field_values_for_entity(values, properties, fields)
-
-        # Check constraints
-        if object_type in cls.OBJECT_CONSTRAINTS.keys():
-            for field in cls.OBJECT_CONSTRAINTS[object_type]:
-                for value in values:
-                    # Multiple constraints are combined with an implied 'AND'
-                    # (i.e. all of the constraints must be satisfied)
-                    if (field not in value or value[field] not in
-                            cls.OBJECT_CONSTRAINTS[object_type][field]):
-                        values.remove(value)
-                        break
-                    # Remove the constraint field if not needed
-                    if field not in cls.OBJECT_FIELDS[object_type]:
-                        del value[field]
+        for row in rows:
+            row_values = [None] * len(layout.keys)
+            for field, value in row:
+                row_values[index[field]] = value
+            # Check constraints
+            if (accessor.constraints and
+                    not cls._check_constraints(row_values, index,
+                                               accessor.constraints)):
+                continue
+            values.append(FieldValues(layout, tuple(row_values)))
         return values
 
+    @staticmethod
+    def _check_constraints(row_values, index, constraints):
+        """Returns True if a row of field values satisfies the constraints.
+
+        Multiple constraints are combined with an implied 'AND' (i.e. all
+        of the constraints must be satisfied). Constraint fields that are
+        not needed are cleared from row_values.
+        """
+        for field, allowed, remove_field in constraints:
+            value = row_values[index[field]]
+            if value is None or value not in allowed:
+                return False
+        for field, allowed, remove_field in constraints:
+            if remove_field:
+                row_values[index[field]] = None
+        return True
+
+    @staticmethod
+    def _convert_to_str(value):
+        if isinstance(value, basestring):
+            return value.encode('utf-8')
+        elif value is None:
+            return 'None'
+        else:
+            return pprint.pformat(value)
+
     @classmethod
-    def _field_values_for_entity(cls, values, entity, fields, first_part=''):
-        """Returns requested field values from a cybox.Entity object."""
+    def _value_pairs(cls, value, field):
+        """Returns the (field, value) pairs to be added to rows for a value.
 
-        def _first_parts(fields):
-            """Get the bits on the left of the first dot in the field names.
-            """
-            first_parts = set()
-            for field in fields:
-                parts = field.split('.')
-                first_parts.add(parts[0])
-            return first_parts
-
-        def _next_parts(fields, field):
-            """Get the next parts for this field."""
-            next_parts = set()
-            first_part = field + '.'
-            for field in fields:
-                if field.startswith(first_part):
-                    next_parts.add(field[len(first_part):])
-            return next_parts
+        The condition value is set to '-' if the field doesn't have a
+        condition attribute to allow us to differentiate it from a value
+        that does contain a condition attribute, but its value is None.
+        """
+        condition = intern(
+            cls._convert_to_str(getattr(value, 'condition', '-'))
+        )
+        value = intern(cls._convert_to_str(getattr(value, 'value', value)))
+        if value and (not cls.STRING_CONDITION_CONSTRAINT or
+                      condition in cls.STRING_CONDITION_CONSTRAINT or
+                      condition == '-'):
+            if condition != '-':
+                return ((field, value),
+                        (cls._condition_key_for_field(field), condition))
+            return ((field, value),)
+        return ()
 
-        def _convert_to_str(value):
-            if isinstance(value, basestring):
-                return value.encode('utf-8')
-            else:
-                return pprint.pformat(value)
-
-        def _get_value_condition(value):
-            """Set the condition value to '-' if the field doesn't have a
-            condition attribute to allow us to differentiate it from a value
-            that does contain a condition attribute, but its value is None.
-            """
-            condition = getattr(value, 'condition', '-')
-            value = getattr(value, 'value', value)
-            return (_convert_to_str(value), _convert_to_str(condition))
-
-        def _add_value_to_dict(dict_, value, field):
-            value, condition = _get_value_condition(value)
-            if value and (not cls.STRING_CONDITION_CONSTRAINT or
-                          condition in cls.STRING_CONDITION_CONSTRAINT or
-                          condition == '-'):
-                dict_[field] = value
-                if condition != '-':
-                    c_field = cls._condition_key_for_field(field)
-                    dict_[c_field] = condition
-
-        def _add_value_to_values(values, value, field):
-            """Add value and condition (if present) to results."""
-            if values:
-                for dict_ in values:
-                    _add_value_to_dict(dict_, value, field)
-            else:
-                # First entry
-                dict_ = dict()
-                _add_value_to_dict(dict_, value, field)
-                if dict_:
-                    values.append(dict_)
-
-        for field in _first_parts(fields):
-            full_first_part = first_part + '.' + field if first_part else field
-            next_parts = _next_parts(fields, field)
-            value = getattr(entity, field, None)
-
-            if isinstance(value, (list, EntityList)):
-                values_copy = copy.deepcopy(values)
-                first = True
+    @classmethod
+    def _rows_for_value(cls, rows, value, full_name, child, max_rows=None):
+        """Returns rows updated with a (non-list) field value."""
+        if child is not None:
+            return cls._rows_for_entity(rows, value, child, max_rows)
+        pairs = cls._value_pairs(value, full_name)
+        if not pairs:
+            return rows
+        elif rows:
+            return [row + pairs for row in rows]
+        else:
+            # First entry
+            return [pairs]
+
+    @classmethod
+    def _rows_for_entity(cls, rows, entity, accessor, max_rows=None):
+        """Returns rows updated with field values from a cybox.Entity object.
+
+        Each row is a tuple of (field, value) pairs (later pairs replace
+        earlier ones for the same field). Rows are never modified, so when
+        a field contains a list, each item's rows are built from the same
+        (shared) rows rather than from copies. A list with n items
+        multiplies the number of rows by n, up to max_rows.
+
+        Args:
+            rows: the list of rows to be updated
+            entity: the :py:class:`cybox.Entity` object
+            accessor: the :py:class:`FieldAccessor` for the fields to be
+                retrieved from the entity
+            max_rows: the maximum number of rows (optional)
+        """
+        for name, full_name, child in accessor.children:
+            value = getattr(entity, name, None)
+
+            if _is_list_value(value):
+                new_rows = None
                 for item in value:
-                    v_list = values if first else copy.deepcopy(values_copy)
-                    if next_parts:
-                        cls._field_values_for_entity(v_list, item, next_parts,
-                                                     full_first_part)
+                    item_rows = cls._rows_for_value(rows, item, full_name,
+                                                    child, max_rows)
+                    if new_rows is None:
+                        new_rows = list(item_rows)
                     else:
-                        _add_value_to_values(v_list, item, full_first_part)
-                    if not first:
-                        values.extend(v_list)
-                    else:
-                        first = False
+                        new_rows.extend(item_rows)
+                    if max_rows and len(new_rows) >= max_rows:
+                        if len(new_rows) > max_rows:
+                            logging.getLogger().warning(
+                                "limiting rows for field '%s' to %d",
+                                full_name, max_rows,
+                            )
+                            del new_rows[max_rows:]
+                        break
+                if new_rows is not None:
+                    rows = new_rows
             elif value:
-                if next_parts:
-                    cls._field_values_for_entity(values, value, next_parts,
-                                                 full_first_part)
-                else:
-                    _add_value_to_values(values, value, full_first_part)
+                rows = cls._rows_for_value(rows, value, full_name, child,
+                                           max_rows)
+        return rows
+
+
+class FieldAccessor(object):
+    """A tree of accessors compiled from (dot notation) field names.
+
+    Each node holds the attributes to be read from an entity. For each
+    attribute there is a child node if fields of the attribute's value
+    are required, or None if the value itself is required. This saves
+    splitting and matching the field names for every observable.
+
+    Args:
+        fields: a list of field names, e.g. ['header.to', 'subject']
+        prefix: the full name of the field this node is for (if any)
+
+    Attributes:
+        children: a list of (attribute name, full field name, child node)
+            tuples
+        constraints: a list of (field name, allowed values, remove field)
+            tuples, where remove field indicates the field is only needed
+            for checking the constraint (only set on the root node)
+        layout: the :py:class:`FieldLayout` of the extracted rows (only
+            set on the root node)
+    """
+
+    __slots__ = ('children', 'constraints', 'layout')
+
+    def __init__(self, fields, prefix=''):
+        self.children = []
+        self.constraints = []
+        self.layout = None
+        first_parts = set(field.split('.')[0] for field in fields)
+        for name in first_parts:
+            full_name = prefix + '.' + name if prefix else name
+            next_parts = set(
+                field[len(name) + 1:] for field in fields
+                if field.startswith(name + '.')
+            )
+            child = FieldAccessor(next_parts, full_name) if next_parts \
+                else None
+            self.children.append((name, full_name, child))
+
+
+class FieldLayout(object):
+    """The keys of the rows of field values extracted for an object type.
+
+    A layout is shared by all of the rows extracted for an object type
+    (by a transform class), so each row only needs to hold its values.
+
+    Args:
+        keys: a list of field names (including condition keys)
+
+    Attributes:
+        keys: a tuple of the (interned) keys
+        index: a :py:class:`dict` mapping each key to its position
+    """
+
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = tuple(intern(key) for key in keys)
+        self.index = dict((key, i) for i, key in enumerate(self.keys))
+
+    def __getstate__(self):
+        return self.keys
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+
+class FieldValues(object):
+    """A read-only mapping of field names to values for one extracted row.
+
+    Values are held in a tuple ordered by the row's :py:class:`FieldLayout`,
+    with None for fields that have no value. This uses much less memory
+    than a :py:class:`dict` for each row. Supports the usual (read-only)
+    mapping operations, e.g. ``fields['value']``, ``'value' in fields``,
+    ``fields.get('value_condition', 'None')`` and ``dict(fields)``.
+
+    Args:
+        layout: the :py:class:`FieldLayout` of the row
+        values: a tuple of values, one for each key of the layout
+    """
+
+    __slots__ = ('_layout', '_values')
+
+    def __init__(self, layout, values):
+        self._layout = layout
+        self._values = values
+
+    def __getstate__(self):
+        return self._layout, self._values
+
+    def __setstate__(self, state):
+        self._layout, self._values = state
+
+    def __getitem__(self, key):
+        i = self._layout.index.get(key)
+        value = self._values[i] if i is not None else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        i = self._layout.index.get(key)
+        value = self._values[i] if i is not None else None
+        return default if value is None else value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __iter__(self):
+        for key, value in zip(self._layout.keys, self._values):
+            if value is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for value in self._values if value is not None)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [value for value in self._values if value is not None]
+
+    def items(self):
+        return [(key, value) for key, value
+                in zip(self._layout.keys, self._values)
+                if value is not None]
+
+    def replace(self, key, value):
+        """Returns a copy of the row with the value of key replaced."""
+        values = list(self._values)
+        values[self._layout.index[key]] = value
+        return FieldValues(self._layout, tuple(values))
+
+    def __eq__(self, other):
+        if isinstance(other, FieldValues):
+            other = dict(other.items())
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'FieldValues({!r})'.format(dict(self.items()))
+
+
+class ExtractedObservable(object):
+    """An observable extracted from a STIX package.
+
+    For compatibility with code written for the original :py:class:`dict`
+    representation, the attributes can also be read as keys, e.g.
+    ``observable['fields']``.
+
+    Args:
+        id: the observable ID
+        observable: the :py:class:`Observable<cybox.core.observable.Observable>`
+            object (None if the observables were loaded from a cache)
+        fields: a list of :py:class:`FieldValues` objects (None if the
+            transform has no OBJECT_FIELDS)
+    """
+
+    __slots__ = ('id', 'observable', 'fields')
+
+    def __init__(self, id, observable, fields):
+        self.id = id
+        self.observable = observable
+        self.fields = fields
+
+    def __getstate__(self):
+        return self.id, self.observable, self.fields
+
+    def __setstate__(self, state):
+        self.id, self.observable, self.fields = state
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def keys(self):
+        return list(self.__slots__)
+
+
+class PackageObservables(dict):
+    """The observables extracted from a STIX package, keyed by object type.
+
+    Each entry contains a list of :py:class:`ExtractedObservable` objects
+    (see :py:func:`StixTransform._observables_for_package`).
+
+    Attributes:
+        references: a list of the IDs referenced (using idref) by
+            observables in the package that have no ID of their own, in
+            the order they were found (without duplicates)
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(PackageObservables, self).__init__(*args, **kwargs)
+        self.references = []
+        self._reference_set = set()
+
+    def add_reference(self, idref):
+        """Records an ID referenced by an observable in the package."""
+        if idref not in self._reference_set:
+            self._reference_set.add(idref)
+            self.references.append(idref)
+
+
+class LazyObservables(object):
+    """A read-only mapping of extracted observables, keyed by object type.
+
+    The package's observables are grouped by object type when the mapping
+    is created, but the fields of each object type are only extracted the
+    first time observables of that type are requested. The contents match
+    the :py:class:`dict` returned by
+    :py:func:`StixTransform._observables_for_package` (object types
+    without any valid observables are not included).
+
+    Observables are normally deduplicated by ID within each object type.
+    If the same ID is found with more than one object type, all of the
+    observables are extracted straight away so the result doesn't depend
+    on the order the object types are requested in.
+
+    Args:
+        transform_class: the :py:class:`StixTransform` subclass used to
+            extract the observables
+        package: a :py:class:`stix:STIXPackage` object
+        object_types: a list of the object types to be extracted
+            (optional)
+        max_rows: the maximum number of rows extracted from a single
+            observable (optional)
+    """
+
+    def __init__(self, transform_class, package, object_types=None,
+                 max_rows=None):
+        self._transform_class = transform_class
+        self._max_rows = max_rows
+        self._extracted = dict()
+        self._pending = dict()
+
+        supported = transform_class.OBJECT_FIELDS
+        id_types = dict()
+        for observable in transform_class._package_observables(package):
+            id_ = observable.id_
+            if id_ is None:
+                continue
+            properties = transform_class._observable_properties(observable)
+            if not properties:
+                continue
+            object_type = properties.__class__.__name__
+            if ((supported and object_type not in supported) or
+                    (object_types and object_type not in object_types)):
+                continue
+            if id_types.setdefault(id_, object_type) != object_type:
+                self._extracted = transform_class._observables_for_package(
+                    package, object_types, max_rows,
+                )
+                self._pending = dict()
+                return
+            if object_type not in self._pending:
+                self._pending[object_type] = []
+            self._pending[object_type].append((observable, properties))
+
+    def _extract(self, object_type):
+        """Extracts the observables of an object type (if not yet done)."""
+        pending = self._pending.pop(object_type, None)
+        if pending is None:
+            return
+        observable_ids = set()
+        extracted = []
+        for observable, properties in pending:
+            if observable.id_ in observable_ids:
+                continue
+            observable = self._transform_class._extract_observable(
+                observable, object_type, properties, self._max_rows,
+            )
+            if observable is not None:
+                extracted.append(observable)
+                observable_ids.add(observable.id)
+        if extracted:
+            self._extracted[object_type] = extracted
+
+    def _extract_all(self):
+        for object_type in list(self._pending):
+            self._extract(object_type)
+
+    def __getitem__(self, object_type):
+        self._extract(object_type)
+        return self._extracted[object_type]
+
+    def get(self, object_type, default=None):
+        self._extract(object_type)
+        return self._extracted.get(object_type, default)
+
+    def __contains__(self, object_type):
+        self._extract(object_type)
+        return object_type in self._extracted
+
+    def __iter__(self):
+        self._extract_all()
+        return iter(self._extracted)
+
+    def __len__(self):
+        self._extract_all()
+        return len(self._extracted)
+
+    def __nonzero__(self):
+        if self._extracted:
+            return True
+        for object_type in list(self._pending):
+            self._extract(object_type)
+            if self._extracted:
+                return True
+        return False
+
+    def keys(self):
+        self._extract_all()
+        return self._extracted.keys()
+
+    def values(self):
+        self._extract_all()
+        return self._extracted.values()
+
+    def items(self):
+        self._extract_all()
+        return self._extracted.items()
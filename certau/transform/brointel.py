@@ -25,6 +25,12 @@ class StixBroIntelTransform(StixTextTransform):
         do_notice: a value to include in the output metadata field
             'meta.do_notice', if set to 'T' a Bro notice will be raised by Bro
             on a match of this indicator
+        observables: observables previously extracted from the package
+            (optional)
+        object_types: a list of the object types to be transformed
+            (optional)
+        max_observable_rows: the maximum number of rows extracted from a
+            single observable (optional)
     """
 
     OBJECT_FIELDS = {
@@ -87,9 +93,11 @@ class StixBroIntelTransform(StixTextTransform):
 
     def __init__(self, package, separator='\t',
                  include_header=False, header_prefix='#',
-                 source='UNKNOWN', url='', do_notice='T'):
+                 source='UNKNOWN', url='', do_notice='T', observables=None,
+                 object_types=None, max_observable_rows=None):
         super(StixBroIntelTransform, self).__init__(
-            package, separator, include_header, header_prefix,
+            package, separator, include_header, header_prefix, observables,
+            object_types, max_observable_rows,
         )
         self._source = source
         self._url = url
@@ -100,17 +108,22 @@ class StixBroIntelTransform(StixTextTransform):
     def _fix_uris(self):
         if 'URI' in self._observables:
             for observable in self._observables['URI']:
-                if 'fields' in observable:
-                    for field in observable['fields']:
-                        if 'value' in field:
-                            field['value'] = re.sub(
-                                pattern=r'^(https?|ftp)://',
-                                repl='',
-                                string=field['value'],
-                            )
-
-    def text_for_object_type(self, object_type):
-        text = ''
+                if observable.fields:
+                    observable.fields = [
+                        self._fix_uri(fields) for fields in observable.fields
+                    ]
+
+    @staticmethod
+    def _fix_uri(fields):
+        if 'value' not in fields:
+            return fields
+        return fields.replace('value', re.sub(
+            pattern=r'^(https?|ftp)://',
+            repl='',
+            string=fields['value'],
+        ))
+
+    def lines_for_object_type(self, object_type):
         if object_type in self._observables:
             for observable in self._observables[object_type]:
                 # Look up source and url from observable ID
@@ -135,5 +148,4 @@ class StixBroIntelTransform(StixTextTransform):
                                 '-',
                                 '-',
                             ]
-                            text += self.join(field_values) + '\n'
-        return text
+                            yield self.join(field_values) + '\n'
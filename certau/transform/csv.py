@@ -19,6 +19,12 @@ class StixCsvTransform(StixTextTransform):
         include_condition: a boolean value indicating whether or not the
             output should include additional fields containing the Cybox
             string matching condition (which may be empty)
+        observables: observables previously extracted from the package
+            (optional)
+        object_types: a list of the object types to be transformed
+            (optional)
+        max_observable_rows: the maximum number of rows extracted from a
+            single observable (optional)
     """
 
     OBJECT_FIELDS = {
@@ -78,9 +84,11 @@ class StixCsvTransform(StixTextTransform):
 
     def __init__(self, package, separator='|', include_header=True,
                  header_prefix='#', include_observable_id=True,
-                 include_condition=True):
+                 include_condition=True, observables=None,
+                 object_types=None, max_observable_rows=None):
         super(StixCsvTransform, self).__init__(
-            package, separator, include_header, header_prefix,
+            package, separator, include_header, header_prefix, observables,
+            object_types, max_observable_rows,
         )
         self._include_observable_id = include_observable_id
         self._include_condition = include_condition
@@ -136,15 +144,16 @@ class StixCsvTransform(StixTextTransform):
                     field_values.append(condition)
         return self.join(field_values)
 
-    def text_for_object_type(self, object_type):
-        text = ''
+    def lines_for_object_type(self, object_type):
         if object_type in self._observables:
+            lines = 0
             for observable in self._observables[object_type]:
                 id_ = observable['id']
                 for field in observable['fields']:
+                    line = self.text_for_fields(field, object_type) + '\n'
                     if self._include_observable_id:
-                        text += '{}{}'.format(id_, self._separator)
-                    text += self.text_for_fields(field, object_type) + '\n'
-        if text:
-            text += '\n'
-        return text
+                        line = '{}{}{}'.format(id_, self._separator, line)
+                    yield line
+                    lines += 1
+            if lines:
+                yield '\n'
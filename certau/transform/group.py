@@ -0,0 +1,177 @@
+import hashlib
+
+from .base import StixTransform, PackageObservables
+from .xpath import XPathExtractor
+
+
+# XPath extractors, keyed by the transform classes they read fields for
+_EXTRACTORS = dict()
+
+
+def _xpath_extractor(transform_classes):
+    """Returns the (shared) :py:class:`XPathExtractor
+    <certau.transform.xpath.XPathExtractor>` for some transform classes.
+
+    Each extractor is only compiled once per process, however many groups
+    (or copies of a group passed to worker processes) use it.
+    """
+    extractor = _EXTRACTORS.get(transform_classes)
+    if extractor is None:
+        extractor = XPathExtractor(transform_classes)
+        _EXTRACTORS[transform_classes] = extractor
+    return extractor
+
+
+class StixTransformGroup(object):
+    """Extracts observables from a STIX package once for several transforms.
+
+    The group can be used in place of a transform class when extracting
+    observables from a source (see
+    :py:func:`StixSource.next_extracted_package
+    <certau.source.StixSource.next_extracted_package>`), so each package
+    is parsed (and walked) once however many outputs are produced. The
+    observables extracted for each transform class then match those the
+    class would extract itself.
+
+    Args:
+        transform_classes: a list of :py:class:`StixTransform` subclasses
+        object_types: a list of the object types to be extracted
+            (optional - see :py:func:`StixTransform._observables_for_package`)
+        max_observable_rows: the maximum number of rows extracted from a
+            single observable (optional - overrides each transform class's
+            MAX_OBSERVABLE_ROWS)
+
+    Attributes:
+        transform_classes: a tuple of the transform classes
+        object_types: a sorted list of the object types to be extracted
+            (or None)
+        max_observable_rows: the maximum number of rows extracted from a
+            single observable (or None)
+        OBJECT_FIELDS: the union of the transform classes' OBJECT_FIELDS
+        REQUIRES_FULL_PACKAGE: True if any of the transform classes
+            requires the full package (see :py:class:`StixTransform`)
+    """
+
+    def __init__(self, transform_classes, object_types=None,
+                 max_observable_rows=None):
+        self.transform_classes = tuple(transform_classes)
+        self.object_types = sorted(object_types) if object_types else None
+        self.max_observable_rows = max_observable_rows
+        self.OBJECT_FIELDS = dict()
+        for transform_class in self.transform_classes:
+            for object_type, fields in transform_class.OBJECT_FIELDS.items():
+                union = self.OBJECT_FIELDS.setdefault(object_type, [])
+                union.extend(f for f in fields if f not in union)
+        self.REQUIRES_FULL_PACKAGE = any(
+            transform_class.REQUIRES_FULL_PACKAGE
+            for transform_class in self.transform_classes
+        )
+
+    def _extraction_fingerprint(self):
+        """Returns a string identifying what the group extracts."""
+        state = [transform_class._extraction_fingerprint()
+                 for transform_class in self.transform_classes]
+        state.extend(self.object_types or [])
+        if self.max_observable_rows:
+            state.append('rows={}'.format(self.max_observable_rows))
+        return hashlib.sha1(':'.join(state)).hexdigest()
+
+    def _observables_for_package(self, package):
+        """Extract observables from a STIX package for each transform class.
+
+        Each observable's object type and properties are determined once,
+        and observables with an object type that isn't in the union of the
+        OBJECT_FIELDS (when none of the classes supports all object types)
+        are skipped without being examined by each class.
+
+        Returns:
+            dict: the observables extracted for each transform class (see
+                :py:func:`StixTransform._observables_for_package`), keyed
+                by transform class
+        """
+        return self._observables_for_items(self._package_items(package))
+
+    def _observables_for_tree(self, root):
+        """Extract observables from a parsed STIX document for each
+        transform class, reading fields from the XML where possible.
+
+        The results are the same as those of
+        :py:func:`_observables_for_package` for the loaded package, except
+        that the observables don't reference python-stix objects (as when
+        read from a cache).
+
+        Args:
+            root: the root (STIX_Package) element of the document
+
+        Raises:
+            UnsupportedDocumentError: if the document can't be read using
+                XPath (see :py:class:`XPathExtractor
+                <certau.transform.xpath.XPathExtractor>`)
+        """
+        extractor = _xpath_extractor(self.transform_classes)
+        return self._detached_observables(
+            self._observables_for_items(extractor.package_items(root))
+        )
+
+    @staticmethod
+    def _package_items(package):
+        """Yields (observable, object type, properties) for the observables
+        in a package with an object with properties, and (observable, None,
+        None) for observables referencing another observable (using idref).
+        """
+        for observable in StixTransform._package_observables(package):
+            properties = StixTransform._observable_properties(observable)
+            if properties:
+                yield observable, properties.__class__.__name__, properties
+            elif observable.idref is not None:
+                yield observable, None, None
+
+    def _observables_for_items(self, items):
+        """Extract observables for each transform class.
+
+        Args:
+            items: an iterable of (observable, object type, properties)
+                tuples, in package order
+        """
+        results = dict()
+        observable_ids = dict()
+        for transform_class in self.transform_classes:
+            results[transform_class] = PackageObservables()
+            observable_ids[transform_class] = set()
+        all_types = not all(transform_class.OBJECT_FIELDS
+                            for transform_class in self.transform_classes)
+
+        for observable, object_type, properties in items:
+            id_ = observable.id_
+            if id_ is None:
+                if observable.idref is not None:
+                    for observables in results.values():
+                        observables.add_reference(observable.idref)
+                continue
+            if not all_types and object_type not in self.OBJECT_FIELDS:
+                continue
+            if self.object_types and object_type not in self.object_types:
+                continue
+            for transform_class in self.transform_classes:
+                if id_ in observable_ids[transform_class]:
+                    continue
+                extracted = transform_class._extract_observable(
+                    observable, object_type, properties,
+                    self.max_observable_rows,
+                )
+                if extracted is None:
+                    continue
+                observables = results[transform_class]
+                if object_type not in observables:
+                    observables[object_type] = []
+                observables[object_type].append(extracted)
+                observable_ids[transform_class].add(id_)
+        return results
+
+    def _detached_observables(self, observables):
+        """Returns a copy of extracted observables suitable for caching."""
+        return dict(
+            (transform_class,
+             transform_class._detached_observables(class_observables))
+            for transform_class, class_observables in observables.items()
+        )
@@ -28,6 +28,12 @@ class StixMispTransform(StixTransform):
         information: info field value (string) for the MISP event
         published: a boolean indicating whether the event has been
             published
+        observables: observables previously extracted from the package
+            (optional)
+        object_types: a list of the object types to be transformed
+            (optional)
+        max_observable_rows: the maximum number of rows extracted from a
+            single observable (optional)
     """
 
     OBJECT_FIELDS = {
@@ -77,8 +83,13 @@ class StixMispTransform(StixTransform):
                  threat_level=1,   # threat
                  analysis=2,       # analysis
                  information=None,
-                 published=False):
-        super(StixMispTransform, self).__init__(package)
+                 published=False,
+                 observables=None,
+                 object_types=None,
+                 max_observable_rows=None):
+        super(StixMispTransform, self).__init__(package, observables,
+                                                object_types,
+                                                max_observable_rows)
         self._misp = misp
         self._misp_distribution = distribution
         self._misp_threat_level = threat_level
@@ -16,14 +16,23 @@ class StixStatsTransform(StixTextTransform):
         pretty_text: a boolean that indicates whether or not the text
             should be made pretty by aligning the columns in
             the text output
+        observables: observables previously extracted from the package
+            (optional)
+        object_types: a list of the object types to be transformed
+            (optional)
+        max_observable_rows: the maximum number of rows extracted from a
+            single observable (optional)
     """
 
     LINE = '++++++++++++++++++++++++++++++++++++++++'
+    REQUIRES_FULL_PACKAGE = True
 
     def __init__(self, package, separator='\t', include_header=True,
-                 header_prefix='', pretty_text=True):
+                 header_prefix='', pretty_text=True, observables=None,
+                 object_types=None, max_observable_rows=None):
         super(StixStatsTransform, self).__init__(
-            package, separator, include_header, header_prefix,
+            package, separator, include_header, header_prefix, observables,
+            object_types, max_observable_rows,
         )
         self._pretty_text = pretty_text
 
@@ -120,16 +129,15 @@ class StixStatsTransform(StixTextTransform):
         header += '\n' + self.text_for_package_stats() + '\n'
         return header
 
-    def text_for_object_type(self, object_type):
+    def lines_for_object_type(self, object_type):
         if object_type in self._observables:
             count = len(self._observables[object_type])
         else:
             count = 0
         if self._pretty_text:
-            text = '{0:<35} {1:>4}\n'.format(
+            yield '{0:<35} {1:>4}\n'.format(
                 object_type + ' observables:',
                 count,
             )
         else:
-            text = self.join([object_type, count]) + '\n'
-        return text
+            yield self.join([object_type, count]) + '\n'
@@ -1,17 +1,57 @@
 from __future__ import absolute_import
 
-import contextlib
 import csv
-import StringIO
+import cStringIO
 
 from .base import StixTransform
 
 
+class RowSerializer(object):
+    """Formats rows of values as delimited text lines.
+
+    Each line matches that written by :py:class:`csv.writer` (with the
+    line terminator and surrounding whitespace stripped), so values
+    containing the separator, quotes or line breaks are quoted. Rows of
+    strings that don't need quoting are joined directly. Other rows are
+    written by a single csv writer (and buffer) that is reused for each
+    row.
+
+    Args:
+        separator: the delimiter between values
+    """
+
+    def __init__(self, separator):
+        self._separator = separator
+        self._buffer = cStringIO.StringIO()
+        self._writer = csv.writer(self._buffer, delimiter=separator)
+
+    def join(self, values):
+        """Returns a line (without a line terminator) for a row."""
+        try:
+            line = self._separator.join(values)
+        except TypeError:
+            # Values that aren't strings are converted by the csv writer
+            line = None
+        if (type(line) is str and
+                line.count(self._separator) == len(values) - 1 and
+                '"' not in line and '\n' not in line and '\r' not in line and
+                (line or len(values) > 1)):
+            return line.strip()
+
+        self._writer.writerow(values)
+        line = self._buffer.getvalue()
+        self._buffer.reset()
+        self._buffer.truncate()
+        return line.strip()
+
+
 class StixTextTransform(StixTransform):
     """A transform for converting a STIX package to simple text.
 
-    This class and its subclasses implement the :py:func:`text` class method
-    which returns a string representation of the STIX package.
+    This class and its subclasses implement the :py:func:`iter_lines`
+    method, which generates a text representation of the STIX package a
+    line at a time. The text can be written to a file as it is generated
+    (see :py:func:`write`), or returned as a string (see :py:func:`text`).
     The entire text output may optionally be preceded by a header string.
     Typically, each line of the output will contain details for a particular
     Cybox observable.
@@ -25,6 +65,12 @@ class StixTextTransform(StixTransform):
         include_header: a boolean value indicating whether
             or not headers should be included in the output
         header_prefix: a string prepended to each header row
+        observables: observables previously extracted from the package
+            (optional)
+        object_types: a list of the object types to be transformed
+            (optional)
+        max_observable_rows: the maximum number of rows extracted from a
+            single observable (optional)
 
     Attributes:
         HEADER_LABELS: a list of field names that are printed by the
@@ -39,17 +85,35 @@ class StixTextTransform(StixTransform):
     OBJECT_HEADER_LABELS = {}
 
     def __init__(self, package, separator='|',
-                 include_header=True, header_prefix='#'):
-        super(StixTextTransform, self).__init__(package)
+                 include_header=True, header_prefix='#', observables=None,
+                 object_types=None, max_observable_rows=None):
+        super(StixTextTransform, self).__init__(package, observables,
+                                                object_types,
+                                                max_observable_rows)
         self._separator = separator
         self._include_header = include_header
         self._header_prefix = header_prefix
+        self._rows = RowSerializer(separator)
 
     def join(self, items):
         """str.join, but with quoting when the items contain delimiters."""
-        with contextlib.closing(StringIO.StringIO()) as sio:
-            csv.writer(sio, delimiter=self._separator).writerow(items)
-            return sio.getvalue().strip()
+        return self._rows.join(items)
+
+    @classmethod
+    def _overrides(cls, name, other):
+        """Returns True if the method name is defined by a more derived
+        class than the method other.
+
+        Subclasses written before the lines_for_* methods were added
+        override text_for_object_type or text_for_observable instead, so
+        those methods are used when they are overridden.
+        """
+        for klass in cls.__mro__:
+            if name in klass.__dict__:
+                return other not in klass.__dict__
+            elif other in klass.__dict__:
+                return False
+        return False
 
     def header(self):
         """Returns a header string to display with transform."""
@@ -80,33 +144,85 @@ class StixTextTransform(StixTransform):
                 field_values.append(field_value)
         return self.join(field_values)
 
+    def lines_for_observable(self, observable, object_type):
+        """Yields the lines representing the given observable."""
+        for field in observable['fields']:
+            yield self.text_for_fields(field, object_type) + '\n'
+
     def text_for_observable(self, observable, object_type):
         """Returns a string representing the given observable."""
-        text = ''
-        for field in observable['fields']:
-            text += self.text_for_fields(field, object_type) + '\n'
-        return text
+        return ''.join(self.lines_for_observable(observable, object_type))
+
+    def lines_for_object_type(self, object_type):
+        """Yields the lines representing observables of the given type.
+
+        Each line ends with a newline. Nothing is yielded if there is no
+        text for the object type.
+        """
+        if object_type not in self._observables:
+            return
+        if self._overrides('text_for_observable', 'lines_for_observable'):
+            for observable in self._observables[object_type]:
+                text = self.text_for_observable(observable, object_type)
+                if text:
+                    yield text
+            return
+        for observable in self._observables[object_type]:
+            for line in self.lines_for_observable(observable, object_type):
+                yield line
 
     def text_for_object_type(self, object_type):
         """Returns a string representing observables of the given type."""
-        text = ''
-        if object_type in self._observables:
-            for observable in self._observables[object_type]:
-                text += self.text_for_observable(observable, object_type)
-        return text
+        return ''.join(self.lines_for_object_type(object_type))
 
-    def text(self):
-        """Returns a string representation of the STIX package."""
-        text = self.header() if self._include_header else ''
+    def iter_lines(self):
+        """Yields the text representation of the STIX package.
+
+        Each item yielded is one or more complete lines (headers may span
+        several lines), so the text can be written out as it is generated.
+        When a subclass overrides :py:func:`text_for_object_type`, the
+        text for each object type is yielded as a single item.
+        """
+        if self._include_header:
+            header = self.header()
+            if header:
+                yield header
 
         if self.OBJECT_FIELDS:
             object_types = self.OBJECT_FIELDS.keys()
         else:
             object_types = self._observables.keys()
+        use_text = self._overrides('text_for_object_type',
+                                   'lines_for_object_type')
         for object_type in sorted(object_types):
-            object_text = self.text_for_object_type(object_type)
-            if object_text:
-                if self._include_header:
-                    text += self.header_for_object_type(object_type)
-                text += object_text
-        return text
+            if use_text:
+                text = self.text_for_object_type(object_type)
+                lines = iter([text] if text else [])
+            else:
+                lines = self.lines_for_object_type(object_type)
+            # Object type headers are only included before some text
+            first = next(lines, None)
+            if first is None:
+                continue
+            if self._include_header:
+                header = self.header_for_object_type(object_type)
+                if header:
+                    yield header
+            yield first
+            for line in lines:
+                yield line
+
+    def write(self, fileobj):
+        """Writes the text representation of the STIX package to a file.
+
+        The text is written as it is generated, rather than being built as
+        a single string.
+
+        Args:
+            fileobj: a file (or file-like) object open for writing
+        """
+        fileobj.writelines(self.iter_lines())
+
+    def text(self):
+        """Returns a string representation of the STIX package."""
+        return ''.join(self.iter_lines())
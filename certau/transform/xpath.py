@@ -0,0 +1,439 @@
+"""Extraction of observables directly from the XML of a STIX package.
+
+Loading a package with python-stix builds a Python object for almost every
+element in the document, which accounts for most of the time taken to
+transform a package. For the object types and fields listed in
+:py:data:`XPATH_FIELDS`, :py:class:`XPathExtractor` reads the field values
+(and their condition attributes) straight from the lxml tree using
+precompiled XPath expressions. The values are passed to the same code that
+builds rows from python-stix objects, so the extracted observables are
+identical.
+
+Any observable that can't be read exactly as python-stix would read it (an
+unsupported object type, a property with pattern attributes or a list
+value, a hash without a type, etc.) is converted to a python-stix object as
+usual, and documents whose structure isn't understood are loaded in full.
+"""
+
+from cybox.bindings import cybox_core as cybox_core_binding
+from cybox.bindings import find_attr_value_
+from cybox.common import DEFAULT_DELIM, VocabString
+from cybox.core import Observable
+from cybox.utils import get_class_for_object_type
+from lxml import etree
+
+from .base import StixTransform
+
+
+XSI_TYPE = '{http://www.w3.org/2001/XMLSchema-instance}type'
+
+
+class UnsupportedDocumentError(Exception):
+    """Raised when observables can't be read directly from a document."""
+    pass
+
+
+class _Unsupported(Exception):
+    """Raised when an observable can't be read directly from the XML."""
+    pass
+
+
+_XPATHS = dict()
+
+
+def _children(name):
+    """Returns a compiled XPath selecting child elements by local name.
+
+    Elements are matched by local name (ignoring their namespace) as they
+    are by the python-stix and python-cybox bindings. Each XPath is only
+    compiled once.
+    """
+    xpath = _XPATHS.get(name)
+    if xpath is None:
+        xpath = etree.XPath('*[local-name()="{}"]'.format(name))
+        _XPATHS[name] = xpath
+    return xpath
+
+
+def _type_name(type_name):
+    """Returns the type name from an xsi:type, as read by the bindings."""
+    type_names = type_name.split(':')
+    return type_names[0] if len(type_names) == 1 else type_names[1]
+
+
+def _last(elements):
+    """Returns the last of a list of elements (or None).
+
+    Where an element that may only appear once is repeated, the bindings
+    keep the last one.
+    """
+    return elements[-1] if elements else None
+
+
+# Kinds of field
+_ATTRIBUTE = 'attribute'    # an XML attribute (a plain string)
+_PROPERTY = 'property'      # an object property element
+_HASH_TYPE = 'hash type'    # a hash type (set by python-cybox if missing)
+_ENTITY = 'entity'          # an element containing fields
+_EMAIL = 'email'            # an e-mail address
+_LIST = 'list'              # a container of elements containing fields
+_EMAIL_LIST = 'email list'  # a list of e-mail addresses
+
+_ADDRESS_FIELDS = {
+    # The bindings use the schema's default category
+    'category': (_ATTRIBUTE, ('category', 'ipv4-addr'), None),
+    'address_value': (_PROPERTY, 'Address_Value', None),
+}
+
+#: The fields of each object type that can be read from the XML. Each entry
+#: maps a field name to a (kind, element name, child fields) tuple. Element
+#: names are separated by '/' for lists, giving the container element and
+#: the list items. Attributes are given as an (attribute name, default
+#: value) tuple instead of an element name.
+XPATH_FIELDS = {
+    'Address': _ADDRESS_FIELDS,
+    'DomainName': {
+        'type_': (_ATTRIBUTE, ('type', None), None),
+        'value': (_PROPERTY, 'Value', None),
+    },
+    'EmailMessage': {
+        'header': (_ENTITY, 'Header', {
+            'from_': (_EMAIL, 'From', _ADDRESS_FIELDS),
+            'to': (_EMAIL_LIST, 'To/Recipient', _ADDRESS_FIELDS),
+            'subject': (_PROPERTY, 'Subject', None),
+        }),
+        'attachments': (_LIST, 'Attachments/File', {
+            'object_reference': (_ATTRIBUTE, ('object_reference', None), None),
+        }),
+    },
+    'File': {
+        'file_name': (_PROPERTY, 'File_Name', None),
+        'hashes': (_LIST, 'Hashes/Hash', {
+            'type_': (_HASH_TYPE, 'Type', None),
+            'simple_hash_value': (_PROPERTY, 'Simple_Hash_Value', None),
+        }),
+    },
+    'URI': {
+        'type_': (_ATTRIBUTE, ('type', None), None),
+        'value': (_PROPERTY, 'Value', None),
+    },
+}
+
+#: The xsi:type (without the prefix) of the object types in XPATH_FIELDS
+XPATH_OBJECT_TYPES = dict(
+    (klass._XSI_TYPE, klass.__name__)
+    for klass in [get_class_for_object_type(xsi_type) for xsi_type in (
+        'AddressObjectType',
+        'DomainNameObjectType',
+        'EmailMessageObjectType',
+        'FileObjectType',
+        'URIObjectType',
+    )]
+)
+
+_OBSERVABLES = _children('Observables')
+_INDICATORS = _children('Indicators')
+_INDICATOR = _children('Indicator')
+_OBSERVABLE = _children('Observable')
+_COMPOSITION = _children('Observable_Composition')
+_OBJECT = _children('Object')
+_PROPERTIES = _children('Properties')
+_SIMPLE_HASH_VALUE = _children('Simple_Hash_Value')
+
+
+class ElementObservable(object):
+    """Stands in for an observable whose fields were read from the XML.
+
+    Attributes:
+        id_: the observable's id
+        idref: the id of the observable referenced (or None)
+    """
+
+    __slots__ = ('id_', 'idref')
+
+    def __init__(self, id_, idref=None):
+        self.id_ = id_
+        self.idref = idref
+
+
+class ElementProperties(object):
+    """The fields of an object (or part of one) read from the XML.
+
+    Fields are stored as attributes named as for the python-cybox object.
+    """
+    pass
+
+
+class PropertyValue(object):
+    """An object property value read from the XML.
+
+    Attributes:
+        value: the element's text
+        condition: the element's condition attribute (or None)
+    """
+
+    __slots__ = ('value', 'condition')
+
+    def __init__(self, value, condition=None):
+        self.value = value
+        self.condition = condition
+
+
+class XPathExtractor(object):
+    """Reads the observables in a parsed STIX document using XPath.
+
+    Observables are found in the same places, and in the same order, as
+    by :py:func:`StixTransform._package_observables
+    <certau.transform.StixTransform._package_observables>`. The fields of
+    an object type are read from the XML if all of the fields used by the
+    transform classes (including constraint fields) are listed in
+    :py:data:`XPATH_FIELDS`.
+
+    Args:
+        transform_classes: the :py:class:`StixTransform
+            <certau.transform.StixTransform>` subclasses whose fields will
+            be extracted
+
+    Attributes:
+        object_types: a sorted list of the object types read from the XML
+    """
+
+    def __init__(self, transform_classes):
+        self._accessors = dict()
+        for object_type, spec in XPATH_FIELDS.items():
+            fields = set()
+            for transform_class in transform_classes:
+                fields.update(transform_class.OBJECT_FIELDS.get(
+                    object_type, []))
+                fields.update(transform_class.OBJECT_CONSTRAINTS.get(
+                    object_type, dict()))
+            try:
+                self._accessors[object_type] = self._compile(spec, fields)
+            except KeyError:
+                # Not all of the fields can be read from the XML
+                pass
+        self.object_types = sorted(self._accessors)
+        self._vocab_classes = dict()
+
+    @classmethod
+    def _compile(cls, spec, fields):
+        """Returns the accessors for reading fields from an element.
+
+        Each accessor is a (name, kind, XPath or (attribute name, default
+        value), XPath for list items, child accessors) tuple. Only the
+        fields needed are read.
+
+        Raises:
+            KeyError: if a field can't be read from the XML
+        """
+        accessors = []
+        names = set(field.split('.')[0] for field in fields)
+        for name in sorted(names):
+            kind, path, child_spec = spec[name]
+            child_fields = [field[len(name) + 1:] for field in fields
+                            if field.startswith(name + '.')]
+            if child_spec is None:
+                if child_fields:
+                    raise KeyError(name)
+                child = None
+            else:
+                if name in fields:
+                    # The value would be a python-cybox object
+                    raise KeyError(name)
+                child = cls._compile(child_spec, child_fields)
+
+            if kind == _ATTRIBUTE:
+                accessors.append((name, kind, path, None, child))
+            elif kind in (_LIST, _EMAIL_LIST):
+                container, item = path.split('/')
+                accessors.append((name, kind, _children(container),
+                                  _children(item), child))
+            else:
+                accessors.append((name, kind, _children(path), None, child))
+        return accessors
+
+    def package_items(self, root):
+        """Yields the observables (other than compositions) in a document.
+
+        Args:
+            root: the root (STIX_Package) element of the document
+
+        Yields:
+            tuple: an (observable, object type, properties) tuple for each
+                observable with an object with properties. The observable
+                and properties are an :py:class:`ElementObservable` and
+                :py:class:`ElementProperties` if read from the XML,
+                otherwise python-cybox objects. An (observable, None, None)
+                tuple is yielded for each observable without an id that
+                references another observable (using idref).
+
+        Raises:
+            UnsupportedDocumentError: if the document can't be read using
+                XPath (it should be loaded with python-stix instead)
+        """
+        sources = []
+        observables = _last(_OBSERVABLES(root))
+        if observables is not None:
+            sources.append(_OBSERVABLE(observables))
+        indicators = _last(_INDICATORS(root))
+        if indicators is not None:
+            for indicator in _INDICATOR(indicators):
+                observable = self._indicator_observable(indicator)
+                if observable is not None:
+                    sources.append([observable])
+
+        stack = [iter(source) for source in reversed(sources)]
+        while stack:
+            element = next(stack[-1], None)
+            if element is None:
+                stack.pop()
+                continue
+            composition = _last(_COMPOSITION(element))
+            if composition is not None:
+                stack.append(iter(_OBSERVABLE(composition)))
+                continue
+            item = self._observable_item(element)
+            if item is not None:
+                yield item
+
+    @staticmethod
+    def _indicator_observable(element):
+        """Returns an indicator's observable element (or None)."""
+        type_name = element.get(XSI_TYPE)
+        if type_name is None:
+            type_name = element.get('type')
+        if type_name is None:
+            # Read by python-stix as a base indicator (with no observable)
+            return None
+        elif _type_name(type_name) != 'IndicatorType':
+            raise UnsupportedDocumentError(
+                'unsupported indicator type {}'.format(type_name))
+        return _last(_OBSERVABLE(element))
+
+    def _observable_item(self, element):
+        """Returns the (observable, object type, properties) for an
+        observable element, or None if it has no id or object properties.
+
+        An observable without an id that references another observable is
+        returned as (observable, None, None).
+        """
+        if element.get('id') is None:
+            idref = element.get('idref')
+            if idref is None:
+                return None
+            return ElementObservable(None, idref), None, None
+        object_ = _last(_OBJECT(element))
+        if object_ is None:
+            return None
+        properties = _last(_PROPERTIES(object_))
+        if properties is None:
+            return None
+
+        xsi_type = find_attr_value_('xsi:type', properties)
+        object_type = None
+        if (xsi_type is not None and xsi_type == properties.get(XSI_TYPE) and
+                xsi_type.count(':') == 1):
+            object_type = XPATH_OBJECT_TYPES.get(_type_name(xsi_type))
+        accessors = self._accessors.get(object_type)
+        if accessors is not None:
+            try:
+                return (
+                    ElementObservable(element.get('id')),
+                    object_type,
+                    self._read_entity(properties, accessors),
+                )
+            except _Unsupported:
+                pass
+
+        observable = self._observable_for_element(element)
+        properties = StixTransform._observable_properties(observable)
+        if not properties:
+            return None
+        return observable, properties.__class__.__name__, properties
+
+    @staticmethod
+    def _observable_for_element(element):
+        obj = cybox_core_binding.ObservableType.factory()
+        obj.build(element)
+        return Observable.from_obj(obj)
+
+    def _read_entity(self, element, accessors):
+        """Returns the :py:class:`ElementProperties` read from an element.
+
+        Raises:
+            _Unsupported: if a value can't be read exactly as python-cybox
+                would read it
+        """
+        entity = ElementProperties()
+        for name, kind, path, item_path, child in accessors:
+            if kind == _ATTRIBUTE:
+                value = element.get(*path)
+            elif kind in (_LIST, _EMAIL_LIST):
+                container = _last(path(element))
+                if container is None:
+                    value = None
+                else:
+                    items = item_path(container)
+                    if kind == _EMAIL_LIST:
+                        self._check_email_addresses(items)
+                    value = [self._read_entity(item, child)
+                             for item in items]
+            else:
+                value_element = _last(path(element))
+                if value_element is None:
+                    if kind == _HASH_TYPE and _SIMPLE_HASH_VALUE(element):
+                        # The type is set from the hash value's length
+                        raise _Unsupported()
+                    value = None
+                elif kind in (_ENTITY, _EMAIL):
+                    if kind == _EMAIL:
+                        self._check_email_addresses([value_element])
+                    value = self._read_entity(value_element, child)
+                elif kind == _PROPERTY:
+                    value = self._property_value(value_element)
+                else:
+                    value = self._vocab_value(value_element)
+            setattr(entity, name, value)
+        return entity
+
+    @staticmethod
+    def _check_email_addresses(elements):
+        """Raises _Unsupported if an address isn't an e-mail address.
+
+        python-cybox raises an error (as the category defaults to
+        'ipv4-addr') when an address without the e-mail category is used
+        as an e-mail address.
+        """
+        for element in elements:
+            if element.get('category', 'ipv4-addr') != 'e-mail':
+                raise _Unsupported()
+
+    @staticmethod
+    def _property_value(element, attributes=('condition',)):
+        """Returns the :py:class:`PropertyValue` of a property element."""
+        text = element.text
+        if (text is None or len(element) or
+                any(key not in attributes for key in element.attrib)):
+            # Pattern attributes, nested elements, comments, etc.
+            raise _Unsupported()
+        elif DEFAULT_DELIM in text or (text.startswith('<![CDATA[') and
+                                       text.endswith(']]>')):
+            # A list value (or CDATA that python-cybox would remove)
+            raise _Unsupported()
+        return PropertyValue(text, element.get('condition'))
+
+    def _vocab_value(self, element):
+        """Returns the :py:class:`PropertyValue` of a vocabulary element."""
+        value = self._property_value(element, ('condition', XSI_TYPE))
+        xsi_type = find_attr_value_('xsi:type', element)
+        if xsi_type != element.get(XSI_TYPE):
+            raise _Unsupported()
+        vocab_class = self._vocab_classes.get(xsi_type)
+        if vocab_class is None:
+            vocab_class = VocabString.lookup_class(xsi_type)
+            self._vocab_classes[xsi_type] = vocab_class
+        allowed = vocab_class._ALLOWED_VALUES
+        if allowed and value.value not in allowed:
+            # python-cybox raises an error
+            raise _Unsupported()
+        return value
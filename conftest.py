@@ -1,8 +1,22 @@
 """Test setup."""
+import random
+
 import pytest
 import stix
 import StringIO
 
+from cybox.core import Observable, ObservableComposition
+from cybox.objects.address_object import Address
+from cybox.objects.domain_name_object import DomainName
+from cybox.objects.email_message_object import EmailMessage
+from cybox.objects.file_object import File
+from cybox.objects.uri_object import URI
+from cybox.objects.win_registry_key_object import (
+    WinRegistryKey, RegistryValue, RegistryValues,
+)
+from stix.core import STIXPackage, STIXHeader
+from stix.indicator import Indicator
+
 
 @pytest.fixture(scope="module")
 def package():
@@ -14,3 +28,101 @@ def package():
     with open('tests/CA-TEST-STIX.xml', 'rb') as stix_f:
         stix_io = StringIO.StringIO(stix_f.read())
         return stix.core.STIXPackage.from_xml(stix_io)
+
+
+def _address(i):
+    return Address('10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255),
+                   Address.CAT_IPV4)
+
+
+def _domain(i):
+    domain = DomainName()
+    domain.value = 'host{}.example.com'.format(i)
+    return domain
+
+
+def _email(i):
+    email = EmailMessage()
+    email.from_ = 'sender{}@example.com'.format(i)
+    email.to = ['recipient{}.{}@example.com'.format(i, j) for j in range(3)]
+    email.subject = 'Subject {}'.format(i)
+    return email
+
+
+def _file(i):
+    file_ = File()
+    file_.file_name = 'file{}.exe'.format(i)
+    file_.add_hash('{:032x}'.format(i))
+    file_.add_hash('{:064x}'.format(i))
+    return file_
+
+
+def _registry_key(i):
+    key = WinRegistryKey()
+    key.hive = 'HKEY_CURRENT_USER'
+    key.key = '\\Software\\Example{}'.format(i)
+    key.values = RegistryValues()
+    for j in range(2):
+        value = RegistryValue()
+        value.name = 'value{}'.format(j)
+        value.data = 'data{}.{}'.format(i, j)
+        key.values.append(value)
+    return key
+
+
+def _uri(i):
+    return URI('http://host{}.example.com/path'.format(i), URI.TYPE_URL)
+
+
+OBJECT_FACTORIES = [_address, _domain, _email, _file, _registry_key, _uri]
+
+
+def make_package(count, indicator_share=0.25, composition_share=0.1,
+                 seed=0):
+    """Build a STIX package containing count observables (also used by
+    the benchmarks).
+
+    Observables cycle through several object types (including list-valued
+    fields). Some are placed in indicators and some in (nested) observable
+    compositions, and a few are repeated, as in real feeds.
+    """
+    rng = random.Random(seed)
+    package = STIXPackage()
+    package.stix_header = STIXHeader(title='Generated package')
+    observables = []
+    for i in range(count):
+        factory = OBJECT_FACTORIES[i % len(OBJECT_FACTORIES)]
+        observable = Observable(factory(i))
+        observable.id_ = 'example:Observable-{}'.format(i)
+        observables.append(observable)
+
+    indicator = None
+    composition = None
+    for observable in observables:
+        choice = rng.random()
+        if choice < indicator_share:
+            if indicator is None or len(indicator.observables) >= 100:
+                indicator = Indicator()
+                package.add_indicator(indicator)
+            indicator.add_observable(observable)
+        elif choice < indicator_share + composition_share:
+            if composition is None or len(composition.observables) >= 10:
+                composition = ObservableComposition(operator='OR')
+                parent = Observable()
+                parent.observable_composition = composition
+                package.add_observable(parent)
+            composition.add(observable)
+        else:
+            package.add_observable(observable)
+            if choice > 0.99:
+                # An occasional repeated observable
+                package.add_observable(observable)
+    return package
+
+
+@pytest.fixture(scope="module")
+def generated_package():
+    """Create a 'generated_package' fixture: a package built by
+    :py:func:`make_package` with 300 observables.
+    """
+    return make_package(300)
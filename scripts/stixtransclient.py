@@ -4,17 +4,33 @@ into the Bro Intelligence Format. It can interact with a TAXII server to obtain
 the STIX package(s), or a STIX package file can be supplied.
 """
 
+import os
+import re
 import sys
 import logging
+import ConfigParser
 from StringIO import StringIO
 
 import configargparse
 from stix.core import STIXPackage
 
-from certau.source import StixFileSource, SimpleTaxiiClient
+from certau.source import StixFileSource, StixStreamSource
+from certau.source import SimpleTaxiiClient, StixMultiSource
+from certau.cache import ObservableCache, UpgradeCache
+from certau.dedup import PackageDeduplicator
+from certau.index import ObservableIndex
 from certau.transform import StixTextTransform, StixStatsTransform
 from certau.transform import StixCsvTransform, StixBroIntelTransform
-from certau.transform import StixMispTransform
+from certau.transform import StixMispTransform, StixTransformGroup
+
+
+# Buffer size for text output files (and stdout)
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+
+def _object_types(value):
+    """Parse a comma separated list of object types."""
+    return [type_.strip() for type_ in value.split(',') if type_.strip()]
 
 
 def get_arg_parser():
@@ -42,6 +58,43 @@ def get_arg_parser():
         action="store_true",
         help="enable debug output",
     )
+    global_group.add_argument(
+        "--upgrade-cache",
+        help=("cache file used to store documents updated from older " +
+              "STIX versions, so each is only updated once (see " +
+              "stixupgrade.py)"),
+    )
+    global_group.add_argument(
+        "--dedup",
+        metavar="STATE_FILE",
+        help=("skip packages (identified by id and timestamp) that have " +
+              "already been processed, from any source, recording them " +
+              "in the given state file"),
+    )
+    global_group.add_argument(
+        "--dedup-capacity",
+        default=1000000,
+        type=int,
+        help=("number of packages remembered by each of the two " +
+              "generations of the dedup filter - default: 1000000"),
+    )
+    global_group.add_argument(
+        "--resolve-idrefs",
+        nargs="?",
+        const="",
+        metavar="INDEX_FILE",
+        help=("output the observables referenced (by idref) from other " +
+              "packages, using an index of the observables processed, " +
+              "kept in memory or in the given index file (so observables " +
+              "from previous runs are also found). The in-memory index " +
+              "isn't limited in size"),
+    )
+    global_group.add_argument(
+        "--index-size",
+        default=512,
+        type=int,
+        help="maximum size of the index file in MB - default: 512",
+    )
     # Source options
     source_group = parser.add_argument_group('input (source) options')
     source_ex_group = source_group.add_mutually_exclusive_group(
@@ -58,31 +111,47 @@ def get_arg_parser():
         help="poll TAXII server to obtain STIX packages",
     )
     # Output (transform) options
-    output_group = parser.add_argument_group('output (transform) options')
-    output_ex_group = output_group.add_mutually_exclusive_group(
-        required=True,
-    )
-    output_ex_group.add_argument(
+    output_group = parser.add_argument_group(
+        title='output (transform) options',
+        description=("Several of --stats, --text, --bro and --misp may be " +
+                     "given, in which case each package is read once and " +
+                     "each output is produced from it. Text outputs are " +
+                     "written to stdout unless a file is given."),
+    )
+    output_group.add_argument(
         "-s", "--stats",
-        action="store_true",
+        nargs="?",
+        const="-",
+        metavar="FILE",
         help="display summary statistics for each STIX package",
     )
-    output_ex_group.add_argument(
+    output_group.add_argument(
         "-t", "--text",
-        action="store_true",
+        nargs="?",
+        const="-",
+        metavar="FILE",
         help="output observables in delimited text",
     )
-    output_ex_group.add_argument(
+    output_group.add_argument(
         "-b", "--bro",
-        action="store_true",
+        nargs="?",
+        const="-",
+        metavar="FILE",
         help="output observables in Bro intel framework format",
     )
-    output_ex_group.add_argument(
+    output_group.add_argument(
         "-m", "--misp",
         action="store_true",
         help="feed output to a MISP server",
     )
-    output_ex_group.add_argument(
+    output_group.add_argument(
+        "--types",
+        type=_object_types,
+        metavar="TYPES",
+        help=("comma separated list of the object types to output " +
+              "(e.g. Address,DomainName) - default: all supported types"),
+    )
+    output_group.add_argument(
         "-x", "--xml_output",
         help=("output XML STIX packages to the given directory " +
               "(use with --taxii)"),
@@ -96,6 +165,43 @@ def get_arg_parser():
         action="store_true",
         help="recurse subdirectories when processing files.",
     )
+    file_group.add_argument(
+        "--workers",
+        type=int,
+        help=("number of processes used to load files and extract " +
+              "observables in parallel (not supported with --stream)"),
+    )
+    file_group.add_argument(
+        "--stream",
+        action="store_true",
+        help=("read large files (or TAXII poll responses) incrementally, " +
+              "processing observables and indicators in batches"),
+    )
+    file_group.add_argument(
+        "--xpath-extract",
+        action="store_true",
+        help=("read observables directly from the XML where possible, " +
+              "rather than loading each package with python-stix " +
+              "(faster, with identical output - not supported with " +
+              "--stream or --taxii)"),
+    )
+    file_group.add_argument(
+        "--cache",
+        help=("cache file used to store observables extracted from " +
+              "files, so unchanged files are not processed again"),
+    )
+    file_group.add_argument(
+        "--cache-size",
+        default=512,
+        type=int,
+        help="maximum size of each cache in MB - default: 512",
+    )
+    file_group.add_argument(
+        "--incremental",
+        metavar="STATE_FILE",
+        help=("only process files that are new or have changed since " +
+              "they were recorded in the given state file"),
+    )
     # TAXII source options
     taxii_group = parser.add_argument_group(
         title='taxii input arguments (use with --taxii)',
@@ -155,6 +261,30 @@ def get_arg_parser():
         "--subscription-id",
         help="a subscription ID for the poll request",
     )
+    taxii_group.add_argument(
+        "--keep-alive",
+        action="store_true",
+        help="reuse connections to the TAXII server between requests",
+    )
+    taxii_group.add_argument(
+        "--taxii-collections",
+        help=("file defining several collections to poll, with one " +
+              "section per collection (values not given in a section " +
+              "are taken from the options above)"),
+    )
+    taxii_group.add_argument(
+        "--poll-threads",
+        default=4,
+        type=int,
+        help=("maximum number of collections polled at the same time " +
+              "(use with --taxii-collections) - default: 4"),
+    )
+    taxii_group.add_argument(
+        "--poll-state",
+        help=("directory used to record the end timestamp of the last " +
+              "successful poll of each collection, which is then used " +
+              "as the begin timestamp for the next poll"),
+    )
     other_group = parser.add_argument_group(
         title='other output options',
     )
@@ -184,6 +314,34 @@ def get_arg_parser():
         "--base-url",
         help="base URL for indicator source - use with --bro or --misp",
     )
+    other_group.add_argument(
+        "--max-observable-rows",
+        type=int,
+        help=("maximum number of rows (sets of field values) to extract " +
+              "from a single observable, limiting the combinations " +
+              "produced by fields containing lists"),
+    )
+    xml_group = parser.add_argument_group(
+        title='xml output arguments (use with --xml_output)',
+    )
+    xml_group.add_argument(
+        "--xml-compress",
+        choices=['gzip', 'zstd'],
+        help=("compress saved content blocks (zstd requires the " +
+              "zstandard package)"),
+    )
+    xml_group.add_argument(
+        "--xml-dedup",
+        action="store_true",
+        help=("name saved content blocks by a hash of their content and " +
+              "skip blocks that have already been saved"),
+    )
+    xml_group.add_argument(
+        "--xml-threads",
+        default=1,
+        type=int,
+        help="number of threads used to save content blocks - default: 1",
+    )
     misp_group = parser.add_argument_group(
         title='misp output arguments (use with --misp)',
     )
@@ -227,18 +385,166 @@ def get_arg_parser():
     return parser
 
 
-def _process_package(package, transform_class, transform_kwargs):
+def _process_package(package, transform_class, transform_kwargs,
+                     output=None, observables=None):
     """Loads a STIX package and runs a transform over it."""
-    transform = transform_class(package, **transform_kwargs)
+    transform = transform_class(package, observables=observables,
+                                **transform_kwargs)
     if isinstance(transform, StixTextTransform):
-        sys.stdout.write(transform.text())
+        transform.write(output or sys.stdout)
     elif isinstance(transform, StixMispTransform):
         transform.publish()
 
 
+def _output_file(value):
+    """Output file for a text output option ('-' for stdout, or None).
+
+    Configuration files enable an output with a boolean value (e.g.
+    'bro: true'), which is passed on as the option's value.
+    """
+    if not value or value.lower() in ('false', 'no', '0'):
+        return None
+    elif value.lower() in ('true', 'yes', '1'):
+        return '-'
+    return value
+
+
+def _outputs(options):
+    """Determine the outputs requested in the options.
+
+    Returns a list of (transform class, transform kwargs, output file)
+    tuples, where output file is the file name for text outputs ('-' for
+    stdout) or None.
+    """
+    text_kwargs = {}
+    if options.types:
+        text_kwargs['object_types'] = options.types
+    if options.max_observable_rows:
+        text_kwargs['max_observable_rows'] = options.max_observable_rows
+    if options.header:
+        text_kwargs['include_header'] = options.header
+
+    outputs = []
+    if _output_file(options.stats):
+        outputs.append((StixStatsTransform, text_kwargs,
+                        _output_file(options.stats)))
+    if _output_file(options.text):
+        csv_kwargs = dict(text_kwargs)
+        if options.field_separator:
+            csv_kwargs['separator'] = options.field_separator
+        outputs.append((StixCsvTransform, csv_kwargs,
+                        _output_file(options.text)))
+    if _output_file(options.bro):
+        outputs.append((StixBroIntelTransform, text_kwargs,
+                        _output_file(options.bro)))
+    if options.misp:
+        misp = StixMispTransform.get_misp_object(
+            options.misp_url, options.misp_key)
+        misp_kwargs = dict(
+            misp=misp,
+            distribution=options.misp_distribution,
+            threat_level=options.misp_threat,
+            analysis=options.misp_analysis,
+            information=options.misp_info,
+            published=options.misp_published,
+            object_types=options.types,
+            max_observable_rows=options.max_observable_rows,
+        )
+        outputs.append((StixMispTransform, misp_kwargs, None))
+    return outputs
+
+
+def _poll_state_file(settings):
+    """Name of the poll state file for a collection (or None)."""
+    if not settings['poll_state']:
+        return None
+    name = '{}_{}_{}_{}.json'.format(
+        settings['hostname'],
+        settings['port'] or '',
+        settings['path'],
+        settings['collection'],
+    )
+    return os.path.join(settings['poll_state'],
+                        re.sub(r'[^\w.-]', '_', name))
+
+
+def _upgrade_cache(options):
+    """Open the upgrade cache given in the options (or return None)."""
+    if not options['upgrade_cache']:
+        return None
+    return UpgradeCache(options['upgrade_cache'],
+                        options['cache_size'] * 1024 * 1024)
+
+
+def _taxii_client(settings):
+    """Create a TAXII client from a dictionary of option values."""
+    return SimpleTaxiiClient(
+        hostname=settings['hostname'],
+        path=settings['path'],
+        port=settings['port'],
+        collection=settings['collection'],
+        use_ssl=settings['ssl'],
+        username=settings['username'],
+        password=settings['password'],
+        key_file=settings['key'],
+        cert_file=settings['cert'],
+        ca_file=settings['ca_file'],
+        begin_ts=settings['begin_timestamp'],
+        end_ts=settings['end_timestamp'],
+        subscription_id=settings['subscription_id'],
+        keep_alive=settings['keep_alive'],
+        state_file=_poll_state_file(settings),
+        stream=settings['stream'] and not settings['xml_output'],
+        upgrade_cache=_upgrade_cache(settings),
+    )
+
+
+def _taxii_clients(options):
+    """Create TAXII clients for the collection(s) given in the options.
+
+    Each section of the --taxii-collections file describes a collection.
+    Keys match the long TAXII option names (e.g. 'hostname', 'ca_file' or
+    'begin-timestamp'). The section name is used as the collection name
+    if no 'collection' is given.
+    """
+    if not options.taxii_collections:
+        return [_taxii_client(vars(options))]
+
+    parser = ConfigParser.RawConfigParser()
+    if not parser.read(options.taxii_collections):
+        raise IOError('unable to read TAXII collections file ({})'.format(
+            options.taxii_collections))
+
+    clients = []
+    for section in parser.sections():
+        settings = dict(vars(options))
+        settings['collection'] = section
+        for key, value in parser.items(section):
+            settings[key.replace('-', '_')] = value
+        for key in ('ssl', 'keep-alive'):
+            if parser.has_option(section, key):
+                settings[key.replace('-', '_')] = parser.getboolean(
+                    section, key)
+        clients.append(_taxii_client(settings))
+    return clients
+
+
 def main():
     parser = get_arg_parser()
     options = parser.parse_args()
+    output_options = (_output_file(options.stats), _output_file(options.text),
+                      _output_file(options.bro), options.misp)
+    if options.xml_output and any(output_options):
+        parser.error("argument -x/--xml_output: not allowed with " +
+                     "other output options")
+    elif not options.xml_output and not any(output_options):
+        parser.error("one of the arguments -s/--stats -t/--text -b/--bro " +
+                     "-m/--misp -x/--xml_output is required")
+    if options.xpath_extract and (options.stream or options.taxii):
+        parser.error("argument --xpath-extract: not allowed with " +
+                     "--stream or --taxii")
+    if options.workers and options.stream:
+        parser.error("argument --workers: not allowed with --stream")
 
     logger = logging.getLogger(__name__)
     if options.debug:
@@ -249,68 +555,138 @@ def main():
         logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
     logger.info("logging enabled")
 
-    transform_kwargs = {}
-    if options.stats:
-        transform_class = StixStatsTransform
-    elif options.text:
-        transform_class = StixCsvTransform
-        if options.field_separator:
-            transform_kwargs['separator'] = options.field_separator
-    elif options.bro:
-        transform_class = StixBroIntelTransform
-    elif options.misp:
-        transform_class = StixMispTransform
-        misp = StixMispTransform.get_misp_object(
-            options.misp_url, options.misp_key)
-        transform_kwargs['misp'] = misp
-        transform_kwargs['distribution'] = options.misp_distribution
-        transform_kwargs['threat_level'] = options.misp_threat
-        transform_kwargs['analysis'] = options.misp_analysis
-        transform_kwargs['information'] = options.misp_info
-        transform_kwargs['published'] = options.misp_published
-    elif options.xml_output:
-        pass
-    else:
-        logger.error('Unable to determine transform type from options')
+    outputs = _outputs(options)
+    # Observables are extracted once for all of the outputs
+    transform_group = StixTransformGroup(
+        [transform_class for transform_class, _, _ in outputs],
+        object_types=options.types,
+        max_observable_rows=options.max_observable_rows,
+    )
 
-    if options.header:
-        transform_kwargs['include_header'] = options.header
+    dedup = None
+    if options.dedup:
+        dedup = PackageDeduplicator(options.dedup,
+                                    capacity=options.dedup_capacity)
 
+    observable_index = None
+    if options.resolve_idrefs is not None:
+        observable_index = ObservableIndex(
+            options.resolve_idrefs or None,
+            options.index_size * 1024 * 1024,
+        )
+
+    clients = []
     if options.taxii:
         logger.info("Processing a TAXII message")
-        source = SimpleTaxiiClient(
-            hostname=options.hostname,
-            path=options.path,
-            port=options.port,
-            collection=options.collection,
-            use_ssl=options.ssl,
-            username=options.username,
-            password=options.password,
-            key_file=options.key,
-            cert_file=options.cert,
-            ca_file=options.ca_file,
-            begin_ts=options.begin_timestamp,
-            end_ts=options.end_timestamp,
-            subscription_id=options.subscription_id,
-        )
-        source.send_poll_request()
+        clients = _taxii_clients(options)
 
         if options.xml_output:
             logger.debug("Writing XML to %s", options.xml_output)
-            source.save_content_blocks(options.xml_output)
+            for client in clients:
+                try:
+                    client.send_poll_request()
+                    client.save_content_blocks(
+                        options.xml_output,
+                        compression=options.xml_compress,
+                        dedup=options.xml_dedup,
+                        threads=options.xml_threads,
+                    )
+                    client.commit_state()
+                except Exception:
+                    if len(clients) == 1:
+                        raise
+                    logger.exception("error polling %r", client)
+                client.close()
             return
 
+        if len(clients) > 1:
+            source = StixMultiSource(clients, options.poll_threads)
+        else:
+            source = clients[0]
+            source.send_poll_request()
+
         logger.info("Processing TAXII content blocks")
     else:
         logger.info("Processing file input")
-        source = StixFileSource(options.file, options.recurse)
+        upgrade_cache = _upgrade_cache(vars(options))
+        if options.stream:
+            # Duplicates are skipped before the files are streamed
+            source = StixStreamSource(options.file, options.recurse,
+                                      upgrade_cache=upgrade_cache,
+                                      dedup=dedup,
+                                      state_file=options.incremental)
+        else:
+            if options.cache:
+                cache = ObservableCache(options.cache,
+                                        options.cache_size * 1024 * 1024)
+            else:
+                cache = None
+            source = StixFileSource(options.file, options.recurse,
+                                    options.workers, cache=cache,
+                                    state_file=options.incremental,
+                                    upgrade_cache=upgrade_cache,
+                                    xpath_extract=options.xpath_extract)
 
+    output_files = {}
+    for _, _, output in outputs:
+        if not output or output in output_files:
+            continue
+        elif output == '-':
+            # A duplicate of stdout, with a large buffer
+            sys.stdout.flush()
+            output_files[output] = os.fdopen(os.dup(sys.stdout.fileno()),
+                                             'w', OUTPUT_BUFFER_SIZE)
+        else:
+            output_files[output] = open(output, 'w', OUTPUT_BUFFER_SIZE)
+
+    check_duplicates = (dedup is not None and
+                        not isinstance(source, StixStreamSource))
+    # Unless the observables are needed for something else (or can be
+    # extracted by the workers or read from the cache), a single output
+    # extracts the observables it uses itself, when it first uses them
+    extract_on_demand = (len(outputs) == 1 and observable_index is None and
+                         not (options.workers or options.cache or
+                              options.xpath_extract))
     while True:
-        package = source.next_stix_package()
-        if package:
-            _process_package(package, transform_class, transform_kwargs)
+        if extract_on_demand:
+            package, observables = source.next_stix_package(), None
         else:
+            package, observables = source.next_extracted_package(
+                transform_group,
+            )
+        if not package:
             break
+        elif check_duplicates and dedup.is_duplicate(package):
+            continue
+        if observable_index is not None:
+            for transform_class in transform_group.transform_classes:
+                observable_index.update(transform_class,
+                                        observables[transform_class],
+                                        options.types)
+        for transform_class, transform_kwargs, output in outputs:
+            _process_package(package, transform_class, transform_kwargs,
+                             output_files.get(output),
+                             observables and observables[transform_class])
+
+    for output_file in output_files.values():
+        output_file.close()
+
+    if dedup is not None:
+        logger.info("%d duplicate packages skipped", dedup.duplicates)
+        dedup.save()
+
+    if observable_index is not None:
+        logger.info("%d referenced observables resolved",
+                    observable_index.resolved)
+        observable_index.close()
+
+    for client in clients:
+        # All output has been written, so record where each poll ended
+        client.commit_state()
+        if client.connection_stats():
+            logger.info("TAXII connection usage for %r: %s",
+                        client, client.connection_stats())
+    source.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+This script updates STIX documents with an older STIX version (e.g. STIX 1.0)
+ahead of time, storing the updated documents in a cache file for use with the
+--upgrade-cache option of stixtransclient.py.
+"""
+
+import sys
+import logging
+
+import configargparse
+
+from certau.source import StixFileSource
+from certau.cache import UpgradeCache
+
+
+def get_arg_parser():
+    """Create an argument parser with options used by this script."""
+    parser = configargparse.ArgumentParser(
+        default_config_files=['/etc/ctitoolkit.conf', '~/.ctitoolkit'],
+        # The config files are shared with stixtransclient.py
+        ignore_unknown_config_file_keys=True,
+        description=("Utility to update legacy STIX files in parallel, " +
+                     "storing the results in an upgrade cache."),
+    )
+    parser.add_argument(
+        "-c", "--config",
+        is_config_file=True,
+        help="configuration file to use",
+    )
+    parser.add_argument(
+        "-v", "--verbose",
+        action="store_true",
+        help="verbose output",
+    )
+    parser.add_argument(
+        "-d", "--debug",
+        action="store_true",
+        help="enable debug output",
+    )
+    parser.add_argument(
+        "--file",
+        nargs="+",
+        required=True,
+        help="STIX files, archives or directories to update",
+    )
+    parser.add_argument(
+        "-r", "--recurse",
+        action="store_true",
+        help="recurse subdirectories when processing files.",
+    )
+    parser.add_argument(
+        "--upgrade-cache",
+        required=True,
+        help="cache file used to store the updated documents",
+    )
+    parser.add_argument(
+        "--cache-size",
+        default=512,
+        type=int,
+        help="maximum size of the cache in MB - default: 512",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="number of processes used to update files in parallel",
+    )
+    return parser
+
+
+def main():
+    parser = get_arg_parser()
+    options = parser.parse_args()
+
+    logger = logging.getLogger(__name__)
+    if options.debug:
+        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    elif options.verbose:
+        logging.basicConfig(stream=sys.stderr, level=logging.INFO)
+    else:
+        logging.basicConfig(stream=sys.stderr, level=logging.WARNING)
+
+    upgrade_cache = UpgradeCache(options.upgrade_cache,
+                                 options.cache_size * 1024 * 1024)
+    source = StixFileSource(options.file, options.recurse, options.workers,
+                            upgrade_cache=upgrade_cache)
+    counts = source.pre_upgrade()
+    upgrade_cache.close()
+
+    logger.info("%(upgraded)d updated, %(cached)d already cached, "
+                "%(current)d current, %(failed)d failed", counts)
+    if counts['failed']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
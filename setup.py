@@ -15,6 +15,7 @@ setup(name='certau_stix_toolkit',
     },
     scripts=[
         'scripts/stixtransclient.py',
+        'scripts/stixupgrade.py',
     ],
     install_requires=[
         'configargparse',
@@ -22,9 +23,10 @@ setup(name='certau_stix_toolkit',
         'libtaxii',
         'cybox==2.1.0.12',
         'stix==1.1.1.5',
-        'stix-ramrod',
+        'stix-ramrod==1.2.0',
         'mixbox',
         'pymisp',
         'requests',
+        'scandir; python_version < "3.5"',
     ]
 )
@@ -3,14 +3,31 @@
 The SimpleTaxiiClient encapsulates the libtaxii.clients.HttpClient,
 configuring it using the passed in configargparse instance.
 """
+import os
+import gzip
+
 import httpretty
 import libtaxii.clients
+import libtaxii.constants
+import libtaxii.messages_11
 import pytest
 import xmltodict
 
 import certau.source
 
 
+@pytest.fixture
+def httpretty_enabled():
+    """Enable httpretty, as @httpretty.activate does (for tests that use
+    other fixtures, which the decorator hides from pytest).
+    """
+    httpretty.reset()
+    httpretty.enable()
+    yield
+    httpretty.disable()
+    httpretty.reset()
+
+
 def test_client_creation():
     """Test that the instantiation of a TAXII client sets up the libtaxii
     HttpClient correctly, based on the passed-in options.
@@ -260,3 +277,333 @@ def test_send_poll_request():
             u'taxii_11:Exclusive_Begin_Timestamp': u'2015-12-30T10:13:05+10:00'
         }
     }
+
+
+def _poll_response_body(request, part_number, more, content_blocks):
+    """Build a poll response (XML) in response to a captured request."""
+    request_message = libtaxii.messages_11.get_message_from_xml(request.body)
+    response = libtaxii.messages_11.PollResponse(
+        message_id=libtaxii.messages_11.generate_message_id(),
+        in_response_to=request_message.message_id,
+        collection_name='my_collection',
+        more=more,
+        result_id='result-1',
+        result_part_number=part_number,
+        content_blocks=[
+            libtaxii.messages_11.ContentBlock(
+                libtaxii.constants.CB_STIX_XML_111, content,
+            )
+            for content in content_blocks
+        ],
+    )
+    return response.to_xml()
+
+
+def _check_multipart_poll_response(**client_kwargs):
+    """Test that the parts of a multi-part poll response are requested as
+    the content blocks are consumed.
+    """
+    httpretty.reset()
+    httpretty.HTTPretty.allow_net_connect = False
+
+    with open('tests/CA-TEST-STIX.xml', 'rb') as stix_f:
+        stix_xml = stix_f.read()
+
+    requests = []
+
+    def _respond(request, uri, headers):
+        message = libtaxii.messages_11.get_message_from_xml(request.body)
+        requests.append(message)
+        if message.message_type == libtaxii.constants.MSG_POLL_REQUEST:
+            body = _poll_response_body(request, 1, True, [stix_xml])
+        else:
+            assert message.result_id == 'result-1'
+            part_number = message.result_part_number
+            body = _poll_response_body(
+                request, part_number, part_number < 3,
+                [stix_xml] * (part_number - 1),
+            )
+        headers = {
+            'X-TAXII-Content-Type': libtaxii.constants.VID_TAXII_XML_11,
+            'Content-Type': 'application/xml',
+        }
+        return (200, headers, body)
+
+    httpretty.register_uri(
+        httpretty.POST, 'http://example.com:80/taxii_endpoint',
+        body=_respond,
+    )
+
+    taxii_client = certau.source.SimpleTaxiiClient(
+        hostname='example.com',
+        path='/taxii_endpoint',
+        collection='my_collection',
+        **client_kwargs
+    )
+    taxii_client.send_poll_request()
+    assert len(requests) == 1
+
+    # Parts are only requested once the previous part has been consumed
+    assert taxii_client.next_stix_package() is not None
+    assert len(requests) == 1
+    assert taxii_client.next_stix_package() is not None
+    assert len(requests) == 2
+    assert [taxii_client.next_stix_package() is not None
+            for _ in range(3)] == [True, True, False]
+    assert len(requests) == 3
+    assert [r.message_type for r in requests[1:]] == [
+        libtaxii.constants.MSG_POLL_FULFILLMENT_REQUEST,
+    ] * 2
+
+
+@httpretty.activate
+def test_multipart_poll_response():
+    """Test a multi-part poll response."""
+    _check_multipart_poll_response()
+
+
+@httpretty.activate
+def test_streamed_poll_response():
+    """Test a multi-part poll response parsed as it is received."""
+    _check_multipart_poll_response(stream=True)
+    _check_multipart_poll_response(stream=True, keep_alive=True)
+
+
+@httpretty.activate
+def test_fulfillment_request_retry():
+    """Test that a failed fulfillment request can be retried."""
+    httpretty.HTTPretty.allow_net_connect = False
+
+    with open('tests/CA-TEST-STIX.xml', 'rb') as stix_f:
+        stix_xml = stix_f.read()
+
+    failures = [True]
+
+    def _respond(request, uri, headers):
+        message = libtaxii.messages_11.get_message_from_xml(request.body)
+        if message.message_type == libtaxii.constants.MSG_POLL_REQUEST:
+            body = _poll_response_body(request, 1, True, [stix_xml])
+        elif failures:
+            failures.pop()
+            return (200, {}, 'OK')
+        else:
+            assert message.result_id == 'result-1'
+            assert message.result_part_number == 2
+            body = _poll_response_body(request, 2, False, [stix_xml])
+        headers = {
+            'X-TAXII-Content-Type': libtaxii.constants.VID_TAXII_XML_11,
+            'Content-Type': 'application/xml',
+        }
+        return (200, headers, body)
+
+    httpretty.register_uri(
+        httpretty.POST, 'http://example.com:80/taxii_endpoint',
+        body=_respond,
+    )
+
+    taxii_client = certau.source.SimpleTaxiiClient(
+        hostname='example.com',
+        path='/taxii_endpoint',
+        collection='my_collection',
+    )
+    taxii_client.send_poll_request()
+    assert taxii_client.next_stix_package() is not None
+    with pytest.raises(Exception):
+        taxii_client.next_stix_package()
+    # The same part is requested again
+    assert taxii_client.next_stix_package() is not None
+    assert taxii_client.next_stix_package() is None
+
+
+@httpretty.activate
+def test_keep_alive_session():
+    """Test that a keep-alive client sends requests through a persistent
+    session and reports connection usage.
+    """
+    httpretty.HTTPretty.allow_net_connect = False
+
+    def _respond(request, uri, headers):
+        headers = {
+            'X-TAXII-Content-Type': libtaxii.constants.VID_TAXII_XML_11,
+            'Content-Type': 'application/xml',
+        }
+        return (200, headers, _poll_response_body(request, 1, False, []))
+
+    httpretty.register_uri(
+        httpretty.POST, 'http://example.com:80/taxii_endpoint',
+        body=_respond,
+    )
+
+    taxii_client = certau.source.SimpleTaxiiClient(
+        username='user',
+        password='pass',
+        hostname='example.com',
+        path='/taxii_endpoint',
+        collection='my_collection',
+        keep_alive=True,
+    )
+    taxii_client.send_poll_request()
+    assert taxii_client.next_stix_package() is None
+    taxii_client.send_poll_request()
+
+    request = httpretty.last_request()
+    assert request.headers['x-taxii-services'] == \
+        libtaxii.constants.VID_TAXII_SERVICES_11
+    assert request.headers['authorization'] == 'Basic dXNlcjpwYXNz'
+    assert request.headers['connection'] == 'keep-alive'
+
+    stats = taxii_client.connection_stats()
+    assert stats['requests'] == 2
+    assert stats['connections'] == 1
+    assert stats['reused'] == 1
+    taxii_client.close()
+
+    # Not available without keep-alive
+    taxii_client = certau.source.SimpleTaxiiClient(
+        hostname='example.com',
+        path='/taxii_endpoint',
+        collection='my_collection',
+    )
+    assert taxii_client.connection_stats() is None
+
+
+@httpretty.activate
+def test_keep_alive_in_response_to():
+    """Test that a keep-alive client rejects a response to another
+    request.
+    """
+    httpretty.HTTPretty.allow_net_connect = False
+
+    def _respond(request, uri, headers):
+        response = libtaxii.messages_11.PollResponse(
+            message_id=libtaxii.messages_11.generate_message_id(),
+            in_response_to='another-request',
+            collection_name='my_collection',
+        )
+        headers = {
+            'X-TAXII-Content-Type': libtaxii.constants.VID_TAXII_XML_11,
+            'Content-Type': 'application/xml',
+        }
+        return (200, headers, response.to_xml())
+
+    httpretty.register_uri(
+        httpretty.POST, 'http://example.com:80/taxii_endpoint',
+        body=_respond,
+    )
+
+    for stream in (False, True):
+        taxii_client = certau.source.SimpleTaxiiClient(
+            hostname='example.com',
+            path='/taxii_endpoint',
+            collection='my_collection',
+            keep_alive=True,
+            stream=stream,
+        )
+        with pytest.raises(Exception) as excinfo:
+            taxii_client.send_poll_request()
+        assert 'in_response_to' in str(excinfo.value)
+        taxii_client.close()
+
+
+def test_poll_state(httpretty_enabled, tmpdir):
+    """Test that the end timestamp of a completed poll is recorded and
+    used as the begin timestamp of the next poll.
+    """
+    httpretty.HTTPretty.allow_net_connect = False
+    end_label = '2016-02-01T10:00:00+00:00'
+
+    def _respond(request, uri, headers):
+        request_message = libtaxii.messages_11.get_message_from_xml(
+            request.body,
+        )
+        response = libtaxii.messages_11.PollResponse(
+            message_id=libtaxii.messages_11.generate_message_id(),
+            in_response_to=request_message.message_id,
+            collection_name='my_collection',
+            inclusive_end_timestamp_label=end_label,
+        )
+        headers = {
+            'X-TAXII-Content-Type': libtaxii.constants.VID_TAXII_XML_11,
+            'Content-Type': 'application/xml',
+        }
+        return (200, headers, response.to_xml())
+
+    httpretty.register_uri(
+        httpretty.POST, 'http://example.com:80/taxii_endpoint',
+        body=_respond,
+    )
+
+    state_file = str(tmpdir.join('state.json'))
+
+    def _client():
+        return certau.source.SimpleTaxiiClient(
+            hostname='example.com',
+            path='/taxii_endpoint',
+            collection='my_collection',
+            state_file=state_file,
+        )
+
+    taxii_client = _client()
+    assert taxii_client.create_poll_request().exclusive_begin_timestamp_label \
+        is None
+    taxii_client.send_poll_request()
+
+    # Not recorded until the content has been consumed
+    taxii_client.commit_state()
+    assert not os.path.exists(state_file)
+    assert taxii_client.next_stix_package() is None
+    taxii_client.commit_state()
+
+    poll_request = _client().create_poll_request()
+    assert poll_request.exclusive_begin_timestamp_label.isoformat() == \
+        end_label
+
+
+def test_save_content_blocks(httpretty_enabled, tmpdir):
+    """Test saving compressed content blocks, skipping duplicates."""
+    httpretty.HTTPretty.allow_net_connect = False
+    content_blocks = ['<a/>', '<b/>', '<a/>']
+
+    def _respond(request, uri, headers):
+        headers = {
+            'X-TAXII-Content-Type': libtaxii.constants.VID_TAXII_XML_11,
+            'Content-Type': 'application/xml',
+        }
+        return (200, headers,
+                _poll_response_body(request, 1, False, content_blocks))
+
+    httpretty.register_uri(
+        httpretty.POST, 'http://example.com:80/taxii_endpoint',
+        body=_respond,
+    )
+
+    output_dir = str(tmpdir)
+
+    def _save():
+        taxii_client = certau.source.SimpleTaxiiClient(
+            hostname='example.com',
+            path='/taxii_endpoint',
+            collection='my_collection',
+        )
+        taxii_client.send_poll_request()
+        return taxii_client.save_content_blocks(
+            output_dir, compression='gzip', dedup=True, threads=2,
+        )
+
+    writer = _save()
+    assert (writer.written, writer.duplicates) == (2, 1)
+    files = sorted(os.listdir(output_dir))
+    assert len(files) == 2
+    assert all(f.startswith('my_collection_STIX111_h') and
+               f.endswith('.xml.gz') for f in files)
+    contents = []
+    for name in files:
+        with gzip.open(os.path.join(output_dir, name)) as gz_file:
+            contents.append(gz_file.read())
+    # libtaxii adds namespace declarations to XML content
+    assert sorted(c[:2] for c in contents) == ['<a', '<b']
+
+    # Blocks saved by an earlier poll are skipped
+    writer = _save()
+    assert (writer.written, writer.duplicates) == (0, 3)
+    assert len(os.listdir(output_dir)) == 2
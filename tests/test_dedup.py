@@ -0,0 +1,88 @@
+"""Package deduplication tests."""
+import shutil
+
+import certau.dedup
+import certau.source
+
+
+def test_rotating_bloom_filter():
+    """Test that items are remembered for at least one generation and
+    that old items are eventually forgotten.
+    """
+    bloom = certau.dedup.RotatingBloomFilter(capacity=100, error_rate=0.001)
+    for i in range(100):
+        bloom.add('a{}'.format(i))
+    assert all('a{}'.format(i) in bloom for i in range(100))
+    false_positives = sum('b{}'.format(i) in bloom for i in range(1000))
+    assert false_positives < 10
+
+    # The second generation is full once another 100 items are added,
+    # so the next item added starts a new generation
+    for i in range(101):
+        bloom.add('c{}'.format(i))
+    assert all('c{}'.format(i) in bloom for i in range(101))
+    assert sum('a{}'.format(i) in bloom for i in range(100)) < 10
+
+
+def test_package_deduplicator(package, tmpdir):
+    """Test that packages are identified by id and timestamp, and that
+    the state persists between runs.
+    """
+    state_file = str(tmpdir.join('dedup.state'))
+    dedup = certau.dedup.PackageDeduplicator(state_file, capacity=1000,
+                                             window=2)
+    assert not dedup.is_duplicate(package)
+    assert dedup.is_duplicate(package)
+    assert not dedup.is_duplicate_id(package.id_, '2016-01-01T00:00:00Z')
+    # The timestamp is compared as a date/time
+    assert dedup.is_duplicate_id(package.id_, package.timestamp.isoformat())
+    # Packages without an id can't be identified
+    assert not dedup.is_duplicate_id(None, None)
+    assert not dedup.is_duplicate_id(None, None)
+    # Beyond the recent window, but still in the Bloom filter
+    for i in range(5):
+        assert not dedup.is_duplicate_id('example:Package-{}'.format(i), None)
+    assert dedup.is_duplicate(package)
+    assert dedup.duplicates == 3
+    dedup.save()
+
+    dedup = certau.dedup.PackageDeduplicator(state_file, capacity=1000,
+                                             window=2)
+    assert dedup.is_duplicate(package)
+    assert dedup.is_duplicate_id('example:Package-4', None)
+    assert not dedup.is_duplicate_id('example:Package-5', None)
+
+    # The state is ignored if the filter settings change
+    dedup = certau.dedup.PackageDeduplicator(state_file, capacity=2000)
+    assert not dedup.is_duplicate(package)
+
+
+def test_stream_source_dedup(tmpdir):
+    """Test that duplicate files are skipped by the stream source."""
+    for name in ('a.xml', 'b.xml'):
+        shutil.copy('tests/CA-TEST-STIX.xml', str(tmpdir.join(name)))
+    dedup = certau.dedup.PackageDeduplicator(capacity=1000)
+    source = certau.source.StixStreamSource([str(tmpdir)], batch_size=3,
+                                            dedup=dedup)
+    batches = 0
+    while source.next_stix_package() is not None:
+        batches += 1
+    # All the batches of the first file
+    assert batches == 9
+    assert dedup.duplicates == 1
+
+    # A file that can't be read in full isn't recorded as processed
+    with open('tests/CA-TEST-STIX.xml', 'rb') as stix_f:
+        content = stix_f.read()
+    truncated = tmpdir.mkdir('truncated').join('a.xml')
+    truncated.write(content[:len(content) // 2], mode='wb')
+    dedup = certau.dedup.PackageDeduplicator(capacity=1000)
+    for files, expected in (([str(truncated)], 7),
+                            (['tests/CA-TEST-STIX.xml'], 9),
+                            (['tests/CA-TEST-STIX.xml'], 0)):
+        source = certau.source.StixStreamSource(files, batch_size=3,
+                                                dedup=dedup)
+        batches = 0
+        while source.next_stix_package() is not None:
+            batches += 1
+        assert batches == expected
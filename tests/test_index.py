@@ -0,0 +1,144 @@
+"""Observable index (idref resolution) tests."""
+import io
+import cPickle as pickle
+
+from cybox.core import Observable
+from cybox.objects.address_object import Address
+from cybox.objects.domain_name_object import DomainName
+from stix.core import STIXPackage
+from stix.indicator import Indicator
+
+import certau.index
+import certau.source
+import certau.transform
+from certau.transform import StixCsvTransform, StixBroIntelTransform
+from certau.transform import StixTransformGroup
+
+
+def _observable_package():
+    """A package with observables at the root (and no indicators)."""
+    package = STIXPackage()
+    package.id_ = 'example:Package-observables'
+    address = Observable(Address('10.0.0.1', Address.CAT_IPV4))
+    address.id_ = 'example:Observable-address'
+    package.add_observable(address)
+    domain = DomainName()
+    domain.value = 'example.com'
+    domain = Observable(domain)
+    domain.id_ = 'example:Observable-domain'
+    package.add_observable(domain)
+    return package
+
+
+def _indicator_package():
+    """A package with indicators that only reference observables."""
+    package = STIXPackage()
+    package.id_ = 'example:Package-indicators'
+    for idref in ('example:Observable-domain', 'example:Observable-unknown',
+                  'example:Observable-address',
+                  'example:Observable-domain'):
+        indicator = Indicator()
+        indicator.add_observable(Observable(idref=idref))
+        package.add_indicator(indicator)
+    return package
+
+
+REFERENCES = ['example:Observable-domain', 'example:Observable-unknown',
+              'example:Observable-address']
+
+
+def _normalised(observables):
+    return dict(
+        (object_type, [
+            (observable.id,
+             [dict(fields.items()) for fields in observable.fields])
+            for observable in object_observables
+        ])
+        for object_type, object_observables in observables.items()
+    )
+
+
+def test_package_references():
+    """Test that the ids referenced by observables in indicators are
+    recorded however the observables are extracted.
+    """
+    package = _indicator_package()
+    observables = StixCsvTransform._observables_for_package(package)
+    assert observables == {}
+    assert observables.references == REFERENCES
+
+    group = StixTransformGroup([StixCsvTransform, StixBroIntelTransform])
+    results = group._observables_for_package(package)
+    root = certau.source.StixSource()._load_stix_root(
+        io.BytesIO(package.to_xml()),
+    )
+    tree_results = group._observables_for_tree(root)
+    for transform_class in group.transform_classes:
+        assert results[transform_class].references == REFERENCES
+        assert tree_results[transform_class].references == REFERENCES
+
+    # References survive detaching and pickling (e.g. in the cache)
+    detached = StixCsvTransform._detached_observables(observables)
+    detached = pickle.loads(pickle.dumps(detached, pickle.HIGHEST_PROTOCOL))
+    assert detached.references == REFERENCES
+
+    # Observables found in the package aren't references
+    package = _observable_package()
+    assert StixCsvTransform._observables_for_package(package).references == []
+
+
+def test_observable_index():
+    """Test that referenced observables are resolved from the index."""
+    index = certau.index.ObservableIndex()
+    defined = StixCsvTransform._observables_for_package(
+        _observable_package(),
+    )
+    assert index.update(StixCsvTransform, defined) == 0
+
+    observables = StixCsvTransform._observables_for_package(
+        _indicator_package(),
+    )
+    assert index.update(StixCsvTransform, observables) == 2
+    assert _normalised(observables) == _normalised(defined)
+    assert observables['DomainName'][0].observable is None
+    assert index.resolved == 2
+
+    # Only the observables of the given object types are resolved
+    observables = StixCsvTransform._observables_for_package(
+        _indicator_package(),
+    )
+    assert index.resolve_references(StixCsvTransform, observables,
+                                    ['Address']) == 1
+    assert list(observables) == ['Address']
+
+    # Entries are kept separately for each transform class
+    observables = StixBroIntelTransform._observables_for_package(
+        _indicator_package(),
+    )
+    assert index.update(StixBroIntelTransform, observables) == 0
+
+
+def test_observable_index_file(tmpdir):
+    """Test that observables indexed in a file are resolved in later
+    runs.
+    """
+    path = str(tmpdir.join('index.db'))
+    index = certau.index.ObservableIndex(path)
+    index.update(StixCsvTransform, StixCsvTransform._observables_for_package(
+        _observable_package(),
+    ))
+    index.close()
+
+    index = certau.index.ObservableIndex(path)
+    query = 'SELECT key, accessed FROM cache ORDER BY key'
+    accessed = index._disk._db.execute(query).fetchall()
+    observables = StixCsvTransform._observables_for_package(
+        _indicator_package(),
+    )
+    assert index.update(StixCsvTransform, observables) == 2
+    # Lookups don't write to the index
+    assert index._disk._db.execute(query).fetchall() == accessed
+    assert _normalised(observables) == _normalised(
+        StixCsvTransform._observables_for_package(_observable_package()),
+    )
+    index.close()
@@ -0,0 +1,567 @@
+"""File source tests."""
+import io
+import bz2
+import gzip
+import json
+import logging
+import os
+import shutil
+import tarfile
+import zipfile
+
+import lxml.etree
+import pytest
+import ramrod
+import stix
+import stix.core
+
+import certau.cache
+import certau.source
+import certau.transform
+
+
+@pytest.fixture
+def stix_dir(tmpdir):
+    """A directory containing copies of the test package and an invalid
+    file.
+    """
+    for name in ('a.xml', 'c.xml', 'e.xml'):
+        shutil.copy('tests/CA-TEST-STIX.xml', str(tmpdir.join(name)))
+    tmpdir.join('b.xml').write('not xml')
+    tmpdir.join('d.txt').write('<stix:STIX_Package')
+    return tmpdir
+
+
+def test_parallel_file_source(stix_dir):
+    """Test that loading packages with worker processes returns the same
+    packages, in the same order, as loading them sequentially.
+    """
+    transform_class = certau.transform.StixCsvTransform
+
+    def _texts(source):
+        texts = []
+        while True:
+            package, observables = source.next_extracted_package(
+                transform_class,
+            )
+            if package is None:
+                break
+            transform = transform_class(package, observables=observables)
+            texts.append(transform.text())
+        return texts
+
+    sequential = _texts(certau.source.StixFileSource([str(stix_dir)]))
+    parallel = _texts(certau.source.StixFileSource(
+        [str(stix_dir)], workers=2, max_pending=2,
+    ))
+
+    assert len(sequential) == 3
+    assert parallel == sequential
+
+    # Workers only return the package's id, timestamp and header (unless
+    # the transform requires the full package)
+    source = certau.source.StixFileSource([str(stix_dir)], workers=2)
+    package, _ = source.next_extracted_package(transform_class)
+    source.close()
+    assert package.id_ and package.stix_header
+    assert not package.observables and not package.indicators
+    source = certau.source.StixFileSource([str(stix_dir)], workers=2)
+    package, _ = source.next_extracted_package(
+        certau.transform.StixStatsTransform,
+    )
+    source.close()
+    assert package.indicators
+
+    # next_stix_package() also works with worker processes
+    source = certau.source.StixFileSource([str(stix_dir)], workers=2)
+    ids = []
+    while True:
+        package = source.next_stix_package()
+        if package is None:
+            break
+        ids.append(package.id_)
+        assert package.indicators
+    assert len(ids) == 3
+
+
+def test_stream_file_source(package):
+    """Test that streaming a file in batches produces the same observables
+    as loading the file in full.
+    """
+    transform_class = certau.transform.StixBroIntelTransform
+    expected = transform_class(package).text()
+
+    # A single batch produces identical output
+    source = certau.source.StixStreamSource(['tests/CA-TEST-STIX.xml'])
+    streamed = source.next_stix_package()
+    assert source.next_stix_package() is None
+    assert streamed.id_ == package.id_
+    assert streamed.stix_header.title == package.stix_header.title
+    assert transform_class(streamed).text() == expected
+
+    # Smaller batches produce the same lines (grouped differently)
+    source = certau.source.StixStreamSource(
+        ['tests/CA-TEST-STIX.xml'], batch_size=3,
+    )
+    lines = []
+    batches = 0
+    while True:
+        streamed = source.next_stix_package()
+        if streamed is None:
+            break
+        batches += 1
+        lines.extend(transform_class(streamed).text().splitlines())
+    assert batches == 9
+    assert sorted(lines) == sorted(expected.splitlines())
+
+
+def test_stream_file_errors(stix_dir, monkeypatch):
+    """Test that invalid files are skipped when streaming, but that other
+    errors are raised.
+    """
+    source = certau.source.StixStreamSource([str(stix_dir)])
+    packages = []
+    while True:
+        package = source.next_stix_package()
+        if package is None:
+            break
+        packages.append(package)
+    assert len(packages) == 3
+
+    def _error(element):
+        raise RuntimeError('unexpected')
+    monkeypatch.setattr(certau.source.StixStreamSource,
+                        '_observable_for_element', staticmethod(_error))
+    source = certau.source.StixStreamSource([str(stix_dir)])
+    with pytest.raises(RuntimeError):
+        source.next_stix_package()
+
+
+def test_file_source_cache(stix_dir, tmpdir):
+    """Test that extracted observables are cached by file content."""
+    transform_class = certau.transform.StixCsvTransform
+    cache = certau.cache.ObservableCache(str(tmpdir.join('cache.db')))
+
+    def _texts(workers=None):
+        source = certau.source.StixFileSource(
+            [str(stix_dir)], workers=workers, cache=cache,
+        )
+        texts = []
+        while True:
+            package, observables = source.next_extracted_package(
+                transform_class,
+            )
+            if package is None:
+                break
+            transform = transform_class(package, observables=observables)
+            texts.append(transform.text())
+        return texts
+
+    uncached = _texts()
+    # The three copies have the same content, so share one entry
+    assert len(cache) == 1
+    assert _texts() == uncached
+    assert _texts(workers=2) == uncached
+
+    # Entries are keyed by the transform's fields
+    class _Transform(certau.transform.StixCsvTransform):
+        OBJECT_FIELDS = {'Address': ['address_value']}
+    assert cache.get_extracted(
+        certau.cache.file_digest(str(stix_dir.join('a.xml'))), _Transform,
+    ) is None
+
+    # Transforms needing the full package are not cached
+    source = certau.source.StixFileSource([str(stix_dir)], cache=cache)
+    source.next_extracted_package(certau.transform.StixStatsTransform)
+    assert len(cache) == 1
+
+
+def test_xpath_file_source(stix_dir):
+    """Test that reading observables directly from the XML produces the
+    same output as loading the packages with python-stix.
+    """
+    shutil.copy('tests/CA-TEST-STIX-1.0.xml', str(stix_dir.join('f.xml')))
+    transform_classes = [certau.transform.StixCsvTransform,
+                         certau.transform.StixBroIntelTransform]
+    group = certau.transform.StixTransformGroup(transform_classes)
+
+    def _texts(**kwargs):
+        source = certau.source.StixFileSource([str(stix_dir)], **kwargs)
+        texts = []
+        while True:
+            package, observables = source.next_extracted_package(group)
+            if package is None:
+                break
+            for transform_class in transform_classes:
+                transform = transform_class(
+                    package, observables=observables[transform_class],
+                )
+                texts.append(transform.text())
+        return texts
+
+    expected = _texts()
+    assert len(expected) == 8
+    assert _texts(xpath_extract=True) == expected
+    assert _texts(xpath_extract=True, workers=2) == expected
+
+    # Only the package id, timestamp and header are loaded
+    source = certau.source.StixSource()
+    source._xpath_extract = True
+    package, observables = source.load_extracted_package(
+        'tests/CA-TEST-STIX.xml', transform_classes[0],
+    )
+    assert package.id_ == (
+        'cert_au:Package-dd2d0b1c-22d6-48b8-a511-2659a642015d'
+    )
+    assert package.stix_header.title == 'CA-TEST-STIX'
+    assert not package.observables
+    assert len(observables['File']) == 6
+
+    # Transforms needing the full package load it with python-stix
+    package, observables = source.load_extracted_package(
+        'tests/CA-TEST-STIX.xml', certau.transform.StixStatsTransform,
+    )
+    assert len(package.observables) == 20
+    assert source.load_extracted_package(
+        io.BytesIO(b'not xml'), transform_classes[0],
+    ) == (None, None)
+
+
+def test_disk_cache_eviction(tmpdir):
+    """Test that the least recently used entries are evicted."""
+    cache = certau.cache.DiskCache(str(tmpdir.join('cache.db')), 3000)
+    cache.set('a', 'a' * 1000)
+    cache.set('b', 'b' * 1000)
+    assert cache.get('a') == 'a' * 1000
+    cache.set('c', 'c' * 1000)
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+
+
+def test_incremental_file_source(stix_dir, tmpdir):
+    """Test that only new or changed files are processed when using a
+    state file.
+    """
+    state_file = str(tmpdir.join('state.json'))
+
+    def _count(source_class=certau.source.StixFileSource):
+        source = source_class([str(stix_dir)], state_file=state_file)
+        count = 0
+        while source.next_stix_package() is not None:
+            count += 1
+        return count
+
+    assert _count() == 3
+    assert _count() == 0
+
+    # New and modified files are processed again
+    shutil.copy('tests/CA-TEST-STIX.xml', str(stix_dir.join('f.xml')))
+    stix_dir.join('c.xml').write('\n', mode='a')
+    assert _count() == 2
+    assert _count() == 0
+
+    # The stream source uses the same state
+    stix_dir.join('c.xml').write('\n', mode='a')
+    assert _count(certau.source.StixStreamSource) == 1
+    assert _count(certau.source.StixStreamSource) == 0
+
+    # Files that no longer exist are dropped from the state (and invalid
+    # files are never recorded)
+    stix_dir.join('f.xml').remove()
+    _count()
+    with open(state_file) as state_f:
+        assert sorted(json.load(state_f)) == [
+            str(stix_dir.join(name)) for name in ('a.xml', 'c.xml', 'e.xml')
+        ]
+
+
+@pytest.mark.parametrize('workers', [None, 2])
+def test_incremental_state_recorded(stix_dir, tmpdir, workers):
+    """Test that a file is only recorded in the state once its package has
+    been loaded and returned.
+    """
+    state_file = str(tmpdir.join('state.json'))
+
+    def _recorded():
+        with open(state_file) as state_f:
+            return sorted(os.path.basename(f) for f in json.load(state_f))
+
+    # A package that has been returned is only recorded once the next
+    # package is requested
+    source = certau.source.StixFileSource([str(stix_dir)], workers=workers,
+                                          state_file=state_file)
+    assert source.next_stix_package() is not None
+    source.save_state()
+    assert _recorded() == []
+    assert source.next_stix_package() is not None
+    source.save_state()
+    assert _recorded() == ['a.xml']
+    source.close()
+
+    # A file that fails to load isn't recorded
+    os.remove(state_file)
+    stix_dir.join('c.xml').write('not xml')
+    source = certau.source.StixFileSource([str(stix_dir)], workers=workers,
+                                          state_file=state_file)
+    while source.next_stix_package() is not None:
+        pass
+    assert _recorded() == ['a.xml', 'e.xml']
+
+
+def test_file_source_walk(tmpdir, monkeypatch):
+    """Test that files are found lazily in sorted, depth-first order."""
+    for path in ('b.xml', 'sub/a.xml', 'sub/x/z.xml', 'a.txt', 'c/d.xml'):
+        tmpdir.join(path).ensure()
+    expected = [str(tmpdir.join(path)) for path in (
+        'a.txt', 'b.xml', 'c/d.xml', 'sub/a.xml', 'sub/x/z.xml',
+    )]
+
+    # scandir (or its backport) is used to list directories
+    scandir = certau.source.files.scandir
+    assert scandir is not None
+    scanned = []
+
+    def _scandir(path):
+        scanned.append(path)
+        return scandir(path)
+
+    def _listdir(path):
+        raise AssertionError('listdir() used with scandir available')
+    monkeypatch.setattr(certau.source.files, 'scandir', _scandir)
+    monkeypatch.setattr(os, 'listdir', _listdir)
+    source = certau.source.StixFileSource([str(tmpdir)], recurse=True)
+    assert list(source._files) == expected
+    assert len(scanned) == 4
+    source = certau.source.StixFileSource([str(tmpdir)])
+    assert list(source._files) == expected[:2]
+    monkeypatch.undo()
+
+    # Without scandir available
+    monkeypatch.setattr(certau.source.files, 'scandir', None)
+    source = certau.source.StixFileSource([str(tmpdir)], recurse=True)
+    assert list(source._files) == expected
+
+
+def test_multi_source(stix_dir):
+    """Test that packages from several sources are combined, and that a
+    failing source doesn't stop the others.
+    """
+    class _FailingSource(certau.source.StixSource):
+        def __init__(self):
+            self.opened = False
+
+        def open(self):
+            self.opened = True
+
+        def next_stix_package(self):
+            raise Exception('connection failed')
+
+    failing = _FailingSource()
+    source = certau.source.StixMultiSource(
+        [
+            certau.source.StixFileSource([str(stix_dir)]),
+            failing,
+            certau.source.StixFileSource(['tests/CA-TEST-STIX.xml']),
+        ],
+        threads=2,
+        max_pending=1,
+    )
+    count = 0
+    while source.next_stix_package() is not None:
+        count += 1
+    assert count == 4
+    assert failing.opened
+    source.close()
+
+
+def test_archive_file_source(tmpdir):
+    """Test that packages are read from compressed files and archives."""
+    with open('tests/CA-TEST-STIX.xml', 'rb') as stix_f:
+        stix_xml = stix_f.read()
+    with gzip.open(str(tmpdir.join('a.xml.gz')), 'wb') as gz_file:
+        gz_file.write(stix_xml)
+    with bz2.BZ2File(str(tmpdir.join('b.xml.bz2')), 'wb') as bz2_file:
+        bz2_file.write(stix_xml)
+    with zipfile.ZipFile(str(tmpdir.join('c.zip')), 'w') as zip_file:
+        zip_file.writestr('c1.xml', stix_xml)
+        zip_file.writestr('sub/', '')
+        zip_file.writestr('sub/c2.xml', stix_xml)
+    with tarfile.open(str(tmpdir.join('d.tar.gz')), 'w:gz') as tar_file:
+        tar_file.add('tests/CA-TEST-STIX.xml', 'd1.xml')
+        tar_file.add('tests/CA-TEST-STIX.xml', 'd2.xml')
+    tmpdir.join('e.xml.gz').write('not gzip')
+
+    def _ids(source):
+        ids = []
+        while True:
+            package = source.next_stix_package()
+            if package is None:
+                break
+            ids.append(package.id_)
+        return ids
+
+    expected = _ids(certau.source.StixFileSource(['tests/CA-TEST-STIX.xml']))
+    assert _ids(certau.source.StixFileSource([str(tmpdir)])) == expected * 6
+    assert _ids(certau.source.StixFileSource(
+        [str(tmpdir)], workers=2,
+    )) == expected * 6
+    assert _ids(certau.source.StixStreamSource([str(tmpdir)])) == \
+        expected * 6
+
+
+def test_damaged_and_legacy_archives(tmpdir):
+    """Test that damaged compressed files are skipped, and that older
+    STIX documents in (streamed) archives are loaded.
+    """
+    with open('tests/CA-TEST-STIX.xml', 'rb') as stix_f:
+        stix_xml = stix_f.read()
+    compressed = io.BytesIO()
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as gz_file:
+        gz_file.write(stix_xml)
+    damaged = bytearray(compressed.getvalue())
+    damaged[30:60] = b'\xff' * 30
+    tmpdir.join('a.xml.gz').write(bytes(damaged), mode='wb')
+    with tarfile.open(str(tmpdir.join('b.tar.gz')), 'w:gz') as tar_file:
+        tar_file.add('tests/CA-TEST-STIX-1.0.xml', 'b1.xml')
+    shutil.copy('tests/CA-TEST-STIX.xml', str(tmpdir))
+
+    for source in (certau.source.StixFileSource([str(tmpdir)]),
+                   certau.source.StixStreamSource([str(tmpdir)])):
+        packages = []
+        while True:
+            package = source.next_stix_package()
+            if package is None:
+                break
+            packages.append(package)
+        # The updated package from the archive, then the plain file
+        assert len(packages) == 2
+        assert packages[0].version == stix.supported_stix_version()
+        assert len(packages[0].observables) == 20
+
+
+def test_upgrade_cache(tmpdir, monkeypatch):
+    """Test that legacy documents are updated once and then loaded from
+    the upgrade cache.
+    """
+    stix_dir = tmpdir.mkdir('stix')
+    for name in ('a.xml', 'b.xml'):
+        shutil.copy('tests/CA-TEST-STIX-1.0.xml', str(stix_dir.join(name)))
+    shutil.copy('tests/CA-TEST-STIX.xml', str(stix_dir.join('c.xml')))
+    cache = certau.cache.UpgradeCache(str(tmpdir.join('upgrade.db')))
+
+    source = certau.source.StixFileSource([str(stix_dir)],
+                                          upgrade_cache=cache)
+    assert source.pre_upgrade() == dict(
+        current=1, cached=1, upgraded=1, failed=0,
+    )
+    source = certau.source.StixFileSource([str(stix_dir)], workers=2,
+                                          upgrade_cache=cache)
+    assert source.pre_upgrade() == dict(
+        current=1, cached=2, upgraded=0, failed=0,
+    )
+
+    # Cached documents are loaded without being updated again
+    def _upgrade(root):
+        raise AssertionError('document updated')
+    monkeypatch.setattr(certau.source.base, 'upgrade_stix_tree', _upgrade)
+
+    source = certau.source.StixFileSource([str(stix_dir)],
+                                          upgrade_cache=cache)
+    packages = []
+    while True:
+        package = source.next_stix_package()
+        if package is None:
+            break
+        packages.append(package)
+    assert len(packages) == 3
+    assert packages[0].id_ == 'example:STIXPackage-10'
+    address = packages[0].observables[0].object_.properties
+    assert address.address_value == '10.0.0.1'
+
+    # A document polled as an element (when streaming) shares the cache
+    # entry of its content as serialized by libtaxii
+    monkeypatch.undo()
+    root = lxml.etree.parse('tests/CA-TEST-STIX-1.0.xml').getroot()
+    content = lxml.etree.tostring(root, encoding='utf-8')
+    source = certau.source.StixSource()
+    source._upgrade_cache = cache
+    assert source.load_stix_package(io.BytesIO(content)) is not None
+    assert len(cache) == 2
+    monkeypatch.setattr(certau.source.base, 'upgrade_stix_tree', _upgrade)
+    assert source.load_stix_package(root) is not None
+    assert len(cache) == 2
+
+
+def _parent_only(method, parent):
+    """Wrap a DiskCache method that writes to the cache, so that it fails
+    when called from any process other than parent.
+    """
+    def _method(self, *args, **kwargs):
+        assert os.getpid() == parent, 'cache written by a worker'
+        return method(self, *args, **kwargs)
+    return _method
+
+
+def test_upgrade_cache_workers(tmpdir, monkeypatch):
+    """Test that documents updated by worker processes are added to the
+    upgrade cache (and the access times of the documents they read are
+    updated) by the parent process.
+    """
+    stix_dir = tmpdir.mkdir('stix')
+    shutil.copy('tests/CA-TEST-STIX-1.0.xml', str(stix_dir.join('a.xml')))
+    shutil.copy('tests/CA-TEST-STIX.xml', str(stix_dir.join('b.xml')))
+    cache = certau.cache.UpgradeCache(str(tmpdir.join('upgrade.db')))
+
+    # Workers only open the cache for reading, and only read using peek()
+    parent = os.getpid()
+    init = certau.cache.DiskCache.__init__
+
+    def _init(self, path, max_size=512 * 1024 * 1024, reader=False):
+        assert reader or os.getpid() == parent, 'cache set up by a worker'
+        init(self, path, max_size, reader)
+    monkeypatch.setattr(certau.cache.DiskCache, '__init__', _init)
+    for name in ('_store', 'get', 'touch'):
+        monkeypatch.setattr(
+            certau.cache.DiskCache, name,
+            _parent_only(getattr(certau.cache.DiskCache, name), parent),
+        )
+
+    query = 'SELECT accessed FROM cache'
+    accessed = []
+    for _ in range(2):
+        source = certau.source.StixFileSource([str(stix_dir)], workers=2,
+                                              upgrade_cache=cache)
+        packages = []
+        while True:
+            package = source.next_stix_package()
+            if package is None:
+                break
+            packages.append(package)
+        assert len(packages) == 2
+        assert len(cache) == 1
+        accessed.append(cache._db.execute(query).fetchone()[0])
+    # The second run read the cached document
+    assert accessed[1] > accessed[0]
+
+
+def test_load_stix_package(caplog):
+    """Test loading current and legacy packages, and that the reason is
+    logged when a package can't be loaded.
+    """
+    source = certau.source.StixSource()
+    package = source.load_stix_package('tests/CA-TEST-STIX-1.0.xml')
+    expected = ramrod.update('tests/CA-TEST-STIX-1.0.xml', to_='1.1.1')
+    assert package.to_xml() == stix.core.STIXPackage.from_xml(
+        expected.document.as_stringio(),
+    ).to_xml()
+
+    # Files, file objects and elements are all accepted
+    with open('tests/CA-TEST-STIX.xml', 'rb') as stix_f:
+        assert source.load_stix_package(stix_f).id_ == \
+            source.load_stix_package('tests/CA-TEST-STIX.xml').id_
+    element = lxml.etree.parse('tests/CA-TEST-STIX-1.0.xml').getroot()
+    assert source.load_stix_package(element).to_xml() == package.to_xml()
+
+    caplog.set_level(logging.WARNING)
+    assert source.load_stix_package(io.BytesIO(b'not xml')) is None
+    assert 'unable to load STIX package - XMLSyntaxError' in caplog.text
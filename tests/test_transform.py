@@ -1,9 +1,18 @@
 # -*- coding: utf-8 -*-
 """Basic high-level tests of the transform functionality."""
 import csv
+import sys
+import cPickle
 import StringIO
 import textwrap
 
+import pytest
+from cybox.core import Observable, ObservableComposition
+from cybox.objects.address_object import Address
+from cybox.objects.domain_name_object import DomainName
+from cybox.objects.email_message_object import EmailMessage
+from stix.core import STIXPackage
+
 import certau.transform
 
 
@@ -162,3 +171,324 @@ def test_transform_to_bro(package):
         183.82.180.95\tIntel::ADDR\tCCIRC\thttps://www.publicsafety.gc.ca/cnt/ntnl-scrt/cbr-scrt/ccirc-ccric-eng.aspx\tF\t-\t-
         host.domain.tld/path/file\tIntel::URL\tCERT-AU\thttps://www.cert.gov.au/\tF\t-\t-
     """).strip().expandtabs()
+
+
+def test_field_accessor():
+    """Test that field names are compiled into a tree of accessors."""
+    accessor = certau.transform.base.FieldAccessor(
+        ['header.to', 'header.from_.address_value', 'subject'],
+    )
+    children = dict((name, (full_name, child))
+                    for name, full_name, child in accessor.children)
+    assert sorted(children) == ['header', 'subject']
+    assert children['subject'] == ('subject', None)
+    header = dict((name, (full_name, child)) for name, full_name, child
+                  in children['header'][1].children)
+    assert header['to'] == ('header.to', None)
+    from_ = header['from_'][1]
+    assert from_.children == [
+        ('address_value', 'header.from_.address_value', None),
+    ]
+
+    # Constraint fields are compiled once for each class and object type
+    transform_class = certau.transform.StixBroIntelTransform
+    accessor = transform_class._field_accessor('Address')
+    assert transform_class._field_accessor('Address') is accessor
+    assert accessor.constraints == [
+        ('category', transform_class.OBJECT_CONSTRAINTS['Address']['category'],
+         True),
+    ]
+
+
+def test_list_field_expansion(monkeypatch):
+    """Test that list fields produce a row for each item, and that the
+    number of rows can be limited.
+    """
+    email = EmailMessage()
+    email.from_ = 'sender@example.com'
+    email.to = ['a@example.com', 'b@example.com', 'c@example.com']
+    email.subject = 'Test'
+    observable = Observable(email)
+
+    transform_class = certau.transform.StixCsvTransform
+    values = transform_class._field_values_for_observable(observable)
+    assert [v['header.to.address_value'] for v in values] == [
+        'a@example.com', 'b@example.com', 'c@example.com',
+    ]
+    for value in values:
+        assert value['header.from_.address_value'] == 'sender@example.com'
+        assert value['header.subject'] == 'Test'
+
+    monkeypatch.setattr(transform_class, 'MAX_OBSERVABLE_ROWS', 2)
+    values = transform_class._field_values_for_observable(observable)
+    assert [v['header.to.address_value'] for v in values] == [
+        'a@example.com', 'b@example.com',
+    ]
+    monkeypatch.undo()
+
+    # The limit can be given for each extraction (e.g. by a group or a
+    # transform) without changing the class
+    package = STIXPackage()
+    package.add_observable(observable)
+    group = certau.transform.StixTransformGroup([transform_class],
+                                                max_observable_rows=1)
+    observables = group._observables_for_package(package)[transform_class]
+    assert len(observables['EmailMessage'][0].fields) == 1
+    transform = transform_class(package, max_observable_rows=2)
+    assert len(transform._observables['EmailMessage'][0].fields) == 2
+    assert transform_class.MAX_OBSERVABLE_ROWS is None
+    assert group._extraction_fingerprint() != \
+        certau.transform.StixTransformGroup(
+            [transform_class])._extraction_fingerprint()
+
+
+def test_nested_compositions():
+    """Test that observables are collected from deeply nested
+    compositions, and that repeated observables are only collected once.
+    """
+    address = Observable(Address('10.0.0.1', Address.CAT_IPV4))
+    observable = address
+    for _ in range(sys.getrecursionlimit() + 100):
+        composition = ObservableComposition(operator='AND')
+        composition.add(observable)
+        observable = Observable()
+        observable.observable_composition = composition
+    package = STIXPackage()
+    package.add_observable(observable)
+    package.add_observable(address)
+
+    observables = certau.transform.StixCsvTransform._observables_for_package(
+        package,
+    )
+    assert [o['id'] for o in observables['Address']] == [address.id_]
+
+
+def test_multiple_row_constraints():
+    """Test that constraints are applied to every row of an observable."""
+    class ConstrainedTransform(certau.transform.StixCsvTransform):
+        OBJECT_FIELDS = {
+            'EmailMessage': ['header.subject'],
+        }
+        OBJECT_CONSTRAINTS = {
+            'EmailMessage': {
+                'header.to.address_value': ['a@example.com', 'c@example.com'],
+            },
+        }
+
+    email = EmailMessage()
+    email.to = ['a@example.com', 'b@example.com', 'c@example.com']
+    email.subject = 'Test'
+    values = ConstrainedTransform._field_values_for_observable(
+        Observable(email),
+    )
+    assert [v['header.subject'] for v in values] == ['Test', 'Test']
+    # The constraint field isn't one of the transform's fields
+    assert not any('header.to.address_value' in v for v in values)
+
+
+def test_extracted_observables(package):
+    """Test the compact representation of extracted observables."""
+    observables = certau.transform.StixCsvTransform._observables_for_package(
+        package,
+    )
+    address = observables['Address'][0]
+    assert address['id'] == address.id
+    assert address['observable'].id_ == address.id
+    fields = address['fields'][0]
+    assert dict(fields) == {
+        'category': 'ipv4-addr',
+        'address_value': '158.164.39.51',
+        'address_value_condition': 'None',
+    }
+    assert 'category_condition' not in fields
+    assert fields.get('category_condition', 'None') == 'None'
+    with pytest.raises(KeyError):
+        fields['category_condition']
+    with pytest.raises(TypeError):
+        fields['category'] = 'ipv6-addr'
+
+    # Rows of the same object type share their keys
+    other = observables['Address'][1]['fields'][0]
+    assert other._layout is fields._layout
+
+    for protocol in (0, cPickle.HIGHEST_PROTOCOL):
+        loaded = cPickle.loads(cPickle.dumps(observables['Address'],
+                                             protocol))
+        assert [o['fields'] for o in loaded] == [
+            o['fields'] for o in observables['Address']
+        ]
+
+
+def test_transform_group(package):
+    """Test that observables extracted once for several transforms match
+    those extracted by each transform.
+    """
+    transform_classes = [
+        certau.transform.StixCsvTransform,
+        certau.transform.StixBroIntelTransform,
+        certau.transform.StixMispTransform,
+        certau.transform.StixStatsTransform,
+    ]
+    group = certau.transform.StixTransformGroup(transform_classes)
+    assert group.REQUIRES_FULL_PACKAGE
+    observables = group._observables_for_package(package)
+    assert sorted(observables) == sorted(transform_classes)
+
+    def _summary(class_observables):
+        return dict(
+            (object_type, [(o['id'], o['fields']) for o in object_observables])
+            for object_type, object_observables in class_observables.items()
+        )
+
+    for transform_class in transform_classes:
+        assert _summary(observables[transform_class]) == _summary(
+            transform_class._observables_for_package(package)
+        )
+
+    # Each transform renders from its own share of the extraction
+    bro = certau.transform.StixBroIntelTransform(
+        package, observables=observables[certau.transform.StixBroIntelTransform],
+    )
+    assert 'host.domain.tld/path/file\tIntel::URL' in bro.text()
+    csv_ = certau.transform.StixCsvTransform(
+        package, observables=observables[certau.transform.StixCsvTransform],
+    )
+    assert '|http://host.domain.tld/path/file|' in csv_.text()
+
+
+def test_lazy_extraction(package):
+    """Test that observables are extracted when each object type is
+    first used, and that the object types can be limited.
+    """
+    transform_class = certau.transform.StixCsvTransform
+    transform = transform_class(package)
+    observables = transform._observables
+    assert isinstance(observables, certau.transform.base.LazyObservables)
+    assert 'Address' in observables
+    assert sorted(observables._extracted) == ['Address']
+    eager = transform_class._observables_for_package(package)
+    assert sorted(observables) == sorted(eager)
+    for object_type in eager:
+        assert ([o['fields'] for o in observables[object_type]] ==
+                [o['fields'] for o in eager[object_type]])
+
+    transform = transform_class(package, object_types=['Address', 'URI'])
+    assert sorted(transform._observables.keys()) == ['Address', 'URI']
+    text = transform.text()
+    assert '# Address observables' in text
+    assert 'DomainName' not in text
+    assert sorted(transform_class._observables_for_package(
+        package, ['Address', 'URI'])) == ['Address', 'URI']
+
+    # An ID used with two object types is only extracted once
+    mixed = STIXPackage()
+    for properties in (DomainName(), Address('10.0.0.1', Address.CAT_IPV4)):
+        if isinstance(properties, DomainName):
+            properties.value = 'example.com'
+        observable = Observable(properties)
+        observable.id_ = 'example:Observable-1'
+        mixed.add_observable(observable)
+    observables = certau.transform.base.LazyObservables(transform_class,
+                                                        mixed)
+    assert observables.keys() == ['DomainName']
+
+
+def _written(transform):
+    output = StringIO.StringIO()
+    transform.write(output)
+    return output.getvalue()
+
+
+def test_streamed_text(package):
+    """Test the text written as it is generated."""
+    object_types = ['Address', 'Mutex']
+    transform = certau.transform.StixCsvTransform(package,
+                                                  object_types=object_types)
+    assert all(line.endswith('\n') for line in transform.iter_lines())
+    assert _written(transform) == textwrap.dedent("""\
+        # CA-TEST-STIX (TLP:WHITE)
+
+        # Address observables
+        # id|category|address
+        cert_au:Observable-fe5ddeac-f9b0-4488-9f89-bfbd9351efd4|ipv4-addr|158.164.39.51
+        cert_au:Observable-ccccceac-f9b0-4488-9f89-bfbd9351efd4|ipv4-addr|111.222.33.44
+
+        # Mutex observables
+        # id|mutex|mutex_condition
+        NCCIC:Observable-01234567-6868-4ffd-babc-ba2ad0e34f43|WIN_ABCDEF|None
+        NCCIC:Observable-abcdef01-3363-4533-a77c-10d71c371282|MUTEX_0001|None
+        CCIRC-CCRIC:Observable-01234567-e44c-473a-85c6-fc6c2e781114|iurlkjashdk|Equals
+
+    """)
+    assert transform.text_for_object_type('Process') == ''
+
+    transform = certau.transform.StixBroIntelTransform(
+        package, include_header=True, object_types=['Address'],
+    )
+    assert _written(transform) == (
+        '# indicator\tindicator_type\tmeta.source\tmeta.url\t'
+        'meta.do_notice\tmeta.if_in\tmeta.whitelist\n'
+        '158.164.39.51\tIntel::ADDR\tCERT-AU\thttps://www.cert.gov.au/'
+        '\tT\t-\t-\n'
+        '111.222.33.44\tIntel::ADDR\tCERT-AU\thttps://www.cert.gov.au/'
+        '\tT\t-\t-\n'
+    )
+
+
+def test_overridden_text_methods(package):
+    """Test that subclasses overriding text_for_object_type or
+    text_for_observable (rather than the lines_for_* methods) produce
+    their own text.
+    """
+    class ObservableTransform(certau.transform.StixTextTransform):
+        OBJECT_FIELDS = {'Address': ['address_value']}
+
+        def text_for_observable(self, observable, object_type):
+            return observable.id + '\n'
+
+    class ObjectTypeTransform(certau.transform.StixCsvTransform):
+        def text_for_object_type(self, object_type):
+            if object_type != 'Address':
+                return ''
+            return 'addresses: {}\n'.format(
+                len(self._observables[object_type]),
+            )
+
+    transform = ObservableTransform(package, include_header=False)
+    assert _written(transform) == (
+        'cert_au:Observable-fe5ddeac-f9b0-4488-9f89-bfbd9351efd4\n'
+        'cert_au:Observable-ccccceac-f9b0-4488-9f89-bfbd9351efd4\n'
+    )
+    transform = ObjectTypeTransform(package, include_header=False)
+    assert _written(transform) == 'addresses: 2\n'
+
+
+def test_row_serializer():
+    """Test that rows are formatted as by csv.writer, with or without
+    quoting.
+    """
+    rows = [
+        ['first', 'second'],
+        ['first|second', 'third'],
+        ['say "hello"', 'x'],
+        ['line\nbreak', 'x'],
+        ['cr\r', 'x'],
+        [''],
+        [],
+        ['', ''],
+        ['', 'x'],
+        [' leading', 'trailing '],
+        ['count', 3],
+        [None, 'x'],
+        [u'unicode', 'x'],
+        ['single'],
+    ]
+    for separator in ('|', '\t', ','):
+        serializer = certau.transform.text.RowSerializer(separator)
+        for row in rows:
+            sio = StringIO.StringIO()
+            csv.writer(sio, delimiter=separator).writerow(row)
+            expected = sio.getvalue().strip()
+            joined = serializer.join(row)
+            assert joined == expected
+            assert type(joined) is str
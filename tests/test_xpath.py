@@ -0,0 +1,370 @@
+"""Differential tests of reading observables directly from the XML.
+
+Observables extracted using XPath must be identical to those extracted
+from the package loaded with python-stix.
+"""
+import io
+
+import lxml.etree
+import pytest
+import stix.core
+
+import certau.source
+import certau.transform
+from certau.transform.xpath import (
+    ElementProperties, UnsupportedDocumentError, XPathExtractor,
+)
+
+
+TRANSFORM_CLASSES = [
+    certau.transform.StixTextTransform,
+    certau.transform.StixCsvTransform,
+    certau.transform.StixBroIntelTransform,
+    certau.transform.StixMispTransform,
+]
+
+PACKAGE_TEMPLATE = """<stix:STIX_Package
+    xmlns:AddressObj="http://cybox.mitre.org/objects#AddressObject-2"
+    xmlns:DomainNameObj="http://cybox.mitre.org/objects#DomainNameObject-1"
+    xmlns:EmailMessageObj="http://cybox.mitre.org/objects#EmailMessageObject-2"
+    xmlns:FileObj="http://cybox.mitre.org/objects#FileObject-2"
+    xmlns:MutexObj="http://cybox.mitre.org/objects#MutexObject-2"
+    xmlns:URIObj="http://cybox.mitre.org/objects#URIObject-2"
+    xmlns:cybox="http://cybox.mitre.org/cybox-2"
+    xmlns:cyboxCommon="http://cybox.mitre.org/common-2"
+    xmlns:cyboxVocabs="http://cybox.mitre.org/default_vocabularies-2"
+    xmlns:indicator="http://stix.mitre.org/Indicator-2"
+    xmlns:stix="http://stix.mitre.org/stix-1"
+    xmlns:example="http://example.com/"
+    xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
+    xmlns:schema="http://www.w3.org/2001/XMLSchema-instance"
+    id="example:Package-1" version="1.1.1">
+    <stix:Observables cybox_major_version="2" cybox_minor_version="1">
+        {observables}
+    </stix:Observables>
+    <stix:Indicators>
+        {indicators}
+    </stix:Indicators>
+</stix:STIX_Package>"""
+
+OBSERVABLE_TEMPLATE = """<cybox:Observable id="example:Observable-{id}">
+    <cybox:Object>
+        <cybox:Properties xsi:type="{xsi_type}"{attributes}>
+            {properties}
+        </cybox:Properties>
+    </cybox:Object>
+</cybox:Observable>"""
+
+
+def _observable(id_, xsi_type, properties, attributes=''):
+    return OBSERVABLE_TEMPLATE.format(id=id_, xsi_type=xsi_type,
+                                      properties=properties,
+                                      attributes=attributes)
+
+
+def _address(id_, value, attributes=' category="ipv4-addr"'):
+    return _observable(id_, 'AddressObj:AddressObjectType', value,
+                       attributes)
+
+
+def _file(id_, properties):
+    return _observable(id_, 'FileObj:FileObjectType', properties)
+
+
+def _hash(value, type_='<cyboxCommon:Type xsi:type="cyboxVocabs:'
+                       'HashNameVocab-1.0">MD5</cyboxCommon:Type>'):
+    return """<FileObj:Hashes><cyboxCommon:Hash>{}
+        <cyboxCommon:Simple_Hash_Value>{}</cyboxCommon:Simple_Hash_Value>
+        </cyboxCommon:Hash></FileObj:Hashes>""".format(type_, value)
+
+
+# Observables that are read from the XML, and those that aren't (but must
+# still produce the same results)
+EDGE_CASES = [
+    _address(1, '<AddressObj:Address_Value condition="Equals">10.0.0.1'
+                '</AddressObj:Address_Value>'),
+    _address(2, '<AddressObj:Address_Value>  10.0.0.2  '
+                '</AddressObj:Address_Value>'),
+    _address(3, '<AddressObj:Address_Value>10.0.0.3'
+                '</AddressObj:Address_Value>', ''),
+    _address(4, '<AddressObj:Address_Value>10.0.0.4##comma##10.0.0.5'
+                '</AddressObj:Address_Value>'),
+    _address(5, '<AddressObj:Address_Value condition="Equals" '
+                'apply_condition="ALL">10.0.0.6</AddressObj:Address_Value>'),
+    _address(6, '<AddressObj:Address_Value condition="StartsWith">10.0.0.'
+                '</AddressObj:Address_Value>'),
+    _address(7, '<AddressObj:Address_Value>10.0.0.7<!-- comment -->'
+                '</AddressObj:Address_Value>'),
+    _address(8, '<AddressObj:Address_Value><![CDATA[10.0.0.8]]>'
+                '</AddressObj:Address_Value>'),
+    _address(9, '<AddressObj:Address_Value></AddressObj:Address_Value>'),
+    # A repeated element (the last one is used)
+    _address(10, '<AddressObj:Address_Value>10.0.0.9'
+                 '</AddressObj:Address_Value>'
+                 '<AddressObj:Address_Value>10.0.0.10'
+                 '</AddressObj:Address_Value>'),
+    # An element in the wrong namespace is read by local name
+    _address(11, '<FileObj:Address_Value>10.0.0.11</FileObj:Address_Value>'),
+    _address(12, '<AddressObj:Address_Value>a@example.com'
+                 '</AddressObj:Address_Value>', ' category="e-mail"'),
+    _observable(13, 'DomainNameObj:DomainNameObjectType',
+                '<DomainNameObj:Value condition="Equals">example.com'
+                '</DomainNameObj:Value>'),
+    _observable(14, 'URIObj:URIObjectType',
+                '<URIObj:Value>http://example.com/</URIObj:Value>',
+                ' type="URL"'),
+    _observable(15, 'URIObj:URIObjectType',
+                '<URIObj:Value>example.com</URIObj:Value>',
+                ' type="Domain Name"'),
+    _file(16, '<FileObj:File_Name>a.exe</FileObj:File_Name>' +
+          _hash('11111111111111111111111111111111')),
+    # Hash types set from the length of the hash value
+    _file(17, _hash('11111111111111111111111111111111', '')),
+    _file(18, _hash('1111', '')),
+    _file(19, _hash('1111111111111111111111111111111111111111',
+                    '<cyboxCommon:Type>SHA1</cyboxCommon:Type>')),
+    _file(20, _hash('1111111111111111111111111111111111111111',
+                    '<cyboxCommon:Type condition="Equals" xsi:type="'
+                    'cyboxVocabs:HashNameVocab-1.0">SHA1</cyboxCommon:Type>')),
+    # A different prefix for the XML Schema instance namespace
+    _file(21, _hash('11111111111111111111111111111111',
+                    '<cyboxCommon:Type schema:type="cyboxVocabs:'
+                    'HashNameVocab-1.0">MD5</cyboxCommon:Type>')),
+    _file(22, '<FileObj:File_Name>b.exe</FileObj:File_Name>'
+              '<FileObj:Hashes/>'),
+    _observable(23, 'EmailMessageObj:EmailMessageObjectType', """
+        <EmailMessageObj:Header>
+            <EmailMessageObj:To>
+                <EmailMessageObj:Recipient category="e-mail">
+                    <AddressObj:Address_Value>a@example.com
+                    </AddressObj:Address_Value>
+                </EmailMessageObj:Recipient>
+                <EmailMessageObj:Recipient category="e-mail">
+                    <AddressObj:Address_Value condition="Equals"
+                        >b@example.com</AddressObj:Address_Value>
+                </EmailMessageObj:Recipient>
+            </EmailMessageObj:To>
+            <EmailMessageObj:From category="e-mail">
+                <AddressObj:Address_Value>c@example.com
+                </AddressObj:Address_Value>
+            </EmailMessageObj:From>
+            <EmailMessageObj:Subject>Subject</EmailMessageObj:Subject>
+        </EmailMessageObj:Header>
+        <EmailMessageObj:Attachments>
+            <EmailMessageObj:File object_reference="example:File-1"/>
+            <EmailMessageObj:File object_reference="example:File-2"/>
+        </EmailMessageObj:Attachments>"""),
+    _observable(24, 'EmailMessageObj:EmailMessageObjectType', """
+        <EmailMessageObj:Header>
+            <EmailMessageObj:From category="e-mail">
+                <AddressObj:Address_Value>d@example.com
+                </AddressObj:Address_Value>
+            </EmailMessageObj:From>
+        </EmailMessageObj:Header>"""),
+    _observable(31, 'EmailMessageObj:EmailMessageObjectType',
+                '<EmailMessageObj:Header/>'),
+    # An object type that isn't read from the XML
+    _observable(25, 'MutexObj:MutexObjectType',
+                '<MutexObj:Name>mutex</MutexObj:Name>'),
+    # Observables without an id or object properties
+    """<cybox:Observable><cybox:Object>
+        <cybox:Properties xsi:type="AddressObj:AddressObjectType">
+        <AddressObj:Address_Value>10.0.1.1</AddressObj:Address_Value>
+        </cybox:Properties></cybox:Object></cybox:Observable>""",
+    '<cybox:Observable id="example:Observable-26"><cybox:Object/>'
+    '</cybox:Observable>',
+    '<cybox:Observable idref="example:Observable-1"/>',
+    # A nested composition
+    """<cybox:Observable id="example:Observable-27">
+        <cybox:Observable_Composition operator="OR">
+        {}
+        <cybox:Observable id="example:Observable-28">
+        <cybox:Observable_Composition operator="AND">{}{}
+        </cybox:Observable_Composition></cybox:Observable>
+        </cybox:Observable_Composition></cybox:Observable>""".format(
+        _address(29, '<AddressObj:Address_Value>10.0.2.1'
+                     '</AddressObj:Address_Value>'),
+        _address(30, '<AddressObj:Address_Value>10.0.2.2'
+                     '</AddressObj:Address_Value>'),
+        # A repeated observable
+        _address(1, '<AddressObj:Address_Value>10.0.0.1'
+                    '</AddressObj:Address_Value>'),
+    ),
+]
+
+INDICATORS = """
+    <stix:Indicator id="example:Indicator-1"
+        xsi:type="indicator:IndicatorType">
+        <indicator:Observable id="example:Observable-40">
+            <cybox:Object>
+                <cybox:Properties xsi:type="AddressObj:AddressObjectType"
+                    category="ipv6-addr">
+                    <AddressObj:Address_Value>::1</AddressObj:Address_Value>
+                </cybox:Properties>
+            </cybox:Object>
+        </indicator:Observable>
+    </stix:Indicator>
+    <stix:Indicator idref="example:Indicator-2"/>
+"""
+
+
+def _normalised(observables):
+    """Returns extracted observables in a form that can be compared."""
+    return dict(
+        (object_type, [
+            (observable.id,
+             None if observable.fields is None else
+             [dict(fields.items()) for fields in observable.fields])
+            for observable in object_observables
+        ])
+        for object_type, object_observables in observables.items()
+    )
+
+
+def _root(document):
+    """Returns the root element of a document, parsed as by the sources."""
+    return certau.source.StixSource()._load_stix_root(io.BytesIO(document))
+
+
+def _assert_identical(root):
+    """Assert that reading the observables in a document using XPath gives
+    the same results as loading the package with python-stix.
+    """
+    package = stix.core.STIXPackage.from_xml(
+        io.BytesIO(lxml.etree.tostring(root)),
+    )
+    for transform_class in TRANSFORM_CLASSES:
+        expected = transform_class._observables_for_package(package)
+        assert expected
+        assert _normalised(transform_class._observables_for_tree(root)) == \
+            _normalised(expected)
+
+    group = certau.transform.StixTransformGroup(TRANSFORM_CLASSES)
+    results = group._observables_for_tree(root)
+    for transform_class in TRANSFORM_CLASSES:
+        expected = transform_class._observables_for_package(package)
+        assert _normalised(results[transform_class]) == _normalised(expected)
+        assert all(observable.observable is None
+                   for observables in results[transform_class].values()
+                   for observable in observables)
+
+
+@pytest.mark.parametrize('stix_file', [
+    'tests/CA-TEST-STIX.xml',
+    'tests/CA-TEST-STIX-1.0.xml',
+])
+def test_xpath_corpus(stix_file):
+    """Test that the observables in the test packages are identical."""
+    root = certau.source.StixSource()._load_stix_root(stix_file)
+    _assert_identical(root)
+
+
+def test_xpath_generated_package(generated_package):
+    """Test that the observables in a generated package (with indicators,
+    nested compositions and repeated observables) are identical.
+    """
+    _assert_identical(_root(generated_package.to_xml()))
+
+
+def test_xpath_edge_cases():
+    """Test that observables that are (and aren't) read from the XML are
+    identical.
+    """
+    root = _root(PACKAGE_TEMPLATE.format(
+        observables='\n'.join(EDGE_CASES),
+        indicators=INDICATORS,
+    ))
+    _assert_identical(root)
+
+    # Most of the observables are read from the XML
+    extractor = XPathExtractor(TRANSFORM_CLASSES)
+    items = list(extractor.package_items(root))
+    read = [properties for _, _, properties in items
+            if isinstance(properties, ElementProperties)]
+    assert len(read) > len(items) / 2
+    assert len(read) < len(items)
+
+
+def test_xpath_fields():
+    """Test that object types are only read from the XML when all of the
+    fields used by the transforms can be read.
+    """
+    class PartialTransform(certau.transform.StixTransform):
+        OBJECT_FIELDS = {
+            'Address': ['address_value'],
+            'File': ['file_name', 'size_in_bytes'],
+            'EmailMessage': ['header'],
+        }
+
+    extractor = XPathExtractor([PartialTransform])
+    assert extractor.object_types == ['Address', 'DomainName', 'URI']
+    extractor = XPathExtractor(TRANSFORM_CLASSES)
+    assert extractor.object_types == [
+        'Address', 'DomainName', 'EmailMessage', 'File', 'URI',
+    ]
+
+
+def test_xpath_unsupported():
+    """Test that documents python-stix can't load aren't read either."""
+    root = _root(PACKAGE_TEMPLATE.format(
+        observables='',
+        indicators='<stix:Indicator id="example:Indicator-1" '
+                   'xsi:type="example:OtherIndicatorType"/>',
+    ))
+    with pytest.raises(UnsupportedDocumentError):
+        certau.transform.StixCsvTransform._observables_for_tree(root)
+
+    # python-cybox rejects a hash type that isn't in the vocabulary
+    root = _root(PACKAGE_TEMPLATE.format(
+        observables=_file(1, _hash(
+            '11111111111111111111111111111111',
+            '<cyboxCommon:Type xsi:type="cyboxVocabs:HashNameVocab-1.0">'
+            'XXX</cyboxCommon:Type>',
+        )),
+        indicators='',
+    ))
+    with pytest.raises(ValueError):
+        certau.transform.StixCsvTransform._observables_for_tree(root)
+
+    # and e-mail addresses without the e-mail category
+    for header in [
+        '<EmailMessageObj:From><AddressObj:Address_Value>a@example.com'
+        '</AddressObj:Address_Value></EmailMessageObj:From>',
+        '<EmailMessageObj:To><EmailMessageObj:Recipient>'
+        '<AddressObj:Address_Value>a@example.com</AddressObj:Address_Value>'
+        '</EmailMessageObj:Recipient></EmailMessageObj:To>',
+    ]:
+        root = _root(PACKAGE_TEMPLATE.format(
+            observables=_observable(
+                1, 'EmailMessageObj:EmailMessageObjectType',
+                '<EmailMessageObj:Header>{}</EmailMessageObj:Header>'.format(
+                    header),
+            ),
+            indicators='',
+        ))
+        with pytest.raises(ValueError):
+            certau.transform.StixCsvTransform._observables_for_tree(root)
+
+
+def test_xpath_extractor_reused(monkeypatch):
+    """Test that the XPath extractor for a transform class (or group) is
+    only compiled once.
+    """
+    class ReusedTransform(certau.transform.StixCsvTransform):
+        pass
+
+    extractors = []
+
+    def _extractor(transform_classes):
+        extractors.append(transform_classes)
+        return XPathExtractor(transform_classes)
+    monkeypatch.setattr(certau.transform.group, 'XPathExtractor', _extractor)
+
+    root = certau.source.StixSource()._load_stix_root(
+        'tests/CA-TEST-STIX.xml',
+    )
+    for _ in range(2):
+        ReusedTransform._observables_for_tree(root)
+        group = certau.transform.StixTransformGroup([ReusedTransform])
+        group._observables_for_tree(root)
+    assert extractors == [(ReusedTransform,)]